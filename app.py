@@ -1,23 +1,53 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, send_from_directory
+from flask import Flask, Blueprint, render_template, request, redirect, url_for, flash, session, g, has_request_context, Response, stream_with_context, before_render_template, template_rendered, send_file, abort
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user # type: ignore
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from werkzeug.exceptions import RequestEntityTooLarge, ClientDisconnected
 import os
-from weasyprint import HTML, CSS # For PDF generation
+import time
+import hashlib
+import click
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from weasyprint import HTML, CSS, default_url_fetcher # For PDF generation
+from weasyprint.text.fonts import FontConfiguration
+import threading
+import tempfile
+import zipfile
+from urllib.parse import urlsplit
 import json # Added for passing data to template
-from datetime import datetime, timezone, UTC # Python 3.12+ for UTC, otherwise use timezone.utc
+from collections import namedtuple, OrderedDict, deque
+import re
+import sqlite3
+import secrets
+from functools import wraps
+import mimetypes
+import csv
+import io
+from xml.sax.saxutils import escape as xml_escape
+from markupsafe import Markup, escape
+from datetime import datetime, timedelta, timezone, UTC # Python 3.12+ for UTC, otherwise use timezone.utc
 #edunium
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'supersecretkey' # type: ignore
 
 # Standardized datetime format for the application
 APP_WIDE_DATETIME_FORMAT = '%d/%m/%Y %H:%M'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///municipal.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('MUNICIPAL_DATABASE_URI', 'sqlite:///municipal.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# PRAGMAs applied to every new SQLite connection (see SQLITE_PROFILES); 'default' leaves SQLite's own settings
+app.config['SQLITE_PROFILE'] = os.environ.get('MUNICIPAL_SQLITE_PROFILE', 'production')
 
 db = SQLAlchemy(app)
-from sqlalchemy import desc, or_ # Import 'or_' for complex queries
+from sqlalchemy import desc, or_, and_, func, event, text, case, select, insert # Import 'or_' for complex queries
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import joinedload, contains_eager, aliased, Session as SASession
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import inspect as sa_inspect
+from contextlib import contextmanager
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
@@ -26,6 +56,113 @@ UPLOAD_FOLDER = 'uploads'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 GENERATED_PDF_FOLDER = 'generated_pdfs' # Folder for storing generated PDFs
 app.config['GENERATED_PDF_FOLDER'] = GENERATED_PDF_FOLDER
+# Uploads are written to UPLOAD_TEMP_FOLDER (same filesystem as UPLOAD_FOLDER) and renamed into place when complete
+app.config['UPLOAD_TEMP_FOLDER'] = 'uploads_incoming'
+app.config['MAX_CONTENT_LENGTH'] = 32 * 1024 * 1024 # Per request; larger files go through chunked uploads
+app.config['UPLOAD_MAX_FILE_BYTES'] = 1024 * 1024 * 1024 # Per file, whichever way it is uploaded
+app.config['UPLOAD_CHUNK_REQUEST_BYTES'] = 8 * 1024 * 1024 # Size of each chunk request; browsers send bigger files in chunks
+app.config['UPLOAD_COPY_BUFFER_BYTES'] = 1024 * 1024 # Read/write/hash unit while streaming to disk
+app.config['UPLOAD_SESSION_MAX_AGE_HOURS'] = 48 # Unfinished chunked uploads older than this are removed by `flask cleanup-uploads`
+# Attachment contents are stored once per SHA-256 under ATTACHMENT_BLOB_FOLDER/ab/cd/<sha256> (see AttachmentBlob)
+app.config['ATTACHMENT_BLOB_FOLDER'] = 'attachment_blobs'
+app.config['ATTACHMENT_GC_GRACE_HOURS'] = 24 # Unreferenced blobs are only deleted after this long
+
+# File downloads (see serve_stored_file). Flask always checks the login and answers If-None-Match itself.
+# With FILE_OFFLOAD_HEADER set, the bytes are sent by the front server instead of a Python worker:
+# 'X-Accel-Redirect' (nginx, through the internal locations in FILE_OFFLOAD_LOCATIONS) or
+# 'X-Sendfile' (Apache mod_xsendfile / lighttpd, with the absolute path). Range requests are then handled there.
+app.config['FILE_OFFLOAD_HEADER'] = os.environ.get('MUNICIPAL_FILE_OFFLOAD_HEADER') or None
+app.config['FILE_OFFLOAD_LOCATIONS'] = {
+    'UPLOAD_FOLDER': '/_protected/uploads/',
+    'GENERATED_PDF_FOLDER': '/_protected/generated_pdfs/',
+    'ATTACHMENT_BLOB_FOLDER': '/_protected/attachment_blobs/',
+}
+app.config['FILE_IMMUTABLE_MAX_AGE'] = 365 * 24 * 3600 # Cache lifetime of versioned (?v=<hash>) attachment URLs
+
+# Pagination settings for the /records listing (keyset pagination on created_at, id)
+app.config['RECORDS_PER_PAGE'] = 50
+app.config['RECORDS_MAX_PER_PAGE'] = 200
+app.config['RECORDS_COUNT_CAP'] = 10000 # Counting stops here; the listing shows "10000+" beyond it
+app.config['RECORDS_BULK_ACTION_MAX'] = 500 # Records per bulk resend / status change from the listing
+
+# JSON API (/api/v1, see api_v1 below). Clients authenticate with tokens from `flask create-api-token`.
+app.config['API_BATCH_MAX_ITEMS'] = 500 # Per batch request; each batch is a single transaction
+app.config['API_TOKEN_TOUCH_SECONDS'] = 300 # ApiToken.last_used_at is written at most this often
+
+# In-process caches are checked against their CacheGeneration at most this often (changes made by this
+# process are seen at once; other worker processes see them within this delay)
+app.config['CACHE_GENERATION_CHECK_SECONDS'] = 5
+# load_user keeps up to USER_CACHE_MAX_ENTRIES users in memory, each for at most USER_CACHE_TTL_SECONDS
+app.config['USER_CACHE_MAX_ENTRIES'] = 1000
+app.config['USER_CACHE_TTL_SECONDS'] = 300
+# Rendered dashboard panels and first pages of /records, shared by the users with the same visibility.
+# The cap counts characters of HTML (about bytes: the pages are Latin-1 text); least recently used go first.
+app.config['FRAGMENT_CACHE_ENABLED'] = True
+app.config['FRAGMENT_CACHE_MAX_BYTES'] = 32 * 1024 * 1024
+# Live updates of the dashboard and /records (Server-Sent Events from /records/events, fed by RecordChange).
+# Each process polls the change log once per RECORD_EVENTS_POLL_SECONDS for all its open streams. A stream holds
+# a worker thread, so it is closed after RECORD_EVENTS_STREAM_SECONDS and the browser reconnects where it left off.
+app.config['RECORD_EVENTS_ENABLED'] = True
+app.config['RECORD_EVENTS_POLL_SECONDS'] = 2.0
+app.config['RECORD_EVENTS_STREAM_SECONDS'] = 300
+app.config['RECORD_EVENTS_KEEPALIVE_SECONDS'] = 15
+app.config['RECORD_EVENTS_BUFFER_SIZE'] = 2000 # Recent changes kept in memory; older resumes read the table
+# Pages pass their render time instead of a change id (no query per page view); the stream starts this much
+# earlier, since a change flushed before the render may have committed after it. Repeated events are harmless.
+app.config['RECORD_EVENTS_RESUME_SLACK_SECONDS'] = 10
+app.config['RECORD_CHANGE_RETENTION_HOURS'] = 24 # Older change log rows are removed by `flask prune-record-changes`
+
+# Background PDF rendering (see PdfJob and the `flask pdf-worker` command).
+# With PDF_QUEUE_ENABLED = False the PDF is rendered inside the request, as before.
+app.config['PDF_QUEUE_ENABLED'] = True
+app.config['PDF_WORKER_PROCESSES'] = 2 # 0 renders in the worker process itself, without a pool
+app.config['PDF_WORKER_POLL_SECONDS'] = 1.0
+app.config['PDF_JOB_MAX_ATTEMPTS'] = 3
+app.config['PDF_JOB_RETRY_DELAY_SECONDS'] = 30 # Multiplied by the number of attempts so far
+app.config['PDF_JOB_STALE_SECONDS'] = 600 # 'rendering' jobs older than this are requeued by the workers
+app.config['PDF_WORKER_STALE_CHECK_SECONDS'] = 60 # How often a running worker looks for stale jobs (also at startup)
+
+# Bulk PDF export (route records_export_pdfs and `flask export-pdfs`)
+app.config['BULK_EXPORT_BATCH_SIZE'] = 50 # Records read from the DB (and rendered in parallel) at a time
+app.config['BULK_EXPORT_PROCESSES'] = 2 # 0 renders in the web/CLI process itself
+app.config['BULK_EXPORT_PDF_MAX_RECORDS'] = 300 # A single PDF is laid out in memory; larger exports must use ZIP
+
+# Spreadsheet export of the listing (route records_export): rows are streamed, never held in memory
+app.config['RECORDS_EXPORT_YIELD_PER'] = 1000 # Rows fetched from the cursor at a time
+app.config['RECORDS_EXPORT_CSV_DELIMITER'] = ';' # What Excel expects in Spanish locales
+
+# Test mode: when set to an int, any request issuing more SQL statements than this fails.
+# SQL_STATEMENT_BUDGET_OVERRIDES maps endpoint names to their own budget.
+app.config['SQL_STATEMENT_BUDGET'] = None
+app.config['SQL_STATEMENT_BUDGET_OVERRIDES'] = {}
+
+# Per-request profiling (SQL, template and PDF time): Server-Timing header, a JSON log line per request
+# and the admin page /admin/request-profile. Off by default; when off each hook is a single check.
+app.config['REQUEST_PROFILING_ENABLED'] = os.environ.get('MUNICIPAL_REQUEST_PROFILING') == '1'
+app.config['REQUEST_PROFILING_LOG_MIN_MS'] = 0 # Only requests at least this slow are logged
+app.config['REQUEST_PROFILING_MAX_STATEMENTS'] = 500 # Distinct SQL statements kept for the admin page
+
+# Prometheus metrics at /metrics (text exposition format, no client library needed).
+# Values are per process: with several web workers, scrape each one or aggregate in Prometheus.
+# Scrapers authenticate with "Authorization: Bearer <METRICS_TOKEN>" (Prometheus: `authorization: {credentials: ...}`).
+# The client address is no help behind the reverse proxy, so without a token the endpoint stays closed (404).
+app.config['METRICS_ENABLED'] = True
+app.config['METRICS_TOKEN'] = os.environ.get('MUNICIPAL_METRICS_TOKEN') or None
+
+# SQLite connection profiles: PRAGMA name -> value, in the order they are applied.
+# 'production': WAL lets readers keep working while a request writes, and synchronous=NORMAL is safe
+# with WAL (a power cut can lose the last commits, never corrupt the file). busy_timeout makes a writer
+# wait for the lock instead of failing at once with "database is locked".
+SQLITE_PROFILES = {
+    'default': {},
+    'production': {
+        'journal_mode': 'WAL',
+        'busy_timeout': 5000, # ms
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024, # bytes
+        'cache_size': -64 * 1024, # negative = KiB, i.e. 64 MiB of page cache per connection
+    },
+}
 
 # Special department name
 MESA_DE_ENTRADA_DEPT_NAME = 'Mesa de Entrada' # Example, ensure it matches DB
@@ -44,6 +181,15 @@ DEPARTMENT_CODES = {
     'Prensa': 'PR'
 }
 
+# Display labels for record statuses (same wording as the templates)
+RECORD_STATUS_LABELS = {
+    'active': 'Activo',
+    'pending': 'Pendiente',
+    'in_progress': 'En Progreso',
+    'archived': 'Archivado',
+    'urgente': 'Urgente'
+}
+
 # Inject current time into all templates
 @app.context_processor
 def inject_now():
@@ -76,6 +222,8 @@ class Note(db.Model):
     author = db.relationship('User', backref=db.backref('notes_authored', lazy='dynamic'))
     # The backref to Record will be 'record_associated' as defined in Record model
 
+    __table_args__ = (db.Index('ix_note_record_created_at', 'record_id', 'created_at'),) # Record.notes
+
     def __repr__(self):
         return f'<Note {self.id} for Record {self.record_id} by User {self.user_id}>'
 
@@ -87,9 +235,28 @@ class RecordHistory(db.Model):
     action_type = db.Column(db.String(50), nullable=False) # Ej: "Creación", "Modificación", "Reenvío", "Adjunto"
     details = db.Column(db.Text, nullable=True) # Descripción detallada de la acción
 
+    __table_args__ = (db.Index('ix_record_history_record_timestamp', 'record_id', 'timestamp'),) # Record.history_entries
+
     def __repr__(self):
         return f'<RecordHistory {self.id} - {self.action_type} for Record {self.record_id}>'
 
+class RecordChange(db.Model):
+    # Change log behind the live updates (/records/events), written by log_record_changes() in the same
+    # transaction as the change. No foreign key: rows outlive deleted records until pruned. AUTOINCREMENT keeps
+    # ids growing after a prune, since clients resume from the last id they saw.
+    id = db.Column(db.Integer, primary_key=True)
+    record_id = db.Column(db.Integer, nullable=False)
+    event = db.Column(db.String(20), nullable=False) # 'record-created', 'record-resent' or 'status-changed'
+    department_id = db.Column(db.Integer, nullable=False)
+    previous_department_id = db.Column(db.Integer, nullable=True) # Department a resent record left
+    status = db.Column(db.String(20), nullable=True)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC), nullable=False)
+
+    __table_args__ = (db.Index('ix_record_change_created_at', 'created_at'), {'sqlite_autoincrement': True})
+
+    def __repr__(self):
+        return f'<RecordChange {self.id} {self.event} record={self.record_id}>'
+
 class Record(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     sequence_number = db.Column(db.Integer, nullable=False)
@@ -102,10 +269,13 @@ class Record(db.Model):
     email = db.Column(db.String(120), nullable=True)
     description = db.Column(db.Text)
     attachment_filename = db.Column(db.String(255), nullable=True) # New field for attachment
+    attachment_sha256 = db.Column(db.String(64), db.ForeignKey('attachment_blob.sha256'), nullable=True) # Content of the attachment
+    attachment_size = db.Column(db.Integer, nullable=True) # Bytes
     status = db.Column(db.String(20), default='pending')
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC))
     updated_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC), onupdate=lambda: datetime.now(UTC))
     generated_pdf_filename = db.Column(db.String(255), nullable=True) # Stores the filename of the generated PDF
+    generated_pdf_digest = db.Column(db.String(64), nullable=True) # SHA-256 of the printed HTML + stylesheet version of that PDF
     department_id = db.Column(db.Integer, db.ForeignKey('department.id'), nullable=False)
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     
@@ -124,24 +294,1382 @@ class Record(db.Model):
                             lazy='dynamic',
                             order_by=lambda: desc(Note.created_at)) # Use lambda for late binding
 
+    # Indexes for the listing and dashboard, which page by (created_at, id) descending, optionally
+    # filtered by department and/or status, and for sequence number lookups (allocator, manual numbers)
+    __table_args__ = (
+        db.Index('ix_record_created_at_id', 'created_at', 'id'),
+        db.Index('ix_record_department_created_at', 'department_id', 'created_at', 'id'),
+        db.Index('ix_record_status_created_at', 'status', 'created_at', 'id'),
+        db.Index('ix_record_department_status_created_at', 'department_id', 'status', 'created_at', 'id'),
+        db.Index('ix_record_sequence_number', 'sequence_number'),
+    )
+
+class PdfJob(db.Model):
+    # Queue of PDF renders, written in the same transaction as the record change and processed
+    # after commit by `flask pdf-worker`. Status: queued, rendering, done, failed.
+    id = db.Column(db.Integer, primary_key=True)
+    record_id = db.Column(db.Integer, db.ForeignKey('record.id'), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC))
+    available_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC)) # Not picked up before this (retry delay)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    render_skipped = db.Column(db.Boolean, nullable=True) # True when the printed content had not changed
+
+    record = db.relationship('Record', backref=db.backref('pdf_jobs', lazy='dynamic'))
+
+    def __repr__(self):
+        return f'<PdfJob {self.id} for Record {self.record_id}: {self.status}>'
+
+class AttachmentBlob(db.Model):
+    # One stored file per distinct attachment content. Records point at it through Record.attachment_sha256
+    # (attachment_filename stays as the download name). ref_count is kept by maintain_attachment_blob_ref_counts;
+    # blobs at 0 since before the grace period are deleted by `flask gc-attachments`.
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC))
+    unreferenced_at = db.Column(db.DateTime, nullable=True, index=True) # When ref_count last dropped to 0
+
+    records = db.relationship('Record', backref='attachment_blob', lazy='dynamic')
+
+    def __repr__(self):
+        return f'<AttachmentBlob {self.sha256[:12]} refs={self.ref_count}>'
+
+class UploadSession(db.Model):
+    # Resumable chunked upload: chunks are appended to UPLOAD_TEMP_FOLDER/<id>.part until received_bytes == total_size.
+    # Status: receiving, complete (hashed, waiting for a form to use it), consumed (moved into uploads/).
+    id = db.Column(db.String(32), primary_key=True) # Random token, also the name of the partial file
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False) # Original name (secure_filename), for the extension
+    total_size = db.Column(db.Integer, nullable=False)
+    received_bytes = db.Column(db.Integer, nullable=False, default=0)
+    sha256 = db.Column(db.String(64), nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='receiving')
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC))
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC), onupdate=lambda: datetime.now(UTC))
+
+    def __repr__(self):
+        return f'<UploadSession {self.id} {self.received_bytes}/{self.total_size} {self.status}>'
+
+class ApiToken(db.Model):
+    # Bearer token for the JSON API. Only its SHA-256 is stored; `flask create-api-token` shows the token once.
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False) # The API acts as this user
+    name = db.Column(db.String(100), nullable=False) # Which integration uses it
+    token_sha256 = db.Column(db.String(64), unique=True, nullable=False)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC))
+    last_used_at = db.Column(db.DateTime, nullable=True)
+    revoked_at = db.Column(db.DateTime, nullable=True)
+
+    user = db.relationship('User')
+
+    def __repr__(self):
+        return f'<ApiToken {self.id} {self.name!r} user={self.user_id}>'
+
+class ImportRun(db.Model):
+    # Progress of `flask import-records`, committed with each batch: a crashed import is resumed after rows_done
+    id = db.Column(db.Integer, primary_key=True)
+    source_name = db.Column(db.String(255), nullable=False)
+    source_sha256 = db.Column(db.String(64), nullable=False, index=True) # Same file -> same run
+    status = db.Column(db.String(20), nullable=False, default='running') # running, finished
+    rows_done = db.Column(db.Integer, nullable=False, default=0) # Source rows processed (imported or rejected)
+    records_created = db.Column(db.Integer, nullable=False, default=0)
+    rows_rejected = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC))
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC))
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<ImportRun {self.id} {self.source_name!r} {self.status} rows={self.rows_done}>'
+
+class SequenceCounter(db.Model):
+    # Last sequence number handed out automatically; only advanced by allocate_sequence_number()
+    name = db.Column(db.String(50), primary_key=True)
+    last_value = db.Column(db.Integer, nullable=False, default=0)
+
+class SequenceReservation(db.Model):
+    # Sequence numbers set aside for manual entry; the automatic allocator never hands them out
+    sequence_number = db.Column(db.Integer, primary_key=True)
+    note = db.Column(db.String(200), nullable=True)
+    reserved_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    reserved_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC))
+    record_id = db.Column(db.Integer, db.ForeignKey('record.id'), nullable=True) # Set once a record uses the number
+
+    def __repr__(self):
+        return f'<SequenceReservation {self.sequence_number:04d} record={self.record_id}>'
+
+class CacheGeneration(db.Model):
+    # Version of data cached in process memory (see DepartmentCache). Bumped in the transaction that changes
+    # the data, so every worker process notices and reloads its copy.
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class DepartmentRecordCount(db.Model):
+    # Number of records per (department, status), kept up to date by maintain_department_record_counts()
+    # so the dashboard does not have to load or count Record rows.
+    department_id = db.Column(db.Integer, db.ForeignKey('department.id'), primary_key=True)
+    status = db.Column(db.String(20), primary_key=True) # '' for records without status
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<DepartmentRecordCount dept={self.department_id} status={self.status!r}: {self.count}>'
+
+# Keep DepartmentRecordCount in sync with Record inserts, department/status changes and deletes.
+# Runs inside the flush, so the counters are committed in the same transaction as the records
+# (add_record, edit_record, resend_record, seed_db...).
+@event.listens_for(SASession, 'before_flush')
+def maintain_department_record_counts(session, flush_context, instances):
+    deltas = {}
+    def add_delta(department_id, status, delta):
+        if department_id is not None:
+            key = (department_id, status or '')
+            deltas[key] = deltas.get(key, 0) + delta
+
+    for obj in session.new:
+        if isinstance(obj, Record):
+            add_delta(obj.department_id, obj.status or Record.__table__.c.status.default.arg, 1)
+    for obj in session.deleted:
+        if isinstance(obj, Record):
+            add_delta(obj.department_id, obj.status, -1)
+    for obj in session.dirty:
+        if not isinstance(obj, Record):
+            continue
+        obj_state = sa_inspect(obj)
+        department_history = obj_state.attrs.department_id.history
+        status_history = obj_state.attrs.status.history
+        if not department_history.has_changes() and not status_history.has_changes():
+            continue
+        old_department_id = department_history.deleted[0] if department_history.deleted else obj.department_id
+        old_status = status_history.deleted[0] if status_history.deleted else obj.status
+        add_delta(old_department_id, old_status, -1)
+        add_delta(obj.department_id, obj.status, 1)
+
+    apply_department_record_count_deltas(session.connection(), deltas)
+
+# The hook above takes the previous department and status from the attribute history, which only has them if
+# they were loaded when the new value was set. Active history loads them first, also on instances expired by
+# a commit (e.g. setting record.status right after db.session.commit()).
+@event.listens_for(Record.department_id, 'set', active_history=True)
+@event.listens_for(Record.status, 'set', active_history=True)
+def load_previous_record_count_key(target, value, oldvalue, initiator):
+    pass
+
+def apply_department_record_count_deltas(connection, deltas):
+    """Adds {(department_id, status): delta} to DepartmentRecordCount (also for Core inserts, which skip the hook)."""
+    counts_table = DepartmentRecordCount.__table__
+    for (department_id, status), delta in deltas.items():
+        if delta == 0:
+            continue
+        upsert = sqlite_insert(counts_table).values(department_id=department_id, status=status, count=delta)\
+                                            .on_conflict_do_update(index_elements=['department_id', 'status'],
+                                                                   set_={'count': counts_table.c.count + delta})
+        connection.execute(upsert)
+
+@event.listens_for(SASession, 'before_flush')
+def maintain_attachment_blob_ref_counts(session, flush_context, instances):
+    deltas = {}
+    def add_delta(sha256, delta):
+        if sha256:
+            deltas[sha256] = deltas.get(sha256, 0) + delta
+
+    for obj in session.new:
+        if isinstance(obj, Record):
+            add_delta(obj.attachment_sha256, 1)
+    for obj in session.deleted:
+        if isinstance(obj, Record):
+            add_delta(obj.attachment_sha256, -1)
+    for obj in session.dirty:
+        if not isinstance(obj, Record):
+            continue
+        blob_history = sa_inspect(obj).attrs.attachment_sha256.history
+        if not blob_history.has_changes():
+            continue
+        for sha256 in blob_history.deleted:
+            add_delta(sha256, -1)
+        for sha256 in blob_history.added:
+            add_delta(sha256, 1)
+
+    apply_attachment_blob_ref_deltas(session.connection(), deltas)
+
+# Same as load_previous_record_count_key: the blob an expired record pointed at must be in the history
+@event.listens_for(Record.attachment_sha256, 'set', active_history=True)
+def load_previous_attachment_blob(target, value, oldvalue, initiator):
+    pass
+
+def apply_attachment_blob_ref_deltas(connection, deltas):
+    """Adds {sha256: delta} to AttachmentBlob.ref_count (also for Core inserts, which skip the hook)."""
+    blobs_table = AttachmentBlob.__table__
+    for sha256, delta in deltas.items():
+        if delta == 0:
+            continue
+        new_count = blobs_table.c.ref_count + delta
+        connection.execute(
+            blobs_table.update().where(blobs_table.c.sha256 == sha256)
+                       .values(ref_count=new_count,
+                               unreferenced_at=case((new_count <= 0, datetime.now(UTC)), else_=None)))
+
+def rebuild_attachment_blob_ref_counts():
+    """Recomputes AttachmentBlob.ref_count from the record table (after bulk loads or migrations)."""
+    referenced = dict(db.session.query(Record.attachment_sha256, func.count(Record.id))
+                                .filter(Record.attachment_sha256.isnot(None))
+                                .group_by(Record.attachment_sha256).all())
+    now = datetime.now(UTC)
+    for blob in AttachmentBlob.query.all():
+        ref_count = referenced.get(blob.sha256, 0)
+        if blob.ref_count != ref_count or (ref_count == 0) != (blob.unreferenced_at is not None):
+            blob.ref_count = ref_count
+            blob.unreferenced_at = (blob.unreferenced_at or now) if ref_count == 0 else None
+    db.session.commit()
+
+def rebuild_department_record_counts():
+    """Recomputes DepartmentRecordCount from the record table with a single grouped COUNT."""
+    status_col = func.coalesce(Record.status, '')
+    grouped = db.session.query(Record.department_id, status_col, func.count(Record.id))\
+                        .group_by(Record.department_id, status_col).all()
+    DepartmentRecordCount.query.delete()
+    db.session.add_all([DepartmentRecordCount(department_id=department_id, status=status, count=count)
+                        for department_id, status, count in grouped])
+    # Also called after Core inserts (seed_db), which did not bump the record versions
+    bump_record_versions(db.session.connection(), [department_id for (department_id,) in db.session.query(Department.id)])
+    db.session.commit()
+
+def get_department_record_counts(department_ids=None):
+    """
+    Returns {department_id: {'total': n, 'by_status': {status: n}}} read from the counter table,
+    in one query (O(departments), not O(records)).
+    """
+    query = DepartmentRecordCount.query.filter(DepartmentRecordCount.count > 0)
+    if department_ids is not None:
+        query = query.filter(DepartmentRecordCount.department_id.in_(department_ids))
+    counts = {}
+    for row in query.all():
+        dept_counts = counts.setdefault(row.department_id, {'total': 0, 'by_status': {}})
+        dept_counts['total'] += row.count
+        dept_counts['by_status'][row.status] = row.count
+    return counts
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
-
-# Helper function to get the next available sequence number, skipping those ending in 8 or 9
-def get_next_available_sequence_number():
-    """Calculates the next available sequence number, skipping numbers ending in 8 or 9."""
-    last_record = Record.query.order_by(Record.sequence_number.desc()).first()
-    current_max_sequence = last_record.sequence_number if last_record else 0
-    next_sequence = current_max_sequence + 1
+    return user_cache.get(int(user_id))
+
+@login_manager.request_loader
+def load_user_from_api_token(request):
+    # Only the JSON API accepts tokens (Authorization: Bearer <token>); the session cookie is checked first
+    if not request.path.startswith(api_v1.url_prefix + '/'):
+        return None
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    api_token = ApiToken.query.filter_by(token_sha256=hashlib.sha256(token.strip().encode('utf-8')).hexdigest(),
+                                         revoked_at=None).first()
+    if not api_token:
+        return None
+    now = datetime.now(UTC)
+    touch_before = now - timedelta(seconds=app.config['API_TOKEN_TOUCH_SECONDS'])
+    if api_token.last_used_at is None or api_token.last_used_at.replace(tzinfo=UTC) < touch_before:
+        api_token.last_used_at = now
+        db.session.commit()
+    g.api_token = api_token
+    return user_cache.get(api_token.user_id)
+
+# Query options per view, so templates never trigger lazy loads row by row (N+1 queries).
+# 'listing' expects the query to already JOIN Department and User (as records() does).
+def record_load_options(profile):
+    if profile == 'listing':
+        return (contains_eager(Record.department), contains_eager(Record.creator))
+    if profile == 'dashboard':
+        return (joinedload(Record.department),)
+    if profile in ('detail', 'pdf'):
+        return (joinedload(Record.department), joinedload(Record.creator))
+    raise ValueError(f"Unknown record load profile: {profile}")
+
+# SQL statement budget (test mode)
+class SQLStatementBudgetExceeded(AssertionError):
+    pass
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_sql_statements(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_statement_count' in g:
+        g.sql_statement_count += 1
+
+@app.before_request
+def start_sql_statement_count():
+    if app.config.get('SQL_STATEMENT_BUDGET') is not None:
+        g.sql_statement_count = 0
+
+@app.after_request
+def check_sql_statement_budget(response):
+    budget = app.config.get('SQL_STATEMENT_BUDGET')
+    if budget is not None and 'sql_statement_count' in g:
+        budget = app.config.get('SQL_STATEMENT_BUDGET_OVERRIDES', {}).get(request.endpoint, budget)
+        if g.sql_statement_count > budget:
+            raise SQLStatementBudgetExceeded(
+                f"{request.method} {request.path} ({request.endpoint}) issued {g.sql_statement_count} SQL statements, budget is {budget}.")
+    return response
+
+# Per-request profiling.
+# g.request_profile is only set when REQUEST_PROFILING_ENABLED; every hook below returns right away otherwise.
+# Aggregates are per process and live in memory (they are reset on restart or from the admin page).
+_request_profile_stats = {'endpoints': {}, 'statements': {}, 'since': datetime.now(UTC)}
+_request_profile_lock = threading.Lock()
+
+def current_request_profile():
+    if has_request_context():
+        return g.get('request_profile')
+    return None
+
+@contextmanager
+def request_profile_timer(section):
+    """Adds the time spent in the block to the current request's profile under section (e.g. 'pdf_ms')."""
+    profile = current_request_profile()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile[section] += (time.perf_counter() - start) * 1000
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    if current_request_profile() is not None:
+        conn.info['request_profile_start'] = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    profile = current_request_profile()
+    start = conn.info.pop('request_profile_start', None)
+    if profile is None or start is None:
+        return
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    profile['sql_count'] += 1
+    profile['sql_ms'] += elapsed_ms
+    statement_stats = profile['statements'].setdefault(statement, [0, 0.0, 0.0]) # count, total ms, max ms
+    statement_stats[0] += 1
+    statement_stats[1] += elapsed_ms
+    statement_stats[2] = max(statement_stats[2], elapsed_ms)
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    profile = current_request_profile()
+    if profile is not None:
+        profile['template_start'] = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def stop_template_timer(sender, template, context, **extra):
+    profile = current_request_profile()
+    if profile is not None and profile.get('template_start') is not None:
+        profile['template_ms'] += (time.perf_counter() - profile.pop('template_start')) * 1000
+
+@app.before_request
+def start_request_profile():
+    if app.config['REQUEST_PROFILING_ENABLED']:
+        g.request_profile = {'start': time.perf_counter(), 'sql_count': 0, 'sql_ms': 0.0,
+                             'template_ms': 0.0, 'pdf_ms': 0.0, 'statements': {}}
+
+def record_request_profile(endpoint, wall_ms, profile):
+    with _request_profile_lock:
+        endpoint_stats = _request_profile_stats['endpoints'].setdefault(endpoint, {
+            'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'sql_count': 0, 'sql_ms': 0.0, 'template_ms': 0.0, 'pdf_ms': 0.0})
+        endpoint_stats['count'] += 1
+        endpoint_stats['total_ms'] += wall_ms
+        endpoint_stats['max_ms'] = max(endpoint_stats['max_ms'], wall_ms)
+        for key in ('sql_count', 'sql_ms', 'template_ms', 'pdf_ms'):
+            endpoint_stats[key] += profile[key]
+
+        statements = _request_profile_stats['statements']
+        for statement, (count, total_ms, max_ms) in profile['statements'].items():
+            statement_stats = statements.get(statement)
+            if statement_stats is None:
+                if len(statements) >= app.config['REQUEST_PROFILING_MAX_STATEMENTS']:
+                    continue # Bounded memory: new distinct statements are dropped once the table is full
+                statement_stats = statements[statement] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'endpoints': set()}
+            statement_stats['count'] += count
+            statement_stats['total_ms'] += total_ms
+            statement_stats['max_ms'] = max(statement_stats['max_ms'], max_ms)
+            statement_stats['endpoints'].add(endpoint)
+
+@app.after_request
+def finish_request_profile(response):
+    profile = g.pop('request_profile', None)
+    if profile is None:
+        return response
+    wall_ms = (time.perf_counter() - profile['start']) * 1000
+    endpoint = request.endpoint or 'unknown'
+    response.headers['Server-Timing'] = ', '.join([
+        f'app;dur={wall_ms:.1f}',
+        f'sql;dur={profile["sql_ms"]:.1f};desc="{profile["sql_count"]} statements"',
+        f'tpl;dur={profile["template_ms"]:.1f}',
+        f'pdf;dur={profile["pdf_ms"]:.1f}',
+    ])
+    if wall_ms >= app.config['REQUEST_PROFILING_LOG_MIN_MS']:
+        app.logger.info(json.dumps({
+            'event': 'request_profile', 'method': request.method, 'path': request.path, 'endpoint': endpoint,
+            'status': response.status_code, 'wall_ms': round(wall_ms, 2), 'sql_count': profile['sql_count'],
+            'sql_ms': round(profile['sql_ms'], 2), 'template_ms': round(profile['template_ms'], 2),
+            'pdf_ms': round(profile['pdf_ms'], 2),
+        }))
+    record_request_profile(endpoint, wall_ms, profile)
+    return response
+
+def get_request_profile_summary(limit=20):
+    """Slowest endpoints (by average time) and statements (by total time) seen by this process."""
+    with _request_profile_lock:
+        endpoints = [dict(stats, endpoint=endpoint, avg_ms=stats['total_ms'] / stats['count'],
+                          avg_sql_count=stats['sql_count'] / stats['count'])
+                     for endpoint, stats in _request_profile_stats['endpoints'].items()]
+        statements = [dict(stats, statement=statement, avg_ms=stats['total_ms'] / stats['count'],
+                           endpoints=sorted(stats['endpoints']))
+                      for statement, stats in _request_profile_stats['statements'].items()]
+        since = _request_profile_stats['since']
+    endpoints.sort(key=lambda stats: stats['avg_ms'], reverse=True)
+    statements.sort(key=lambda stats: stats['total_ms'], reverse=True)
+    return endpoints[:limit], statements[:limit], since
+
+def reset_request_profile_stats():
+    with _request_profile_lock:
+        _request_profile_stats['endpoints'].clear()
+        _request_profile_stats['statements'].clear()
+        _request_profile_stats['since'] = datetime.now(UTC)
+
+# Metrics (Prometheus text format)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PDF_RENDER_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_metrics_lock = threading.Lock()
+_metrics_registry = []
+
+def format_metric_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    def escape_label_value(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape_label_value(value)}"' for name, value in pairs) + '}'
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self.values = {}
+        _metrics_registry.append(self)
+
+    def samples(self):
+        for labelvalues, value in sorted(self.values.items()):
+            yield self.name, format_metric_labels(self.labelnames, labelvalues), value
+
+class MetricCounter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, *labelvalues):
+        with _metrics_lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def set(self, value, *labelvalues):
+        """For counters read from the database at scrape time (still only growing)."""
+        with _metrics_lock:
+            self.values[labelvalues] = value
+
+class MetricGauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, *labelvalues):
+        with _metrics_lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def set(self, value, *labelvalues):
+        with _metrics_lock:
+            self.values[labelvalues] = value
+
+class MetricHistogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        with _metrics_lock:
+            series = self.values.get(labelvalues)
+            if series is None:
+                series = self.values[labelvalues] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def set_series(self, bucket_counts, total, count, *labelvalues):
+        """Replaces a series with cumulative bucket_counts (one per bucket) read at scrape time."""
+        with _metrics_lock:
+            self.values[labelvalues] = {'buckets': list(bucket_counts), 'sum': total, 'count': count}
+
+    def samples(self):
+        for labelvalues, series in sorted(self.values.items()):
+            for upper_bound, bucket_count in zip(self.buckets, series['buckets']):
+                yield (f'{self.name}_bucket', format_metric_labels(self.labelnames, labelvalues, [('le', upper_bound)]),
+                       bucket_count)
+            yield f'{self.name}_bucket', format_metric_labels(self.labelnames, labelvalues, [('le', '+Inf')]), series['count']
+            yield f'{self.name}_sum', format_metric_labels(self.labelnames, labelvalues), series['sum']
+            yield f'{self.name}_count', format_metric_labels(self.labelnames, labelvalues), series['count']
+
+HTTP_REQUEST_DURATION = MetricHistogram('municipal_http_request_duration_seconds',
+                                        'Request latency by Flask endpoint.', ('endpoint', 'method'))
+HTTP_REQUESTS_TOTAL = MetricCounter('municipal_http_requests_total', 'Requests by endpoint and status code.',
+                                    ('endpoint', 'method', 'status'))
+HTTP_REQUESTS_IN_FLIGHT = MetricGauge('municipal_http_requests_in_flight', 'Requests being handled right now.')
+PDF_RENDER_DURATION = MetricHistogram('municipal_pdf_render_duration_seconds',
+                                      'PDF renders of this process (inline, with PDF_QUEUE_ENABLED off), including skipped renders.',
+                                      buckets=PDF_RENDER_BUCKETS)
+PDF_RENDER_FAILURES = MetricCounter('municipal_pdf_render_failures_total', 'PDF renders of this process that raised an error.')
+# The pdf-worker (and its pool processes) is not scraped: its renders are read back from PdfJob instead
+PDF_JOB_RENDER_DURATION = MetricHistogram('municipal_pdf_job_render_duration_seconds',
+                                          'Render time of the done PDF jobs (pdf-worker), read from PdfJob at scrape time.',
+                                          buckets=PDF_RENDER_BUCKETS)
+PDF_JOB_RENDER_FAILURES = MetricCounter('municipal_pdf_job_render_failures_total',
+                                        'Failed PDF job attempts (pdf-worker), read from PdfJob at scrape time.')
+UPLOAD_BYTES = MetricCounter('municipal_upload_bytes_total', 'Bytes of attachments saved, by endpoint.', ('endpoint',))
+SQLITE_LOCK_WAIT = MetricHistogram('municipal_sqlite_lock_wait_seconds',
+                                   'Time waiting for the SQLite write lock in BEGIN IMMEDIATE.')
+SQLITE_BUSY_ERRORS = MetricCounter('municipal_sqlite_busy_errors_total',
+                                   'Statements that failed with "database is locked" after the busy timeout.')
+DB_POOL_CONNECTIONS = MetricGauge('municipal_db_pool_connections', 'Connection pool usage, read at scrape time.',
+                                  ('state',))
+PDF_JOBS = MetricGauge('municipal_pdf_jobs', 'PDF jobs in the queue table by status, read at scrape time.', ('status',))
+
+def observe_upload(size):
+    """Counts the size of an attachment that was just received."""
+    UPLOAD_BYTES.inc(size, request.endpoint or 'unknown')
+
+@event.listens_for(Engine, 'handle_error')
+def count_sqlite_busy_errors(exception_context):
+    if 'database is locked' in str(exception_context.original_exception):
+        SQLITE_BUSY_ERRORS.inc()
+
+CACHE_REQUESTS = MetricCounter('municipal_cache_requests_total', 'Lookups in the in-process caches by result.',
+                               ('cache', 'result'))
+
+# Departments (a few rows that almost never change) are read on nearly every request: dropdowns, the user's
+# own department, digital number codes. DepartmentCache keeps them in process memory as DepartmentInfo
+# tuples (not ORM objects, so they can be shared between requests and threads). Code that assigns a
+# department to a record through the relationship still loads the ORM object.
+DepartmentInfo = namedtuple('DepartmentInfo', 'id name description code')
+
+def bump_cache_generation(connection, name):
+    # A new row starts from the clock rather than 1, so a recreated database (seed_db) cannot repeat a
+    # generation that a running process still has cached
+    generations_table = CacheGeneration.__table__
+    connection.execute(sqlite_insert(generations_table).values(name=name, value=int(time.time() * 1000))
+                       .on_conflict_do_update(index_elements=['name'], set_={'value': generations_table.c.value + 1}))
+
+def read_cache_generation(name):
+    return db.session.query(CacheGeneration.value).filter_by(name=name).scalar() or 0
+
+class DepartmentCache:
+    """
+    Snapshot of the departments, reloaded when the 'departments' CacheGeneration differs from the one it was
+    built from. The generation is read at most every CACHE_GENERATION_CHECK_SECONDS; a commit in this process
+    that changes a department drops the snapshot at once.
+    """
+    GENERATION = 'departments'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None # (generation, {id: DepartmentInfo}, {name: DepartmentInfo}, [by name], [by id])
+        self._checked_at = 0.0
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+
+    def _current(self):
+        snapshot, now = self._snapshot, time.monotonic()
+        if snapshot is not None and now - self._checked_at < app.config['CACHE_GENERATION_CHECK_SECONDS']:
+            CACHE_REQUESTS.inc(1, 'departments', 'hit')
+            return snapshot
+        generation = read_cache_generation(self.GENERATION)
+        if snapshot is not None and snapshot[0] == generation:
+            self._checked_at = now
+            CACHE_REQUESTS.inc(1, 'departments', 'hit')
+            return snapshot
+        CACHE_REQUESTS.inc(1, 'departments', 'miss')
+        infos = [DepartmentInfo(dept.id, dept.name, dept.description, DEPARTMENT_CODES.get(dept.name, f"DPT{dept.id}"))
+                 for dept in Department.query.order_by(Department.id)]
+        snapshot = (generation, {info.id: info for info in infos}, {info.name: info for info in infos},
+                    sorted(infos, key=lambda info: info.name), infos)
+        with self._lock:
+            self._snapshot, self._checked_at = snapshot, now
+        return snapshot
+
+    def all(self, order_by='name'):
+        """All departments, sorted by 'name' (dropdowns) or 'id' (creation order)."""
+        return list(self._current()[3 if order_by == 'name' else 4])
+
+    def get(self, department_id):
+        return self._current()[1].get(department_id) if department_id else None
+
+    def by_name(self, name):
+        return self._current()[2].get(name) if name else None
+
+    def id_for_name(self, name):
+        info = self.by_name(name)
+        return info.id if info else None
+
+    def code(self, department_id):
+        """Code used in digital numbers and attachment names (DEPARTMENT_CODES, or DPT<id>)."""
+        info = self.get(department_id)
+        return info.code if info else f"DPT{department_id}"
+
+department_cache = DepartmentCache()
+
+class SessionUser:
+    """
+    The logged-in user as requests see it (current_user): the columns routes and templates read, without the
+    password hash or any ORM state. Built by UserCache; code that needs the User row loads it explicitly.
+    """
+    __slots__ = ('id', 'username', 'name', 'role', 'department')
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, id, username, name, role, department):
+        self.id, self.username, self.name, self.role, self.department = id, username, name, role, department
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, user.name, user.role, user.department)
+
+    def get_id(self):
+        return str(self.id)
+
+    def __repr__(self):
+        return f'<SessionUser {self.id} {self.username!r} {self.role}>'
+
+class UserCache:
+    """
+    SessionUser by id for load_user, so an authenticated request does not query the user table. Entries expire
+    after USER_CACHE_TTL_SECONDS and the least recently used are dropped beyond USER_CACHE_MAX_ENTRIES.
+    Everything is dropped when the 'users' CacheGeneration changes (a user was added, edited or deleted by any
+    process), which is checked at most every CACHE_GENERATION_CHECK_SECONDS.
+    """
+    GENERATION = 'users'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # user id -> (expires at, SessionUser or None for a deleted user)
+        self._generation = None
+        self._checked_at = 0.0
+
+    def invalidate(self, user_ids=None):
+        with self._lock:
+            if user_ids is None:
+                self._entries.clear()
+            for user_id in user_ids or ():
+                self._entries.pop(user_id, None)
+
+    def get(self, user_id):
+        now = time.monotonic()
+        if now - self._checked_at >= app.config['CACHE_GENERATION_CHECK_SECONDS']:
+            generation = read_cache_generation(self.GENERATION)
+            with self._lock:
+                if generation != self._generation:
+                    self._entries.clear()
+                    self._generation = generation
+                self._checked_at = now
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                CACHE_REQUESTS.inc(1, 'users', 'hit')
+                return entry[1]
+        CACHE_REQUESTS.inc(1, 'users', 'miss')
+        row = db.session.query(User.id, User.username, User.name, User.role, User.department)\
+                        .filter(User.id == user_id).first()
+        principal = SessionUser(*row) if row else None
+        with self._lock:
+            self._entries[user_id] = (now + app.config['USER_CACHE_TTL_SECONDS'], principal)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > app.config['USER_CACHE_MAX_ENTRIES']:
+                self._entries.popitem(last=False)
+        return principal
+
+user_cache = UserCache()
+
+def changed_instances(session, model):
+    """Instances of model added, deleted or with a column change in this flush. Collection changes do not count
+    (record.department = ... also touches Department.records)."""
+    changed = [obj for obj in (*session.new, *session.deleted) if isinstance(obj, model)]
+    changed += [obj for obj in session.dirty
+                if isinstance(obj, model) and session.is_modified(obj, include_collections=False)]
+    return changed
+
+@event.listens_for(SASession, 'before_flush')
+def bump_cache_generations(session, flush_context, instances):
+    if changed_instances(session, Department):
+        bump_cache_generation(session.connection(), DepartmentCache.GENERATION)
+        session.info.setdefault('stale_caches', set()).add(DepartmentCache.GENERATION)
+    if changed_instances(session, User):
+        bump_cache_generation(session.connection(), UserCache.GENERATION)
+        session.info.setdefault('stale_caches', set()).add(UserCache.GENERATION)
+    record_department_ids = set()
+    for record in changed_instances(session, Record):
+        record_department_ids.add(record.department_id)
+        record_department_ids.update(sa_inspect(record).attrs.department_id.history.deleted) # Moved from there
+    if record_department_ids:
+        bump_record_versions(session.connection(), record_department_ids)
+
+@event.listens_for(SASession, 'after_commit')
+def invalidate_caches_after_commit(session):
+    # This process drops its copy at once; the others notice the new generation
+    stale_caches = session.info.pop('stale_caches', ())
+    if DepartmentCache.GENERATION in stale_caches:
+        department_cache.invalidate()
+    if UserCache.GENERATION in stale_caches:
+        user_cache.invalidate()
+
+@event.listens_for(SASession, 'after_rollback')
+def forget_cache_changes(session):
+    session.info.pop('stale_caches', None)
+
+# RecordChange rows for the live updates. after_flush rather than before_flush: new records have their id by
+# then, and the attribute history still shows what the flush changed.
+@event.listens_for(SASession, 'after_flush')
+def log_record_changes(session, flush_context):
+    changes = []
+    for obj in session.new:
+        if isinstance(obj, Record):
+            changes.append({'record_id': obj.id, 'event': 'record-created', 'department_id': obj.department_id,
+                            'previous_department_id': None, 'status': obj.status})
+    for obj in session.dirty:
+        if not isinstance(obj, Record) or obj in session.deleted:
+            continue
+        obj_state = sa_inspect(obj)
+        department_history = obj_state.attrs.department_id.history
+        if department_history.has_changes():
+            changes.append({'record_id': obj.id, 'event': 'record-resent', 'department_id': obj.department_id,
+                            'previous_department_id': department_history.deleted[0] if department_history.deleted else None,
+                            'status': obj.status})
+        elif obj_state.attrs.status.history.has_changes():
+            changes.append({'record_id': obj.id, 'event': 'status-changed', 'department_id': obj.department_id,
+                            'previous_department_id': None, 'status': obj.status})
+    insert_record_changes(session.connection(), changes)
+
+def insert_record_changes(connection, changes):
+    """Writes RecordChange rows (also for Core inserts, which skip the hook)."""
+    if changes:
+        connection.execute(insert(RecordChange), changes)
+
+# A change as sent to the event streams: the log row plus the record as it was when the change was read
+RecordChangeEvent = namedtuple('RecordChangeEvent', 'id event record_id department_id previous_department_id '
+                                                    'record_department_id digital_number full_name status '
+                                                    'created_at created_by')
+
+def fetch_record_changes(after_id, limit):
+    """RecordChange rows after after_id with the current data of their records, in one query."""
+    rows = db.session.query(RecordChange.id, RecordChange.event, RecordChange.record_id, RecordChange.department_id,
+                            RecordChange.previous_department_id, Record.department_id, Record.digital_number,
+                            Record.full_name, Record.status, Record.created_at, User.name)\
+                     .outerjoin(Record, Record.id == RecordChange.record_id)\
+                     .outerjoin(User, User.id == Record.created_by)\
+                     .filter(RecordChange.id > after_id)\
+                     .order_by(RecordChange.id).limit(limit).all()
+    return [RecordChangeEvent(*row) for row in rows]
+
+def latest_record_change_id():
+    return db.session.query(func.max(RecordChange.id)).scalar() or 0
+
+def record_change_id_before(moment):
+    """Id to resume after so that every change flushed since moment is sent."""
+    first_id = db.session.query(func.min(RecordChange.id)).filter(RecordChange.created_at >= moment).scalar()
+    return first_id - 1 if first_id is not None else latest_record_change_id()
+
+def touched_department_ids(changes):
+    return {department_id for change in changes
+            for department_id in (change.department_id, change.previous_department_id) if department_id is not None}
+
+class RecordChangeFeed:
+    """
+    Recent RecordChange rows shared by all the event streams of this process. Whichever stream finds the last
+    poll older than RECORD_EVENTS_POLL_SECONDS reads the new rows and the counts of their departments; the
+    others only filter the buffer. A stream resuming from before the buffer reads the table itself.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changes = deque() # RecordChangeEvent by ascending id
+        self._department_counts = {} # department id -> counts read by the last poll that touched it
+        self._floor_id = None # Every change after this id (up to _last_id) is in _changes
+        self._last_id = None
+        self._polled_at = 0.0
+        self._polling = False
+
+    def changes_after(self, after_id):
+        """Returns (changes after after_id, {department id: counts} for the departments they touch)."""
+        self._poll_if_due()
+        with self._lock:
+            if self._floor_id is not None and after_id >= self._floor_id:
+                changes = []
+                for change in reversed(self._changes):
+                    if change.id <= after_id:
+                        break
+                    changes.append(change)
+                changes.reverse()
+                return changes, {department_id: self._department_counts[department_id]
+                                 for department_id in touched_department_ids(changes)}
+        changes = fetch_record_changes(after_id, app.config['RECORD_EVENTS_BUFFER_SIZE'])
+        return changes, self._read_counts(touched_department_ids(changes))
+
+    def _read_counts(self, department_ids):
+        counts = get_department_record_counts(list(department_ids)) if department_ids else {}
+        return {department_id: counts.get(department_id, {'total': 0, 'by_status': {}}) for department_id in department_ids}
+
+    def _poll_if_due(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._polling or now - self._polled_at < app.config['RECORD_EVENTS_POLL_SECONDS']:
+                return
+            self._polling = True
+            last_id = self._last_id
+        try:
+            limit = app.config['RECORD_EVENTS_BUFFER_SIZE']
+            if last_id is None: # First poll: the buffer starts at the current end of the log
+                last_id = latest_record_change_id()
+                changes = []
+            else:
+                changes = fetch_record_changes(last_id, limit)
+            department_counts = self._read_counts(touched_department_ids(changes))
+            with self._lock:
+                if self._last_id is None:
+                    self._floor_id = last_id
+                self._changes.extend(changes)
+                while len(self._changes) > limit:
+                    self._floor_id = self._changes.popleft().id
+                self._last_id = changes[-1].id if changes else last_id
+                self._department_counts.update(department_counts)
+                # A full batch means more rows are waiting: the next stream polls again at once
+                self._polled_at = 0.0 if len(changes) == limit else now
+        finally:
+            with self._lock:
+                self._polling = False
+
+record_change_feed = RecordChangeFeed()
+
+def record_change_payload(change, access):
+    """The event data: the record as it is now, or only its ids if the user can no longer see it (resent away, deleted)."""
+    if change.record_department_id is None or not access.can_view_department(change.record_department_id):
+        return {'record_id': change.record_id, 'visible': False, 'department_id': change.department_id,
+                'previous_department_id': change.previous_department_id}
+    department = department_cache.get(change.record_department_id)
+    return {
+        'record_id': change.record_id, 'visible': True,
+        'department_id': change.record_department_id, 'department_name': department.name if department else '',
+        'previous_department_id': change.previous_department_id,
+        'digital_number': change.digital_number, 'resent': len(change.digital_number.split('-')) == 6,
+        'full_name': change.full_name, 'status': change.status,
+        'status_label': RECORD_STATUS_LABELS.get(change.status, (change.status or '').capitalize()),
+        'created_at': change.created_at.strftime(APP_WIDE_DATETIME_FORMAT),
+        'created_ts': change.created_at.timestamp(), # Same value as the rows' data-created
+        'created_by': change.created_by or '',
+        'url': url_for('view_record', record_id=change.record_id),
+        'edit_url': url_for('edit_record', record_id=change.record_id),
+    }
+
+def format_server_sent_event(event_name, data, event_id=None):
+    lines = [f'event: {event_name}']
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append('data: ' + json.dumps(data, ensure_ascii=False))
+    return '\n'.join(lines) + '\n\n'
+
+def record_events_url():
+    """URL the live updates of the page being rendered connect to (None when disabled)."""
+    if not app.config['RECORD_EVENTS_ENABLED']:
+        return None
+    return url_for('record_events', rendered_at=f'{time.time():.3f}')
+
+# Record access policy: admins and users of PRIVILEGED_VIEW_DEPARTMENTS see every record, everyone else only
+# the records of their own department. record_access() resolves that to department ids once per request, so
+# checks compare record.department_id and queries get WHERE department_id IN (...) without touching Department.
+class RecordAccess:
+    __slots__ = ('user_id', 'can_view_all', 'own_department_id', 'department_ids')
+
+    def __init__(self, user):
+        self.user_id = user.id
+        self.can_view_all = user.role == 'admin' or user.department in PRIVILEGED_VIEW_DEPARTMENTS
+        self.own_department_id = department_cache.id_for_name(user.department)
+        # Visible departments when restricted (empty if the user's department does not exist)
+        self.department_ids = frozenset() if self.own_department_id is None else frozenset([self.own_department_id])
+
+    def can_view_department(self, department_id):
+        return self.can_view_all or department_id in self.department_ids
+
+    def can_view(self, record):
+        return self.can_view_department(record.department_id)
+
+    def records_filter(self):
+        """SQL condition on Record.department_id for the visible records."""
+        if self.can_view_all:
+            return db.true()
+        return Record.department_id.in_(sorted(self.department_ids)) if self.department_ids else db.false()
+
+    def filter_records(self, query):
+        """query restricted to the visible records (unchanged for users who see everything)."""
+        return query if self.can_view_all else query.filter(self.records_filter())
+
+def record_access(user=None):
+    """RecordAccess of user (current_user by default), computed once per request."""
+    user = user or current_user
+    access = g.get('record_access')
+    if access is None or access.user_id != user.id:
+        access = g.record_access = RecordAccess(user)
+    return access
+
+# Fragment cache. A fragment is keyed by its template, the visibility scope, the filters and the data versions
+# it was rendered from: 'records:<department id>' is bumped with every insert, update or delete of a record of
+# that department (bump_cache_generations, the import and rebuild_department_record_counts), and renamed
+# departments or users change their own generations. Entries of an old version are simply never asked for
+# again and fall out of the LRU.
+def bump_record_versions(connection, department_ids):
+    for department_id in sorted(set(department_ids) - {None}):
+        bump_cache_generation(connection, f'records:{department_id}')
+
+def fragment_data_version(department_ids=None):
+    """The generations a fragment showing department_ids' records (None: all departments) depends on, in one query."""
+    names = [DepartmentCache.GENERATION, UserCache.GENERATION]
+    if department_ids is None:
+        condition = or_(CacheGeneration.name.in_(names), CacheGeneration.name.like('records:%'))
+    else:
+        condition = CacheGeneration.name.in_(names + [f'records:{department_id}' for department_id in department_ids])
+    return tuple(sorted(db.session.query(CacheGeneration.name, CacheGeneration.value).filter(condition)))
+
+class FragmentCache:
+    """Rendered HTML by key (key[0] is the fragment name), LRU within FRAGMENT_CACHE_MAX_BYTES."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+        CACHE_REQUESTS.inc(1, f'fragment:{key[0]}', 'miss' if html is None else 'hit')
+        return html
+
+    def put(self, key, html):
+        max_size = app.config['FRAGMENT_CACHE_MAX_BYTES']
+        if len(html) > max_size // 4: # A single huge page would push everything else out
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            self._size -= len(previous) if previous is not None else 0
+            self._entries[key] = html
+            self._size += len(html)
+            while self._size > max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+fragment_cache = FragmentCache()
+
+def cached_fragment(key, render):
+    """HTML of render() (a template render), taken from the fragment cache when key is there. key None: no caching."""
+    if key is None or not app.config['FRAGMENT_CACHE_ENABLED']:
+        return Markup(render())
+    html = fragment_cache.get(key)
+    if html is None:
+        html = render()
+        fragment_cache.put(key, html)
+    return Markup(html)
+
+# The start time lives in the WSGI environ rather than in g: g is shared with the request contexts
+# pushed while rendering PDFs, whose teardown would otherwise close this request's measurement.
+@app.before_request
+def start_request_metrics():
+    if app.config['METRICS_ENABLED']:
+        request.environ['municipal.metrics_start'] = time.perf_counter()
+        HTTP_REQUESTS_IN_FLIGHT.inc()
+
+@app.after_request
+def record_response_status(response):
+    if 'municipal.metrics_start' in request.environ:
+        request.environ['municipal.metrics_status'] = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exception=None):
+    # teardown runs even when the view raised, so in-flight never leaks
+    start = request.environ.pop('municipal.metrics_start', None)
+    if start is None:
+        return
+    HTTP_REQUESTS_IN_FLIGHT.inc(-1)
+    endpoint = request.endpoint or 'unknown'
+    status = request.environ.pop('municipal.metrics_status', 500 if exception else 200)
+    HTTP_REQUEST_DURATION.observe(time.perf_counter() - start, endpoint, request.method)
+    HTTP_REQUESTS_TOTAL.inc(1, endpoint, request.method, str(status))
+
+def collect_scrape_time_metrics():
+    """Gauges read from the pool and the database when /metrics is requested."""
+    pool = db.engine.pool
+    for state, reader in (('size', 'size'), ('checked_out', 'checkedout'), ('overflow', 'overflow'),
+                          ('checked_in', 'checkedin')):
+        if hasattr(pool, reader):
+            DB_POOL_CONNECTIONS.set(getattr(pool, reader)(), state)
+    job_counts, failed_attempts = {}, 0
+    for status, count, attempts in db.session.query(PdfJob.status, func.count(PdfJob.id), func.sum(PdfJob.attempts))\
+                                             .group_by(PdfJob.status):
+        job_counts[status] = count
+        # Every attempt failed except the current one of 'rendering' jobs and the last one of 'done' jobs
+        failed_attempts += (attempts or 0) - (count if status in ('done', 'rendering') else 0)
+    for status in ('queued', 'rendering', 'done', 'failed'):
+        PDF_JOBS.set(job_counts.get(status, 0), status)
+    PDF_JOB_RENDER_FAILURES.set(failed_attempts)
+    render_seconds = (func.julianday(PdfJob.finished_at) - func.julianday(PdfJob.started_at)) * 86400
+    done_jobs = db.session.query(func.count(PdfJob.id), func.sum(render_seconds),
+                                 *[func.sum(case((render_seconds <= upper_bound, 1), else_=0))
+                                   for upper_bound in PDF_JOB_RENDER_DURATION.buckets])\
+                          .filter(PdfJob.status == 'done', PdfJob.started_at.isnot(None), PdfJob.finished_at.isnot(None))\
+                          .one()
+    PDF_JOB_RENDER_DURATION.set_series([bucket_count or 0 for bucket_count in done_jobs[2:]], done_jobs[1] or 0.0,
+                                       done_jobs[0])
+
+def render_metrics():
+    lines = []
+    with _metrics_lock:
+        for metric in _metrics_registry:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for sample_name, labels, value in metric.samples():
+                lines.append(f'{sample_name}{labels} {value}')
+    return '\n'.join(lines) + '\n'
+
+# Sequence numbers.
+# Numbers ending in 8 or 9 are never handed out automatically (they are left for manual entry).
+# The last automatic number lives in SequenceCounter and is advanced inside the transaction that inserts
+# the record, after BEGIN IMMEDIATE on SQLite, so two concurrent add_record requests cannot get the same one.
+RECORD_SEQUENCE_COUNTER = 'record'
+
+def next_sequence_candidate(value):
+    """First number after value that does not end in 8 or 9."""
+    next_sequence = value + 1
     while next_sequence % 10 == 8 or next_sequence % 10 == 9:
         next_sequence += 1
     return next_sequence
 
+def begin_immediate_transaction():
+    """
+    On SQLite, takes the database write lock right away (BEGIN IMMEDIATE) so a read-then-write that follows
+    cannot interleave with another writer. Nothing to do if this transaction has already written.
+    """
+    connection = db.session.connection()
+    if connection.dialect.name != 'sqlite':
+        return
+    if not connection.connection.driver_connection.in_transaction:
+        start = time.perf_counter()
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+        SQLITE_LOCK_WAIT.observe(time.perf_counter() - start)
+
+def get_sequence_counter_value():
+    """Last automatic sequence number; on databases without a counter yet, the highest one in use."""
+    counter = db.session.get(SequenceCounter, RECORD_SEQUENCE_COUNTER)
+    if counter is not None:
+        return counter.last_value
+    return db.session.query(func.max(Record.sequence_number)).scalar() or 0
+
+def is_sequence_number_taken(sequence_number):
+    return (db.session.get(SequenceReservation, sequence_number) is not None
+            or db.session.query(Record.id).filter(Record.sequence_number == sequence_number).first() is not None)
+
+def allocate_sequence_number():
+    """
+    Hands out the next sequence number (skipping 8/9, reserved numbers and numbers entered manually).
+    Must run in the transaction that inserts the record: the counter update is committed or rolled back with it.
+    """
+    begin_immediate_transaction()
+    counter = db.session.get(SequenceCounter, RECORD_SEQUENCE_COUNTER)
+    if counter is None:
+        counter = SequenceCounter(name=RECORD_SEQUENCE_COUNTER, last_value=get_sequence_counter_value())
+        db.session.add(counter)
+    next_sequence = next_sequence_candidate(counter.last_value)
+    while is_sequence_number_taken(next_sequence):
+        next_sequence = next_sequence_candidate(next_sequence)
+    counter.last_value = next_sequence
+    db.session.flush()
+    return next_sequence
+
+def allocate_sequence_numbers(count):
+    """
+    allocate_sequence_number for count records at once (bulk imports): the numbers in use above the counter
+    are read in two queries instead of checking each candidate. Same transaction rule.
+    """
+    begin_immediate_transaction()
+    counter = db.session.get(SequenceCounter, RECORD_SEQUENCE_COUNTER)
+    if counter is None:
+        counter = SequenceCounter(name=RECORD_SEQUENCE_COUNTER, last_value=get_sequence_counter_value())
+        db.session.add(counter)
+    taken = {number for (number,) in db.session.query(Record.sequence_number)
+                                               .filter(Record.sequence_number > counter.last_value)}
+    taken.update(number for (number,) in db.session.query(SequenceReservation.sequence_number)
+                                                   .filter(SequenceReservation.sequence_number > counter.last_value))
+    numbers = []
+    next_sequence = counter.last_value
+    while len(numbers) < count:
+        next_sequence = next_sequence_candidate(next_sequence)
+        if next_sequence not in taken:
+            numbers.append(next_sequence)
+    counter.last_value = next_sequence
+    db.session.flush()
+    return numbers
+
+def get_sequence_number_suggestion():
+    """(raw next number, next number that will be handed out) for the add_record form. Nothing is reserved."""
+    last_value = get_sequence_counter_value()
+    next_sequence = next_sequence_candidate(last_value)
+    while is_sequence_number_taken(next_sequence):
+        next_sequence = next_sequence_candidate(next_sequence)
+    return last_value + 1, next_sequence
+
+# Helpers for keyset (cursor) pagination of the records listing.
+# A cursor is "<sort value>_<id>": the sort value is created_at as %Y%m%d%H%M%S%f for the normal
+# listing, or the bm25 rank for full-text search results. It is URL-safe and keeps the order stable
+# even when several records share the same sort value.
+RECORDS_CURSOR_DATETIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+def encode_records_cursor(sort_value, record_id):
+    if isinstance(sort_value, datetime):
+        return f"{sort_value.strftime(RECORDS_CURSOR_DATETIME_FORMAT)}_{record_id}"
+    return f"{float(sort_value)!r}_{record_id}"
+
+def decode_records_cursor(cursor_str, ranked=False):
+    """Returns (sort value, id) for a cursor string, or None if it is malformed."""
+    if not cursor_str:
+        return None
+    try:
+        value_part, id_part = cursor_str.rsplit('_', 1)
+        if ranked:
+            return float(value_part), int(id_part)
+        return datetime.strptime(value_part, RECORDS_CURSOR_DATETIME_FORMAT), int(id_part)
+    except ValueError:
+        return None
+
+def keyset_condition(sort_column, sort_value, record_id, descending):
+    # The leading <= / >= is implied by the OR, but lets SQLite start the index scan at the cursor
+    if descending:
+        return and_(sort_column <= sort_value,
+                    or_(sort_column < sort_value, and_(sort_column == sort_value, Record.id < record_id)))
+    return and_(sort_column >= sort_value,
+                or_(sort_column > sort_value, and_(sort_column == sort_value, Record.id > record_id)))
+
+def paginate_records_keyset(query, after_cursor=None, before_cursor=None, per_page=50, rank_column=None):
+    """
+    Returns one page of the query plus the cursors for the next and previous pages
+    (None when there is no such page). Rows are ordered by (created_at, id) descending, or,
+    when rank_column is given (full-text search), by (rank, id) ascending; in that case the
+    query must select (Record, rank, ...) and the returned rows are those tuples.
+    Only per_page + 1 rows are fetched, so the cost does not grow with the table size.
+    """
+    if rank_column is None:
+        sort_column, descending = Record.created_at, True
+        sort_value_of, record_of = (lambda row: row.created_at), (lambda row: row)
+    else:
+        sort_column, descending = rank_column, False
+        sort_value_of, record_of = (lambda row: row[1]), (lambda row: row[0])
+    ranked = rank_column is not None
+
+    after = decode_records_cursor(after_cursor, ranked)
+    before = decode_records_cursor(before_cursor, ranked) if not after else None
+
+    if before: # Going back: walk the sort order backwards and flip the result
+        page_query = query.filter(keyset_condition(sort_column, before[0], before[1], not descending))
+        flipped_order = (sort_column.asc(), Record.id.asc()) if descending else (sort_column.desc(), Record.id.desc())
+        page_query = page_query.order_by(*flipped_order)
+    else:
+        page_query = query
+        if after:
+            page_query = page_query.filter(keyset_condition(sort_column, after[0], after[1], descending))
+        page_order = (sort_column.desc(), Record.id.desc()) if descending else (sort_column.asc(), Record.id.asc())
+        page_query = page_query.order_by(*page_order)
+
+    rows = page_query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    def cursor_for(row):
+        return encode_records_cursor(sort_value_of(row), record_of(row).id)
+
+    if before:
+        rows.reverse()
+        next_cursor = cursor_for(rows[-1]) if rows else None
+        prev_cursor = cursor_for(rows[0]) if rows and has_more else None
+    else:
+        next_cursor = cursor_for(rows[-1]) if rows and has_more else None
+        prev_cursor = cursor_for(rows[0]) if rows and after else None
+    return rows, next_cursor, prev_cursor
+
+def count_records_capped(query, cap):
+    """
+    Counts the rows of the query but stops at cap + 1, so the count stays cheap on huge tables.
+    Returns (count, is_capped).
+    """
+    limited_ids = query.with_entities(Record.id).order_by(None).limit(cap + 1).subquery()
+    total = db.session.query(func.count()).select_from(limited_ids).scalar() or 0
+    return min(total, cap), total > cap
+
+# Full-text search over records (SQLite FTS5).
+# record_fts holds one row per record (rowid = record.id) and is kept in sync by triggers, including the
+# department name so searching "hacienda" still works. remove_diacritics makes "camion" match "camión".
+RECORD_FTS_SETUP_STATEMENTS = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS record_fts USING fts5(
+        digital_number, full_name, description, department_name,
+        tokenize = 'unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER IF NOT EXISTS record_fts_after_insert AFTER INSERT ON record BEGIN
+        INSERT INTO record_fts(rowid, digital_number, full_name, description, department_name)
+        VALUES (new.id, new.digital_number, new.full_name, new.description,
+                (SELECT name FROM department WHERE id = new.department_id));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS record_fts_after_update
+    AFTER UPDATE OF digital_number, full_name, description, department_id ON record BEGIN
+        DELETE FROM record_fts WHERE rowid = old.id;
+        INSERT INTO record_fts(rowid, digital_number, full_name, description, department_name)
+        VALUES (new.id, new.digital_number, new.full_name, new.description,
+                (SELECT name FROM department WHERE id = new.department_id));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS record_fts_after_delete AFTER DELETE ON record BEGIN
+        DELETE FROM record_fts WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS record_fts_department_renamed AFTER UPDATE OF name ON department BEGIN
+        UPDATE record_fts SET department_name = new.name
+        WHERE rowid IN (SELECT id FROM record WHERE department_id = new.id);
+    END"""
+]
+RECORD_FTS_REBUILD_STATEMENTS = [
+    "DELETE FROM record_fts",
+    """INSERT INTO record_fts(rowid, digital_number, full_name, description, department_name)
+       SELECT record.id, record.digital_number, record.full_name, record.description, department.name
+       FROM record LEFT JOIN department ON department.id = record.department_id"""
+]
+# bm25 column weights: digital_number, full_name, description, department_name
+RECORD_FTS_RANK_SQL = "bm25(record_fts, 10.0, 5.0, 1.0, 2.0)"
+# Snippet highlight markers; replaced by <mark> after HTML-escaping the snippet
+FTS_MARK_OPEN, FTS_MARK_CLOSE = '\x02', '\x03'
+
+_record_fts_state = {'available': None}
+
+def setup_record_fts():
+    """
+    Creates the FTS5 table and its triggers if needed, and (re)fills it when it is out of step
+    with the record table. Returns False when this SQLite build has no FTS5, in which case
+    records() keeps using the ilike search.
+    """
+    try:
+        for statement in RECORD_FTS_SETUP_STATEMENTS:
+            db.session.execute(text(statement))
+        fts_rows = db.session.execute(text("SELECT count(*) FROM record_fts")).scalar()
+        if fts_rows != Record.query.count():
+            for statement in RECORD_FTS_REBUILD_STATEMENTS:
+                db.session.execute(text(statement))
+            app.logger.info("Rebuilt the record_fts full-text index.")
+        db.session.commit()
+        _record_fts_state['available'] = True
+    except Exception as e:
+        db.session.rollback()
+        app.logger.warning(f"FTS5 full-text search not available, falling back to ilike search: {e}")
+        _record_fts_state['available'] = False
+    return _record_fts_state['available']
+
+def is_record_fts_available():
+    if _record_fts_state['available'] is None:
+        fts_table = db.session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'record_fts'")).first()
+        _record_fts_state['available'] = fts_table is not None
+    return _record_fts_state['available']
+
+def build_fts_match_query(search_term):
+    """Turns user input into an FTS5 query: every word must match, as a prefix. None if no words."""
+    words = re.findall(r'\w+', search_term)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+def record_fts_subquery(fts_match_query):
+    """Matching record ids with their bm25 rank (lower is better) and a highlighted snippet."""
+    return text(f"""SELECT rowid AS record_id, {RECORD_FTS_RANK_SQL} AS rank,
+                           snippet(record_fts, -1, :mark_open, :mark_close, '…', 12) AS snippet
+                    FROM record_fts WHERE record_fts MATCH :fts_query""")\
+        .bindparams(fts_query=fts_match_query, mark_open=FTS_MARK_OPEN, mark_close=FTS_MARK_CLOSE)\
+        .columns(record_id=db.Integer, rank=db.Float, snippet=db.Text)\
+        .subquery('record_fts_matches')
+
+def highlight_fts_snippet(snippet):
+    if not snippet:
+        return None
+    escaped = str(escape(snippet))
+    return Markup(escaped.replace(FTS_MARK_OPEN, '<mark>').replace(FTS_MARK_CLOSE, '</mark>'))
+
+# Columns added to existing tables after their first release. db.create_all() does not alter existing
+# tables, so they are added here on databases created before them: (table, column, SQL type).
+SCHEMA_COLUMN_UPGRADES = [
+    ('record', 'generated_pdf_digest', 'VARCHAR(64)'),
+    ('pdf_job', 'render_skipped', 'BOOLEAN'),
+    ('record', 'attachment_sha256', 'VARCHAR(64)'),
+    ('record', 'attachment_size', 'INTEGER'),
+]
+
+def upgrade_schema_columns():
+    for table_name, column_name, column_type in SCHEMA_COLUMN_UPGRADES:
+        existing_columns = {row[1] for row in db.session.execute(text(f"PRAGMA table_info({table_name})"))}
+        if existing_columns and column_name not in existing_columns:
+            db.session.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}"))
+            app.logger.info(f"Added column {table_name}.{column_name}")
+    db.session.commit()
+
+def create_missing_indexes():
+    """
+    Creates the indexes declared on the models that an existing database does not have yet
+    (db.create_all() only creates indexes together with new tables). Returns their names.
+    """
+    existing_indexes = {row[0] for row in db.session.execute(
+        text("SELECT name FROM sqlite_master WHERE type = 'index'"))}
+    created = []
+    connection = db.session.connection()
+    for table in db.metadata.sorted_tables:
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in existing_indexes:
+                index.create(connection)
+                created.append(index.name)
+                app.logger.info(f"Created index {index.name}")
+    db.session.commit()
+    return created
+
+@event.listens_for(Engine, 'connect')
+def apply_sqlite_profile(dbapi_connection, connection_record):
+    """Sets the PRAGMAs of app.config['SQLITE_PROFILE'] on each new SQLite connection."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    pragmas = SQLITE_PROFILES[app.config['SQLITE_PROFILE']]
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma_name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {pragma_name} = {value}")
+    finally:
+        cursor.close()
+
 # Create database and admin user
 #@app.before_first_request
 def create_tables_and_admin():
     db.create_all()
+    upgrade_schema_columns()
+    create_missing_indexes()
 
     # Ensure 'Administration' department exists for the admin user
     admin_dept_name = 'Administración' # Changed from Administration
@@ -181,6 +1709,12 @@ def create_tables_and_admin():
             
         db.session.commit()
 
+    # Databases created before the counter table existed: fill it once from the records
+    if not DepartmentRecordCount.query.first() and Record.query.first():
+        rebuild_department_record_counts()
+
+    setup_record_fts()
+
 # Helper function to ensure necessary folders exist
 def ensure_folders_exist():
     upload_path = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'])
@@ -191,46 +1725,829 @@ def ensure_folders_exist():
     if not os.path.exists(pdf_gen_path):
         os.makedirs(pdf_gen_path)
         app.logger.info(f"Created PDF generation folder: {pdf_gen_path}")
+    upload_temp_path = os.path.join(app.root_path, app.config['UPLOAD_TEMP_FOLDER'])
+    if not os.path.exists(upload_temp_path):
+        os.makedirs(upload_temp_path)
+        app.logger.info(f"Created upload temp folder: {upload_temp_path}")
+    blob_path = os.path.join(app.root_path, app.config['ATTACHMENT_BLOB_FOLDER'])
+    if not os.path.exists(blob_path):
+        os.makedirs(blob_path)
+        app.logger.info(f"Created attachment blob folder: {blob_path}")
+
+# Attachment uploads.
+# Files are copied in UPLOAD_COPY_BUFFER_BYTES pieces to a temp file, hashed (SHA-256) on the way, and renamed
+# into the blob store with os.replace, so a half-written attachment is never visible under its final name.
+# Identical contents are stored once: the second upload only adds a reference.
+# Browsers send files larger than UPLOAD_CHUNK_REQUEST_BYTES as a resumable chunked upload (UploadSession,
+# static/js/chunked_upload.js); the form then carries attachment_upload_token instead of the file.
+class UploadError(Exception):
+    """Upload rejected; the message is meant for the user."""
+
+def upload_temp_path(name=''):
+    folder = os.path.join(app.root_path, app.config['UPLOAD_TEMP_FOLDER'])
+    os.makedirs(folder, exist_ok=True) # Also when the app is not started through ensure_folders_exist()
+    return os.path.join(folder, name)
+
+def upload_session_part_path(upload_session):
+    return upload_temp_path(f'{upload_session.id}.part')
+
+def copy_stream_to_file(stream, target_file, hasher=None, max_bytes=None):
+    """Copies stream into target_file piece by piece. Returns the bytes copied; UploadError beyond max_bytes."""
+    buffer_size = app.config['UPLOAD_COPY_BUFFER_BYTES']
+    copied = 0
+    while True:
+        piece = stream.read(buffer_size)
+        if not piece:
+            return copied
+        copied += len(piece)
+        if max_bytes is not None and copied > max_bytes:
+            raise UploadError(f"El archivo supera el tamaño máximo permitido ({max_bytes // (1024 * 1024)} MB).")
+        if hasher is not None:
+            hasher.update(piece)
+        target_file.write(piece)
+
+def hash_file(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as source:
+        while piece := source.read(app.config['UPLOAD_COPY_BUFFER_BYTES']):
+            hasher.update(piece)
+    return hasher.hexdigest()
+
+@app.template_global()
+def attachment_version(record):
+    """Short content hash for ?v= on attachment links; a new attachment gives a new URL."""
+    return record.attachment_sha256[:16] if record.attachment_sha256 else None
+
+def attachment_blob_path(sha256):
+    return os.path.join(app.root_path, app.config['ATTACHMENT_BLOB_FOLDER'], sha256[:2], sha256[2:4], sha256)
+
+def put_attachment_blob(source_path, sha256, size):
+    """
+    Moves source_path into the blob store under its hash (dropping it if that content is already stored) and
+    makes sure its AttachmentBlob row exists. The reference is counted when a record is flushed pointing at it.
+    The file is in place before the row commits; if the transaction rolls back it is left without a row, and
+    gc-attachments deletes such files once they are older than ATTACHMENT_GC_GRACE_HOURS.
+    """
+    blob_path = attachment_blob_path(sha256)
+    if os.path.exists(blob_path):
+        os.remove(source_path)
+    else:
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.replace(source_path, blob_path)
+    os.utime(blob_path) # Fresh mtime keeps gc-attachments away until the row commits (and from content attached again)
+    now = datetime.now(UTC)
+    db.session.execute(sqlite_insert(AttachmentBlob.__table__)
+                       .values(sha256=sha256, size=size, ref_count=0, created_at=now, unreferenced_at=now)
+                       .on_conflict_do_nothing(index_elements=['sha256']))
+
+def pending_attachment_filename():
+    """Original (secure) filename of the attachment sent with the current form, or None if there is none."""
+    upload_token = request.form.get('attachment_upload_token')
+    if upload_token:
+        upload_session = db.session.get(UploadSession, upload_token)
+        return upload_session.filename if upload_session else None
+    attachment_file = request.files.get('attachment')
+    if attachment_file and attachment_file.filename != '':
+        return secure_filename(attachment_file.filename)
+    return None
+
+def store_attachment():
+    """
+    Stores the attachment of the current form (a file field or a finished chunked upload) in the blob store.
+    Returns (size, sha256), to be set on the record. Raises UploadError.
+    """
+    upload_token = request.form.get('attachment_upload_token')
+    if upload_token:
+        upload_session = db.session.get(UploadSession, upload_token)
+        if not upload_session or upload_session.user_id != current_user.id or upload_session.status != 'complete':
+            raise UploadError("La carga del archivo no está completa o no es válida. Vuelva a seleccionar el archivo.")
+        size, sha256 = upload_session.total_size, upload_session.sha256
+        put_attachment_blob(upload_session_part_path(upload_session), sha256, size)
+        upload_session.status = 'consumed'
+    else:
+        size, sha256 = store_attachment_stream(request.files['attachment'].stream, 'form-')
+    observe_upload(size)
+    return size, sha256
+
+def store_attachment_stream(stream, temp_prefix):
+    """Copies stream to a temp file (hashing it) and puts it in the blob store. Returns (size, sha256)."""
+    hasher = hashlib.sha256()
+    temp_file = tempfile.NamedTemporaryFile(dir=upload_temp_path(), prefix=temp_prefix, suffix='.part', delete=False)
+    try:
+        with temp_file:
+            size = copy_stream_to_file(stream, temp_file, hasher, max_bytes=app.config['UPLOAD_MAX_FILE_BYTES'])
+        sha256 = hasher.hexdigest()
+        put_attachment_blob(temp_file.name, sha256, size)
+    except BaseException:
+        if os.path.exists(temp_file.name):
+            os.remove(temp_file.name)
+        raise
+    return size, sha256
+
+def upload_json_error(message, status, **extra):
+    return Response(json.dumps(dict(extra, error=message)), status=status, mimetype='application/json')
+
+def upload_session_json(upload_session, status=200):
+    return Response(json.dumps({
+        'token': upload_session.id, 'offset': upload_session.received_bytes, 'size': upload_session.total_size,
+        'status': upload_session.status, 'sha256': upload_session.sha256,
+        'chunk_size': app.config['UPLOAD_CHUNK_REQUEST_BYTES'],
+    }), status=status, mimetype='application/json')
+
+def serve_stored_file(folder_key, relative_path, download_name=None, as_attachment=False, etag=None, immutable=False):
+    """
+    Response for a file under app.config[folder_key], with a strong ETag (etag, or one derived from mtime and
+    size), 304 on If-None-Match, byte ranges (206) and private caching: revalidated on every use, or kept for
+    FILE_IMMUTABLE_MAX_AGE when immutable (the URL changes with the content). 404 if the file does not exist.
+    """
+    folder = os.path.join(app.root_path, app.config[folder_key])
+    file_path = safe_join(folder, relative_path)
+    if file_path is None or not os.path.isfile(file_path):
+        abort(404)
+    download_name = download_name or os.path.basename(file_path)
+
+    offload_header = app.config['FILE_OFFLOAD_HEADER']
+    if offload_header:
+        response = Response(mimetype=mimetypes.guess_type(download_name)[0] or 'application/octet-stream')
+        response.headers.set('Content-Disposition', 'attachment' if as_attachment else 'inline', filename=download_name)
+        file_stat = os.stat(file_path)
+        response.set_etag(etag or f"{file_stat.st_mtime_ns:x}-{file_stat.st_size:x}")
+        response.last_modified = file_stat.st_mtime
+    else:
+        response = send_file(file_path, download_name=download_name, as_attachment=as_attachment,
+                             etag=etag if etag else True, conditional=True, max_age=None)
+
+    response.cache_control.private = True
+    if immutable:
+        response.cache_control.no_cache = None # Set by send_file when it gets no max_age
+        response.cache_control.max_age = app.config['FILE_IMMUTABLE_MAX_AGE']
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+
+    if offload_header:
+        response = response.make_conditional(request) # 304 here; the front server does ranges on the 200
+        if response.status_code == 200:
+            if offload_header == 'X-Accel-Redirect':
+                location = app.config['FILE_OFFLOAD_LOCATIONS'][folder_key]
+                response.headers['X-Accel-Redirect'] = location + os.path.relpath(file_path, folder).replace(os.sep, '/')
+            else:
+                response.headers[offload_header] = file_path
+    return response
+
+# Helpers to generate the PDF of a record.
+# The PDF is only re-rendered when the printed content changes: the HTML of expediente_imprimir.html
+# (rendered with a placeholder instead of the print date) and the print stylesheet version are hashed,
+# and WeasyPrint is skipped when the hash matches the one stored with the current PDF.
+PDF_PRINT_DATE_PLACEHOLDER = '@@FECHA_IMPRESION@@'
+PDF_RENDER_STATS = {'rendered': 0, 'skipped': 0, 'failed': 0} # Per process; PdfJob.render_skipped keeps the history
+
+class PdfRenderer:
+    """
+    Long-lived WeasyPrint renderer: the print stylesheet is parsed once and re-parsed only when the
+    CSS file's mtime changes, and one FontConfiguration is shared by every render of the process.
+    """
+    def __init__(self, css_file_path):
+        self.css_file_path = css_file_path
+        self.font_config = FontConfiguration()
+        self.stylesheet = None
+        self.stylesheet_mtime = None
+        self.stylesheet_version = '' # SHA-256 of the CSS file, part of the PDF content digest
+        self.stylesheet_loads = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Reloads the stylesheet if the file changed (or disappeared) since it was parsed."""
+        try:
+            css_mtime = os.path.getmtime(self.css_file_path)
+        except OSError:
+            css_mtime = None
+        if css_mtime == self.stylesheet_mtime and (self.stylesheet is not None or css_mtime is None):
+            return
+        with self._lock:
+            if css_mtime is None:
+                app.logger.warning(f"CSS file for PDF generation not found: {self.css_file_path}")
+                self.stylesheet, self.stylesheet_version = None, ''
+            else:
+                with open(self.css_file_path, 'rb') as css_file:
+                    css_bytes = css_file.read()
+                self.stylesheet = CSS(string=css_bytes.decode('utf-8'), base_url=self.css_file_path,
+                                      font_config=self.font_config)
+                self.stylesheet_version = hashlib.sha256(css_bytes).hexdigest()
+                self.stylesheet_loads += 1
+            self.stylesheet_mtime = css_mtime
+
+    def fetch_url(self, url, *args, **kwargs):
+        # /static/ files are read from disk instead of over HTTP. The print stylesheet linked by the
+        # template is already applied from the cache, so it is served empty rather than parsed again.
+        url_path = urlsplit(url).path
+        if url_path.startswith('/static/'):
+            static_folder = os.path.abspath(os.path.join(app.root_path, 'static'))
+            static_file_path = os.path.abspath(os.path.join(app.root_path, *url_path.split('/')[1:]))
+            if not static_file_path.startswith(static_folder + os.sep):
+                return default_url_fetcher(url, *args, **kwargs)
+            if os.path.abspath(static_file_path) == os.path.abspath(self.css_file_path):
+                return {'string': b'', 'mime_type': 'text/css'}
+            if os.path.isfile(static_file_path):
+                with open(static_file_path, 'rb') as static_file:
+                    return {'string': static_file.read(), 'filename': static_file_path}
+        return default_url_fetcher(url, *args, **kwargs)
+
+    def write_pdf(self, html_string, target, base_url):
+        """Writes the PDF to target (path or file object); with target None the PDF bytes are returned."""
+        self.refresh()
+        stylesheets = [self.stylesheet] if self.stylesheet is not None else []
+        return HTML(string=html_string, base_url=base_url, url_fetcher=self.fetch_url)\
+            .write_pdf(target, stylesheets=stylesheets, font_config=self.font_config)
+
+    def render_document(self, html_string, base_url):
+        """Lays out the HTML without writing it, so the pages of several documents can be joined."""
+        self.refresh()
+        stylesheets = [self.stylesheet] if self.stylesheet is not None else []
+        return HTML(string=html_string, base_url=base_url, url_fetcher=self.fetch_url)\
+            .render(stylesheets=stylesheets, font_config=self.font_config)
+
+_pdf_renderers = {} # process id -> PdfRenderer; pool processes build their own after the fork
+
+def get_pdf_renderer():
+    renderer = _pdf_renderers.get(os.getpid())
+    if renderer is None:
+        renderer = PdfRenderer(os.path.join(app.root_path, 'static', 'css', 'estilo_impresion.css'))
+        _pdf_renderers.clear()
+        _pdf_renderers[os.getpid()] = renderer
+    return renderer
+
+def record_pdf_filename(record_obj):
+    return f"expediente_{record_obj.id}_{record_obj.digital_number.replace('-', '_')}.pdf"
+
+def render_record_print_html(record_obj, fecha_actual, base_url=None):
+    """Renders expediente_imprimir.html for PDF generation, in its own request context."""
+    base_url = base_url or (request.url_root if request else 'http://localhost')
+    with app.test_request_context(base_url=base_url): # Provides a basic request context
+        return render_template(
+            'expediente_imprimir.html',
+            record=record_obj,
+            DATETIME_APP_FORMAT=APP_WIDE_DATETIME_FORMAT,
+            fecha_actual=fecha_actual
+        )
 
-# Helper function to generate PDF for a record
-def generate_record_pdf(record_obj):
-    if not record_obj:
-        app.logger.error("generate_record_pdf: No record object provided.")
-        return None
-
+def store_generated_pdf_info(record_obj, pdf_filename, pdf_digest):
+    # Plain UPDATE that keeps updated_at as is: the PDF bookkeeping is not a change of the expediente
+    # (and bumping updated_at would change the printed content, so the next render could never be skipped).
+    Record.query.filter(Record.id == record_obj.id).update({'generated_pdf_filename': pdf_filename,
+                                                           'generated_pdf_digest': pdf_digest,
+                                                           'updated_at': Record.updated_at},
+                                                          synchronize_session=False)
+    set_committed_value(record_obj, 'generated_pdf_filename', pdf_filename)
+    set_committed_value(record_obj, 'generated_pdf_digest', pdf_digest)
+
+def render_record_pdf(record_obj, force=False):
+    """
+    Renders the PDF of the record unless its printed content is unchanged (or force is set).
+    Returns (pdf_filename, skipped). Errors are raised.
+    """
     pdf_folder = os.path.join(app.root_path, app.config['GENERATED_PDF_FOLDER'])
     # Ensure folder exists (should be handled at startup, but good to double check)
     if not os.path.exists(pdf_folder):
         os.makedirs(pdf_folder)
 
-    pdf_filename = f"expediente_{record_obj.id}_{record_obj.digital_number.replace('-', '_')}.pdf"
+    # Load the relationships the print template reads in a single query. They are expired first
+    # because the caller may have just changed department_id (edit/resend).
+    db.session.expire(record_obj, ['department', 'creator'])
+    Record.query.options(*record_load_options('pdf')).filter(Record.id == record_obj.id).first()
+
+    pdf_filename = record_pdf_filename(record_obj)
     pdf_path = os.path.join(pdf_folder, pdf_filename)
 
-    try:
-        with app.test_request_context(base_url=request.url_root if request else 'http://localhost'): # Provides a basic request context
-            html_string = render_template(
-                'expediente_imprimir.html',
-                record=record_obj,
-                DATETIME_APP_FORMAT=APP_WIDE_DATETIME_FORMAT,
-                fecha_actual=datetime.now(UTC).strftime(APP_WIDE_DATETIME_FORMAT)
-            )
+    html_string = render_record_print_html(record_obj, PDF_PRINT_DATE_PLACEHOLDER)
 
-        css_file_path = os.path.join(app.root_path, 'static', 'css', 'estilo_impresion.css')
-        stylesheets = []
-        if os.path.exists(css_file_path):
-            stylesheets.append(CSS(filename=css_file_path))
-        else:
-            app.logger.warning(f"CSS file for PDF generation not found: {css_file_path}")
+    renderer = get_pdf_renderer()
+    renderer.refresh()
+    pdf_digest = hashlib.sha256(f"{html_string}\n{renderer.stylesheet_version}".encode('utf-8')).hexdigest()
+    if (not force and record_obj.generated_pdf_digest == pdf_digest
+            and record_obj.generated_pdf_filename == pdf_filename and os.path.exists(pdf_path)):
+        PDF_RENDER_STATS['skipped'] += 1
+        app.logger.info(f"PDF for record {record_obj.id} is up to date, render skipped: {pdf_filename}")
+        return pdf_filename, True
+
+    html_string = html_string.replace(PDF_PRINT_DATE_PLACEHOLDER, datetime.now(UTC).strftime(APP_WIDE_DATETIME_FORMAT))
+    renderer.write_pdf(html_string, pdf_path,
+                       base_url=request.url_root if request else app.config.get("APPLICATION_ROOT") or 'http://localhost/')
 
-        html_to_render = HTML(string=html_string, base_url=request.url_root if request else app.config.get("APPLICATION_ROOT") or 'http://localhost/')
-        html_to_render.write_pdf(pdf_path, stylesheets=stylesheets)
+    store_generated_pdf_info(record_obj, pdf_filename, pdf_digest)
+    PDF_RENDER_STATS['rendered'] += 1
+    app.logger.info(f"Generated PDF for record {record_obj.id}: {pdf_filename}")
+    return pdf_filename, False
 
-        record_obj.generated_pdf_filename = pdf_filename # Update the attribute on the object
-        app.logger.info(f"Generated PDF for record {record_obj.id}: {pdf_filename}")
+def generate_record_pdf(record_obj, force=False):
+    """Returns the PDF filename of the record (rendering it if its content changed), or None on error."""
+    if not record_obj:
+        app.logger.error("generate_record_pdf: No record object provided.")
+        return None
+    start = time.perf_counter()
+    try:
+        with request_profile_timer('pdf_ms'):
+            pdf_filename, _ = render_record_pdf(record_obj, force=force)
         return pdf_filename
     except Exception as e:
+        PDF_RENDER_STATS['failed'] += 1
+        PDF_RENDER_FAILURES.inc()
         app.logger.error(f"Error generating PDF for record {record_obj.id}: {e}", exc_info=True)
         return None
+    finally:
+        PDF_RENDER_DURATION.observe(time.perf_counter() - start)
+
+# PDF job queue
+def enqueue_record_pdf(record_obj):
+    """
+    Queues a PDF render for the record in the current transaction, so the worker only sees it once the
+    record change is committed. A record keeps at most one queued job. Returns the job, or, when the
+    queue is disabled, the result of rendering right away (the PDF filename or None).
+    """
+    if not app.config['PDF_QUEUE_ENABLED']:
+        return generate_record_pdf(record_obj)
+    queued_job = PdfJob.query.filter_by(record_id=record_obj.id, status='queued').first()
+    if queued_job:
+        queued_job.available_at = datetime.now(UTC)
+        return queued_job
+    new_job = PdfJob(record_id=record_obj.id)
+    db.session.add(new_job)
+    return new_job
+
+def enqueue_record_pdfs(records):
+    """enqueue_record_pdf for many records, looking up their queued jobs in one query."""
+    if not app.config['PDF_QUEUE_ENABLED']:
+        return [generate_record_pdf(record_obj) for record_obj in records]
+    record_ids = [record_obj.id for record_obj in records]
+    queued_jobs = {job.record_id: job for job in
+                   PdfJob.query.filter(PdfJob.record_id.in_(record_ids), PdfJob.status == 'queued')}
+    now = datetime.now(UTC)
+    jobs = []
+    for record_obj in records:
+        job = queued_jobs.get(record_obj.id)
+        if job:
+            job.available_at = now
+        else:
+            job = PdfJob(record_id=record_obj.id)
+            db.session.add(job)
+        jobs.append(job)
+    return jobs
+
+def claim_next_pdf_job():
+    """Marks the oldest available queued job as rendering and returns its id (None if there is none)."""
+    now = datetime.now(UTC)
+    candidate = PdfJob.query.filter(PdfJob.status == 'queued', PdfJob.available_at <= now)\
+                            .order_by(PdfJob.id).first()
+    if not candidate:
+        db.session.rollback()
+        return None
+    # Only one worker can move the job out of 'queued'
+    claimed = PdfJob.query.filter(PdfJob.id == candidate.id, PdfJob.status == 'queued')\
+                          .update({'status': 'rendering', 'attempts': PdfJob.attempts + 1, 'started_at': now},
+                                  synchronize_session=False)
+    db.session.commit()
+    return candidate.id if claimed else None
+
+def mark_pdf_job_failed(job, error_message):
+    """Requeues the job with a growing delay, or marks it failed once PDF_JOB_MAX_ATTEMPTS is reached."""
+    now = datetime.now(UTC)
+    job.last_error = error_message
+    if job.attempts < app.config['PDF_JOB_MAX_ATTEMPTS']:
+        job.status = 'queued'
+        job.available_at = now + timedelta(seconds=app.config['PDF_JOB_RETRY_DELAY_SECONDS'] * job.attempts)
+    else:
+        job.status = 'failed'
+        job.finished_at = now
+
+def run_pdf_job(job_id):
+    """Renders the PDF of a claimed job. Runs in a pool process (or inline when PDF_WORKER_PROCESSES is 0)."""
+    with app.app_context():
+        job = db.session.get(PdfJob, job_id)
+        if not job:
+            return None
+        record_obj = db.session.get(Record, job.record_id)
+        if not record_obj:
+            job.status = 'failed'
+            job.last_error = 'El expediente ya no existe.'
+            job.finished_at = datetime.now(UTC)
+        else:
+            start = time.perf_counter()
+            try:
+                _, job.render_skipped = render_record_pdf(record_obj)
+                job.status = 'done'
+                job.last_error = None
+                job.finished_at = datetime.now(UTC)
+            except Exception as e:
+                PDF_RENDER_STATS['failed'] += 1
+                PDF_RENDER_FAILURES.inc()
+                app.logger.error(f"Error generating PDF for record {job.record_id}: {e}", exc_info=True)
+                db.session.rollback()
+                job = db.session.get(PdfJob, job_id)
+                mark_pdf_job_failed(job, str(e))
+            finally:
+                PDF_RENDER_DURATION.observe(time.perf_counter() - start)
+        db.session.commit()
+        return job.status
+
+def requeue_stale_pdf_jobs():
+    """Puts back in the queue the jobs left in 'rendering' by a worker that died."""
+    stale_before = datetime.now(UTC) - timedelta(seconds=app.config['PDF_JOB_STALE_SECONDS'])
+    requeued = PdfJob.query.filter(PdfJob.status == 'rendering', PdfJob.started_at < stale_before)\
+                           .update({'status': 'queued', 'available_at': datetime.now(UTC)}, synchronize_session=False)
+    db.session.commit()
+    if requeued:
+        app.logger.warning(f"Requeued {requeued} stale PDF jobs.")
+    return requeued
+
+def release_pdf_job(job_id):
+    """Puts a claimed job that never started rendering back in the queue, without counting the attempt."""
+    PdfJob.query.filter(PdfJob.id == job_id, PdfJob.status == 'rendering')\
+                .update({'status': 'queued', 'attempts': PdfJob.attempts - 1, 'available_at': datetime.now(UTC)},
+                        synchronize_session=False)
+    db.session.commit()
+
+def init_pdf_worker_process():
+    # Forked pool processes must not reuse the parent's SQLite connections
+    with app.app_context():
+        db.engine.dispose(close=False)
+# Bulk PDF export: many records rendered with the expediente_imprimir.html template, either as a ZIP
+# with one PDF per record (rendered in parallel and streamed entry by entry) or as one multi-page PDF.
+class ChunkSink:
+    """Write-only file object that collects what zipfile writes, so it can be yielded piece by piece."""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def bulk_export_records_query(department_id=None, status=None, date_from=None, date_to=None):
+    """Records of the export, filtered like the records() listing; date_to is inclusive (whole day)."""
+    query = Record.query.options(*record_load_options('pdf'))
+    if department_id:
+        query = query.filter(Record.department_id == department_id)
+    if status:
+        query = query.filter(Record.status == status)
+    if date_from:
+        query = query.filter(Record.created_at >= date_from)
+    if date_to:
+        query = query.filter(Record.created_at < date_to + timedelta(days=1))
+    return query
+
+def iter_record_batches(query, batch_size):
+    """Yields the records of the query in id order, batch_size at a time (keyset on id)."""
+    last_id = 0
+    while True:
+        batch = query.filter(Record.id > last_id).order_by(Record.id).limit(batch_size).all()
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1].id
+        for record_obj in batch: # Keep the identity map from growing with the export
+            db.session.expunge(record_obj)
+
+def render_pdf_bytes(html_string, base_url):
+    # Runs in the export pool processes; each keeps its own PdfRenderer
+    return get_pdf_renderer().write_pdf(html_string, None, base_url=base_url)
+
+def iter_rendered_record_pdfs(query, batch_size, processes, base_url):
+    """Yields (pdf filename, pdf bytes) per record; each batch is rendered across the process pool."""
+    fecha_actual = datetime.now(UTC).strftime(APP_WIDE_DATETIME_FORMAT)
+    pool = ProcessPoolExecutor(max_workers=processes, initializer=init_pdf_worker_process) if processes else None
+    try:
+        for batch in iter_record_batches(query, batch_size):
+            filenames = [record_pdf_filename(record_obj) for record_obj in batch]
+            html_strings = [render_record_print_html(record_obj, fecha_actual, base_url) for record_obj in batch]
+            base_urls = [base_url] * len(html_strings)
+            rendered = pool.map(render_pdf_bytes, html_strings, base_urls) if pool else map(render_pdf_bytes, html_strings, base_urls)
+            yield from zip(filenames, rendered)
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+
+def stream_records_pdf_zip(query, batch_size, processes, base_url):
+    """Generator of the bytes of a ZIP with one PDF per record; only one batch is held in memory."""
+    sink = ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive: # PDFs are already compressed
+        for pdf_filename, pdf_bytes in iter_rendered_record_pdfs(query, batch_size, processes, base_url):
+            archive.writestr(pdf_filename, pdf_bytes)
+            yield sink.take()
+    yield sink.take() # Central directory
+
+def write_records_combined_pdf(query, batch_size, base_url, target):
+    """
+    Writes one PDF with the pages of every record to target. WeasyPrint needs every page laid out
+    before writing, so this is limited to BULK_EXPORT_PDF_MAX_RECORDS records.
+    """
+    fecha_actual = datetime.now(UTC).strftime(APP_WIDE_DATETIME_FORMAT)
+    renderer = get_pdf_renderer()
+    first_document, all_pages = None, []
+    for batch in iter_record_batches(query, batch_size):
+        for record_obj in batch:
+            document = renderer.render_document(render_record_print_html(record_obj, fecha_actual, base_url), base_url)
+            first_document = first_document or document
+            all_pages.extend(document.pages)
+    if first_document is None:
+        return 0
+    first_document.copy(all_pages).write_pdf(target)
+    return len(all_pages)
+
+def stream_file_and_delete(file_path, chunk_size=64 * 1024):
+    try:
+        with open(file_path, 'rb') as exported_file:
+            while True:
+                chunk = exported_file.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.remove(file_path)
+
+def parse_export_date(date_str):
+    """'YYYY-MM-DD' to a UTC datetime, None if empty. Raises ValueError for malformed dates."""
+    if not date_str:
+        return None
+    return datetime.strptime(date_str, '%Y-%m-%d').replace(tzinfo=UTC)
+
+# Spreadsheet export: header -> column of the listing query (Department and the creator User are joined)
+RECORDS_EXPORT_COLUMNS = [
+    ('Número', Record.digital_number),
+    ('Secuencia', Record.sequence_number),
+    ('Solicitante', Record.full_name),
+    ('DNI', Record.dni),
+    ('Dirección', Record.address),
+    ('Teléfono', Record.phone),
+    ('Email', Record.email),
+    ('Departamento', Department.name),
+    ('Estado', Record.status),
+    ('Fecha de trámite', Record.transaction_date),
+    ('Creado', Record.created_at),
+    ('Actualizado', Record.updated_at),
+    ('Creado por', User.name),
+    ('Descripción', Record.description),
+]
+RECORDS_EXPORT_HISTORY_HEADERS = ['Último movimiento', 'Fecha del movimiento', 'Usuario del movimiento', 'Detalle del movimiento']
+
+def records_export_rows(query, include_history):
+    """
+    Yields the header and then one tuple of cell values per record of the listing query (newest first).
+    Only plain columns are selected and fetched RECORDS_EXPORT_YIELD_PER rows at a time, so memory use
+    does not depend on the number of records. The latest RecordHistory entry is joined in the same statement.
+    """
+    columns = [column for _, column in RECORDS_EXPORT_COLUMNS]
+    headers = [header for header, _ in RECORDS_EXPORT_COLUMNS]
+    if include_history:
+        history_user = aliased(User)
+        latest_history_id = select(RecordHistory.id).where(RecordHistory.record_id == Record.id)\
+                                                    .order_by(RecordHistory.timestamp.desc(), RecordHistory.id.desc())\
+                                                    .limit(1).correlate(Record).scalar_subquery()
+        query = query.outerjoin(RecordHistory, RecordHistory.id == latest_history_id)\
+                     .outerjoin(history_user, RecordHistory.user_id == history_user.id)
+        columns += [RecordHistory.action_type, RecordHistory.timestamp, history_user.name, RecordHistory.details]
+        headers += RECORDS_EXPORT_HISTORY_HEADERS
+
+    yield headers
+    rows = query.with_entities(*columns).order_by(Record.created_at.desc(), Record.id.desc())\
+                .yield_per(app.config['RECORDS_EXPORT_YIELD_PER'])
+    status_index = headers.index('Estado')
+    for row in rows:
+        values = [value.strftime(APP_WIDE_DATETIME_FORMAT) if isinstance(value, datetime) else value for value in row]
+        values[status_index] = RECORD_STATUS_LABELS.get(values[status_index], values[status_index])
+        yield values
+
+CSV_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+def csv_safe_cell(value):
+    """Text a spreadsheet would run as a formula (=, +, -, @, tab, CR first) gets a leading apostrophe."""
+    if value is None:
+        return ''
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def stream_records_csv(rows, flush_bytes=64 * 1024):
+    """CSV (UTF-8 with BOM, so Excel detects the encoding) of rows, yielded in pieces of about flush_bytes."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=app.config['RECORDS_EXPORT_CSV_DELIMITER'])
+    buffer.write('\ufeff')
+    for row in rows:
+        # Names, addresses and descriptions come from users: never let Excel evaluate them
+        writer.writerow([csv_safe_cell(value) for value in row])
+        if buffer.tell() >= flush_bytes:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+XLSX_INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+XLSX_STATIC_PARTS = {
+    '[Content_Types].xml': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>',
+    '_rels/.rels': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>',
+    'xl/workbook.xml': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Expedientes" sheetId="1" r:id="rId1"/></sheets></workbook>',
+    'xl/_rels/workbook.xml.rels': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>',
+}
+
+def xlsx_cell(value):
+    if value is None:
+        return '<c/>'
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c><v>{value}</v></c>'
+    text_value = xml_escape(XLSX_INVALID_XML_CHARS.sub('', str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text_value}</t></is></c>'
+
+def stream_records_xlsx(rows, rows_per_chunk=500):
+    """
+    Minimal XLSX (one sheet, inline strings) of rows, written with zipfile into a ChunkSink and yielded as
+    it is compressed; no spreadsheet library needed and only rows_per_chunk rows are buffered.
+    """
+    sink = ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for part_name, part_xml in XLSX_STATIC_PARTS.items():
+            archive.writestr(part_name, part_xml)
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            pending_rows = []
+            for row in rows:
+                pending_rows.append('<row>' + ''.join(xlsx_cell(value) for value in row) + '</row>')
+                if len(pending_rows) >= rows_per_chunk:
+                    sheet.write(''.join(pending_rows).encode('utf-8'))
+                    pending_rows = []
+                    yield sink.take()
+            sheet.write((''.join(pending_rows) + '</sheetData></worksheet>').encode('utf-8'))
+        yield sink.take()
+    yield sink.take() # Central directory
+
+def build_records_query(department_id=None, status=None, search_term=None):
+    """
+    Records visible to the current user with the filters of the records() listing. Admins and privileged
+    viewers see every department (department_id narrows it down); other users only their own.
+    Returns (query, fts_matches, effective_department_id, own_department): fts_matches is the full-text
+    subquery (rank, snippet) when the search used it, own_department the user's DepartmentInfo when restricted.
+    """
+    query = Record.query.join(Department, Record.department_id == Department.id)\
+                        .join(User, Record.created_by == User.id)
+
+    access = record_access()
+    query = access.filter_records(query)
+    effective_department_id = None
+    own_department = None
+    if access.can_view_all:
+        if department_id:
+            query = query.filter(Record.department_id == department_id)
+            effective_department_id = department_id
+    else: # Restricted to their own department (no records if it does not exist)
+        own_department = department_cache.get(access.own_department_id)
+        effective_department_id = access.own_department_id
+
+    if status:
+        query = query.filter(Record.status == status)
+
+    fts_matches = None
+    if search_term and search_term.strip():
+        search_term_cleaned = search_term.strip()
+        fts_match_query = build_fts_match_query(search_term_cleaned)
+        if fts_match_query and is_record_fts_available():
+            # Full-text search: results ordered by relevance (bm25), with highlighted snippets
+            fts_matches = record_fts_subquery(fts_match_query)
+            query = query.join(fts_matches, fts_matches.c.record_id == Record.id)
+        else:
+            search_pattern = f"%{search_term_cleaned}%"
+            query = query.filter(or_(
+                Record.digital_number.ilike(search_pattern),
+                Record.full_name.ilike(search_pattern),
+                Record.description.ilike(search_pattern),
+                Department.name.ilike(search_pattern)
+            ))
+    return query, fts_matches, effective_department_id, own_department
+
+# Record actions shared by the HTML routes and the JSON API. They only change the session: the caller
+# commits (or rolls back on RecordActionError) and queues the PDF with enqueue_record_pdf when appropriate.
+class RecordActionError(Exception):
+    """A record action that cannot be done; the message is shown to the user (category: flash category)."""
+    def __init__(self, message, category='danger'):
+        super().__init__(message)
+        self.category = category
+
+def add_record_history(record, user, action_type, details, history_batch=None):
+    """
+    Logs an action on the record. With history_batch (a list) the row is collected instead, for a
+    single executemany INSERT with insert_record_history_batch: the ORM inserts rows one by one on SQLite.
+    """
+    values = dict(record_id=record.id, user_id=user.id, action_type=action_type, details=details,
+                  timestamp=datetime.now(UTC))
+    if history_batch is None:
+        db.session.add(RecordHistory(**values))
+    else:
+        history_batch.append(values)
+
+def insert_record_history_batch(history_batch):
+    if history_batch:
+        db.session.execute(insert(RecordHistory), history_batch)
+
+def can_resend_records(user):
+    # Admins of Intendencia, or the main superadmin (username 'admin')
+    return (user.role == 'admin' and user.department == INTENDENCIA_DEPT_NAME) or user.username == 'admin'
+
+def create_record(department, creator, full_name, manual_sequence_number=None, history_batch=None, **fields):
+    """
+    Adds a new record with its CREACIÓN history entry and flushes it. The sequence number is
+    manual_sequence_number if it is free (reserved numbers can be used manually), or the next automatic one.
+    Both hold the database write lock until the commit. fields are other Record columns.
+    """
+    sequence_reservation = None
+    if manual_sequence_number is not None:
+        # Check that the number is free holding the write lock, so nobody else can take it before the commit
+        begin_immediate_transaction()
+        if Record.query.filter_by(sequence_number=manual_sequence_number).first():
+            raise RecordActionError(f'El número de secuencia manual "{manual_sequence_number:04d}" ya está en uso.')
+        sequence_reservation = db.session.get(SequenceReservation, manual_sequence_number)
+        sequence_number = manual_sequence_number
+    else:
+        # Take the next sequence number from the counter (skips 8 and 9)
+        sequence_number = allocate_sequence_number()
+
+    # Digital number format: DEPT-SEQ-DD-MM-YYYY
+    dept_code = department_cache.code(department.id)
+    digital_number = f"{dept_code}-{sequence_number:04d}-{datetime.now(UTC).strftime('%d-%m-%Y')}"
+    new_record = Record(sequence_number=sequence_number, digital_number=digital_number, full_name=full_name,
+                        department_id=department.id, created_by=creator.id, **fields)
+    db.session.add(new_record)
+    db.session.flush() # Flush to get new_record.id
+    if sequence_reservation:
+        sequence_reservation.record_id = new_record.id
+
+    add_record_history(new_record, creator, "CREACIÓN", f"Expediente iniciado en el departamento {department.name}.",
+                       history_batch)
+    return new_record
+
+def change_record_status(record, new_status, user, history_batch=None):
+    """Sets the status with a CAMBIO DE ESTADO history entry. Returns False if the record already had it."""
+    if new_status not in RECORD_STATUS_LABELS:
+        raise RecordActionError(f'Estado no válido: "{new_status}".')
+    if record.status == new_status:
+        return False
+    old_status_label = RECORD_STATUS_LABELS.get(record.status, record.status)
+    record.status = new_status
+    add_record_history(record, user, "CAMBIO DE ESTADO",
+                       f"Estado cambiado de '{old_status_label}' a '{RECORD_STATUS_LABELS[new_status]}'.", history_batch)
+    return True
+
+def resend_record_to_department(record, new_department, user, history_batch=None):
+    """
+    Moves a pending or urgent record to new_department: status 'in_progress', digital number
+    LEAVING-ARRIVING-SEQ-ORIGINAL_DATE and a REENVÍO history entry.
+    """
+    if record.status not in ['pending', 'urgente']:
+        raise RecordActionError('Solo los expedientes en estado "pendiente" o "urgente" pueden ser re-enviados.', 'warning')
+    if new_department.id == record.department_id:
+        raise RecordActionError(f'El expediente ya se encuentra en el departamento "{new_department.name}". No se realizaron cambios.', 'info')
+
+    # The date part comes from the digital number as it is before this change
+    current_dn_parts = record.digital_number.split('-')
+    if len(current_dn_parts) < 5: # Expects at least DEPT-SEQ-DD-MM-YYYY (5 parts)
+        app.logger.error(f"Digital number '{record.digital_number}' for record {record.id} is too short to parse date and sequence.")
+        raise RecordActionError(f"Error: Formato de número digital '{record.digital_number}' no es válido para extraer fecha y secuencia. No se pudo actualizar el número digital.")
+    original_date_part = f"{current_dn_parts[-3]}-{current_dn_parts[-2]}-{current_dn_parts[-1]}"
+
+    leaving_department = record.department # Department the record is currently in (before update)
+    leaving_dept_code = department_cache.code(leaving_department.id)
+    arriving_dept_code = department_cache.code(new_department.id)
+    new_digital_number = f"{leaving_dept_code}-{arriving_dept_code}-{int(record.sequence_number):04d}-{original_date_part}"
+
+    record.department_id = new_department.id
+    record.department = new_department
+    record.status = 'in_progress' # Change status to "En Progreso"
+    record.digital_number = new_digital_number
+
+    add_record_history(record, user, "REENVÍO",
+                       f"Movido del departamento '{leaving_department.name}' al departamento '{new_department.name}'. "
+                       f"Nuevo número digital: {new_digital_number}. Estado actualizado a 'En Progreso'.", history_batch)
+    return leaving_department
+
 # Routes
 @app.route('/')
 def home():
@@ -250,7 +2567,7 @@ def login():
         user = User.query.filter_by(username=username).first()
         
         if user and check_password_hash(user.password, password):
-            login_user(user)
+            login_user(SessionUser.from_user(user))
             return redirect(url_for('dashboard'))
         else:
             flash('Usuario o contraseña incorrectos', 'danger')
@@ -268,21 +2585,36 @@ def logout():
 def dashboard():
     is_admin = current_user.role == 'admin'
     # For the dashboard, Mesa de Entrada users see only their department, like regular users.
+    # The recent records are only loaded when the panels are rendered (not when they come from the fragment cache)
+    recent_records_query = Record.query.options(*record_load_options('dashboard')).order_by(Record.created_at.desc())
     if is_admin:
-        departments_for_dashboard = Department.query.all()
-        recent_records_list = Record.query.order_by(Record.created_at.desc()).limit(8).all()
+        departments_for_dashboard = department_cache.all(order_by='id')
     else:
         user_dept_name = current_user.department
-        user_department_obj_for_dashboard = Department.query.filter_by(name=user_dept_name).first()
+        user_department_obj_for_dashboard = department_cache.by_name(user_dept_name)
         if user_department_obj_for_dashboard:
             departments_for_dashboard = [user_department_obj_for_dashboard]
-            recent_records_list = Record.query.filter_by(department_id=user_department_obj_for_dashboard.id)\
-                                          .order_by(Record.created_at.desc()).limit(8).all()
+            recent_records_query = recent_records_query.filter_by(department_id=user_department_obj_for_dashboard.id)
         else:
             departments_for_dashboard = []
-            recent_records_list = []
+            recent_records_query = None
             flash(f"No se pudo encontrar el departamento asignado: {user_dept_name}", "warning")
-    return render_template('dashboard.html', departments=departments_for_dashboard, recent_records=recent_records_list, DATETIME_APP_FORMAT=APP_WIDE_DATETIME_FORMAT)
+
+    def recent_records_list():
+        return recent_records_query.limit(8).all() if recent_records_query is not None else []
+
+    def render_dashboard_panels():
+        record_counts = get_department_record_counts(None if is_admin else [dept.id for dept in departments_for_dashboard])
+        return render_template('fragments/dashboard_panels.html', departments=departments_for_dashboard,
+                               recent_records=recent_records_list(), record_counts=record_counts,
+                               RECORD_STATUS_LABELS=RECORD_STATUS_LABELS, DATETIME_APP_FORMAT=APP_WIDE_DATETIME_FORMAT)
+
+    live_events_url = record_events_url() # Before the panels, as in records()
+    dashboard_department_ids = None if is_admin else [dept.id for dept in departments_for_dashboard]
+    fragment_key = ('dashboard_panels', 'all' if is_admin else tuple(dashboard_department_ids),
+                    fragment_data_version(dashboard_department_ids)) if departments_for_dashboard else None
+    return render_template('dashboard.html', dashboard_panels=cached_fragment(fragment_key, render_dashboard_panels),
+                           live_events_url=live_events_url, RECORD_STATUS_LABELS=RECORD_STATUS_LABELS)
 
 @app.route('/users')
 @login_required
@@ -301,7 +2633,7 @@ def add_user():
         flash('Acceso no autorizado', 'danger')
         return redirect(url_for('dashboard'))
         
-    departments = Department.query.all()
+    departments = department_cache.all(order_by='id')
     
     if request.method == 'POST':
         username = request.form.get('username')
@@ -341,7 +2673,7 @@ def edit_user(user_id):
         return redirect(url_for('dashboard'))
 
     user_to_edit = User.query.get_or_404(user_id)
-    departments = Department.query.all()
+    departments = department_cache.all(order_by='id')
 
     # Prevent admin from editing their own role or deleting themselves via edit form (though delete route handles deletion)
     # For simplicity, we'll allow admin to edit their own name/department, but not role here.
@@ -396,6 +2728,23 @@ def delete_user(user_id):
 
     return redirect(url_for('users'))
 
+@app.route('/admin/request-profile', methods=['GET', 'POST'])
+@login_required
+def request_profile():
+    if current_user.role != 'admin':
+        flash('Acceso no autorizado', 'danger')
+        return redirect(url_for('dashboard'))
+
+    if request.method == 'POST':
+        reset_request_profile_stats()
+        flash('Estadísticas de rendimiento reiniciadas.', 'success')
+        return redirect(url_for('request_profile'))
+
+    slow_endpoints, slow_statements, stats_since = get_request_profile_summary()
+    return render_template('request_profile.html', profiling_enabled=app.config['REQUEST_PROFILING_ENABLED'],
+                           slow_endpoints=slow_endpoints, slow_statements=slow_statements,
+                           stats_since=stats_since, DATETIME_APP_FORMAT=APP_WIDE_DATETIME_FORMAT)
+
 @app.route('/records')
 @login_required
 def records():
@@ -403,59 +2752,215 @@ def records():
     search_term = request.args.get('search_term', default=None, type=str)
     status_filter = request.args.get('status', default=None, type=str)
 
-    query = Record.query.join(Department, Record.department_id == Department.id)\
-                        .join(User, Record.created_by == User.id)
-
-    is_admin = current_user.role == 'admin'
-    is_privileged_viewer = current_user.department in PRIVILEGED_VIEW_DEPARTMENTS
-    can_view_all_initial = is_admin or is_privileged_viewer
+    query, fts_matches, effective_department_id_filter, own_department = \
+        build_records_query(department_id_from_arg, status_filter, search_term)
 
-    effective_department_id_filter = None
     departments_for_dropdown = []
     page_header_department_obj = None
-
-    if can_view_all_initial:
-        departments_for_dropdown = Department.query.order_by(Department.name).all()
+    if record_access().can_view_all:
+        departments_for_dropdown = department_cache.all()
         if department_id_from_arg:
-            query = query.filter(Record.department_id == department_id_from_arg)
-            effective_department_id_filter = department_id_from_arg
-            page_header_department_obj = Department.query.get(department_id_from_arg)
-        # If no department_id_from_arg, query remains unfiltered by department for these users
-    else: # Regular user, restricted to their department
-        user_dept_name = current_user.department
-        user_dept_obj = Department.query.filter_by(name=user_dept_name).first()
-        if user_dept_obj:
-            query = query.filter(Record.department_id == user_dept_obj.id)
-            effective_department_id_filter = user_dept_obj.id
-            departments_for_dropdown = [user_dept_obj]
-            page_header_department_obj = user_dept_obj
-        else: # User's department not found
-            query = query.filter(db.false()) # Show no records
-            # departments_for_dropdown remains empty
-            # page_header_department_obj remains None
-
-    if status_filter:
-        query = query.filter(Record.status == status_filter)
-
-    if search_term and search_term.strip():
-        search_term_cleaned = search_term.strip()
-        search_pattern = f"%{search_term_cleaned}%"
-        query = query.filter(or_(
-            Record.digital_number.ilike(search_pattern),
-            Record.full_name.ilike(search_pattern),
-            Record.description.ilike(search_pattern),
-            Department.name.ilike(search_pattern)
-        ))
-
-    records_list = query.order_by(Record.created_at.desc()).all()
-
-    return render_template('records.html', 
-                           records=records_list, 
+            page_header_department_obj = department_cache.get(department_id_from_arg)
+    elif own_department: # Regular user, restricted to their department
+        departments_for_dropdown = [own_department]
+        page_header_department_obj = own_department
+
+    # Keyset pagination: only one page of rows is loaded, whatever the size of the table
+    per_page = request.args.get('per_page', default=app.config['RECORDS_PER_PAGE'], type=int)
+    per_page = max(1, min(per_page, app.config['RECORDS_MAX_PER_PAGE']))
+    after_cursor = request.args.get('after', default=None, type=str)
+    before_cursor = request.args.get('before', default=None, type=str)
+
+    can_bulk_resend = can_resend_records(current_user)
+    can_bulk_change_status = current_user.role == 'admin'
+
+    def render_records_table():
+        page_query = query.options(*record_load_options('listing'))
+        search_snippets = {}
+        if fts_matches is not None:
+            page_query = page_query.add_columns(fts_matches.c.rank, fts_matches.c.snippet)
+            ranked_rows, next_cursor, prev_cursor = paginate_records_keyset(page_query, after_cursor=after_cursor,
+                                                                            before_cursor=before_cursor,
+                                                                            per_page=per_page,
+                                                                            rank_column=fts_matches.c.rank)
+            records_list = [row[0] for row in ranked_rows]
+            search_snippets = {row[0].id: highlight_fts_snippet(row[2]) for row in ranked_rows}
+        else:
+            records_list, next_cursor, prev_cursor = paginate_records_keyset(page_query, after_cursor=after_cursor,
+                                                                             before_cursor=before_cursor,
+                                                                             per_page=per_page)
+        total_count, total_is_capped = count_records_capped(query, app.config['RECORDS_COUNT_CAP'])
+
+        # Filters to carry over in the next/previous page links
+        pagination_args = {
+            'department': department_id_from_arg,
+            'status': status_filter,
+            'search_term': search_term,
+            'per_page': per_page if per_page != app.config['RECORDS_PER_PAGE'] else None
+        }
+        pagination_args = {key: value for key, value in pagination_args.items() if value}
+
+        return render_template('fragments/records_table.html',
+                               records=records_list,
+                               departments=departments_for_dropdown,
+                               selected_department_id=effective_department_id_filter,
+                               search_term=search_term,
+                               selected_status=status_filter, DATETIME_APP_FORMAT=APP_WIDE_DATETIME_FORMAT,
+                               total_count=total_count,
+                               total_is_capped=total_is_capped,
+                               next_cursor=next_cursor,
+                               prev_cursor=prev_cursor,
+                               pagination_args=pagination_args,
+                               search_snippets=search_snippets,
+                               can_bulk_resend=can_bulk_resend,
+                               can_bulk_change_status=can_bulk_change_status,
+                               record_status_labels=RECORD_STATUS_LABELS)
+
+    live_events_url = record_events_url() # Taken before the table is read, see RECORD_EVENTS_RESUME_SLACK_SECONDS
+    # First pages without a search are the same for everyone with the same visibility and permissions
+    fragment_key = None
+    if not search_term and not after_cursor and not before_cursor:
+        access = record_access()
+        fragment_key = ('records_table', request.full_path,
+                        'all' if access.can_view_all else tuple(sorted(access.department_ids)),
+                        current_user.role, can_bulk_resend,
+                        fragment_data_version(None if access.can_view_all else access.department_ids))
+
+    return render_template('records.html',
+                           records_table=cached_fragment(fragment_key, render_records_table),
                            departments=departments_for_dropdown,
                            selected_department_id=effective_department_id_filter,
                            department=page_header_department_obj,
                            search_term=search_term, # Keep this for the input field value
-                           selected_status=status_filter, DATETIME_APP_FORMAT=APP_WIDE_DATETIME_FORMAT)
+                           selected_status=status_filter,
+                           live_events_url=live_events_url,
+                           live_insert_new=not search_term and not after_cursor and not before_cursor)
+
+@app.route('/records/events')
+@login_required
+def record_events():
+    """
+    Server-Sent Events for the dashboard and the listing: record-created, record-resent and status-changed for the
+    records the user can see, then department-counts with the new totals of their departments. The stream resumes
+    after Last-Event-ID (sent by the browser when it reconnects) or ?since=, or starts at the page's ?rendered_at=.
+    """
+    if not app.config['RECORD_EVENTS_ENABLED']:
+        return Response(status=204) # EventSource does not reconnect after a 204
+    access = record_access()
+    after_id = request.headers.get('Last-Event-ID', type=int)
+    if after_id is None:
+        after_id = request.args.get('since', type=int)
+    rendered_at = request.args.get('rendered_at', type=float)
+    if after_id is None and rendered_at is not None:
+        after_id = record_change_id_before(datetime.fromtimestamp(rendered_at, UTC)
+                                           - timedelta(seconds=app.config['RECORD_EVENTS_RESUME_SLACK_SECONDS']))
+    if after_id is None:
+        after_id = latest_record_change_id()
+    db.session.close()
+
+    def generate_events(after_id):
+        poll_seconds = app.config['RECORD_EVENTS_POLL_SECONDS']
+        ends_at = time.monotonic() + app.config['RECORD_EVENTS_STREAM_SECONDS']
+        sent_at = time.monotonic()
+        yield f'retry: {int(poll_seconds * 1000)}\n\n'
+        while True:
+            changes, department_counts = record_change_feed.changes_after(after_id)
+            messages = []
+            for change in changes:
+                if access.can_view_department(change.department_id) \
+                        or change.previous_department_id is not None and access.can_view_department(change.previous_department_id):
+                    messages.append(format_server_sent_event(change.event, record_change_payload(change, access), change.id))
+            visible_counts = {department_id: counts for department_id, counts in department_counts.items()
+                              if access.can_view_department(department_id)}
+            db.session.close() # The connection goes back to the pool while the stream waits
+            if changes:
+                after_id = changes[-1].id
+            if messages and visible_counts:
+                messages.append(format_server_sent_event('department-counts', visible_counts))
+            now = time.monotonic()
+            if messages:
+                yield ''.join(messages)
+                sent_at = now
+            elif now - sent_at >= app.config['RECORD_EVENTS_KEEPALIVE_SECONDS']:
+                # Comment line for proxies; the id moves the browser's Last-Event-ID past changes it did not get
+                yield f': keepalive\nid: {after_id}\n\n'
+                sent_at = now
+            if now >= ends_at:
+                return
+            time.sleep(poll_seconds)
+
+    return Response(stream_with_context(generate_events(after_id)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/records/bulk', methods=['POST'])
+@login_required
+def records_bulk_action():
+    """
+    Resend (action=resend, new_department_id) or status change (action=status, new_status) of the records
+    selected in the listing, in one transaction. Records the rules do not allow are skipped and reported;
+    their PDFs are queued for the worker.
+    """
+    next_url = request.form.get('next') or url_for('records')
+    if not next_url.startswith('/records'): # Only back to the listing, never to another site
+        next_url = url_for('records')
+    action = request.form.get('action')
+    record_ids = request.form.getlist('record_ids', type=int)
+
+    if action == 'resend' and not can_resend_records(current_user) \
+            or action == 'status' and current_user.role != 'admin':
+        flash('No tiene permisos para realizar esta acción.', 'danger')
+        return redirect(next_url)
+    if action not in ('resend', 'status'):
+        flash('Acción no válida.', 'danger')
+        return redirect(next_url)
+    if not record_ids:
+        flash('Seleccione al menos un expediente.', 'warning')
+        return redirect(next_url)
+    if len(record_ids) > app.config['RECORDS_BULK_ACTION_MAX']:
+        flash(f"Se pueden procesar como máximo {app.config['RECORDS_BULK_ACTION_MAX']} expedientes a la vez.", 'warning')
+        return redirect(next_url)
+
+    if action == 'resend':
+        new_department_obj = Department.query.get(request.form.get('new_department_id', type=int) or 0)
+        if not new_department_obj:
+            flash('Debe seleccionar un departamento de destino válido.', 'danger')
+            return redirect(next_url)
+        def apply_action(record):
+            resend_record_to_department(record, new_department_obj, current_user, history_batch)
+            return True
+    else:
+        new_status = request.form.get('new_status')
+        if new_status not in RECORD_STATUS_LABELS:
+            flash('Debe seleccionar un estado válido.', 'danger')
+            return redirect(next_url)
+        def apply_action(record):
+            return change_record_status(record, new_status, current_user, history_batch)
+
+    begin_immediate_transaction() # Read and update the selection without another writer in between
+    selected_records = Record.query.options(joinedload(Record.department))\
+                                   .filter(Record.id.in_(record_ids)).order_by(Record.id).all()
+    changed_records, skipped, history_batch = [], [], []
+    for record in selected_records:
+        try:
+            if apply_action(record):
+                changed_records.append(record)
+        except RecordActionError as e:
+            skipped.append(f"{record.digital_number}: {e}")
+    insert_record_history_batch(history_batch)
+    enqueue_record_pdfs(changed_records)
+    db.session.commit()
+
+    if changed_records:
+        if action == 'resend':
+            flash(f'{len(changed_records)} expediente(s) re-enviado(s) a "{new_department_obj.name}". Estado: En Progreso.', 'success')
+        else:
+            flash(f'Estado de {len(changed_records)} expediente(s) cambiado a "{RECORD_STATUS_LABELS[new_status]}".', 'success')
+    elif not skipped:
+        flash('No se realizaron cambios.', 'info')
+    if skipped:
+        shown = '; '.join(skipped[:10]) + (f' (y {len(skipped) - 10} más)' if len(skipped) > 10 else '')
+        flash(f'{len(skipped)} expediente(s) sin cambios: {shown}', 'warning')
+    return redirect(next_url)
 
 @app.route('/records/add', methods=['GET', 'POST'])
 @login_required
@@ -469,10 +2974,10 @@ def add_record():
     user_department_for_form = None # The user's department object if they are restricted
 
     if user_can_select_any_department: # Admin
-        departments_for_select_dropdown = Department.query.order_by(Department.name).all()
+        departments_for_select_dropdown = department_cache.all()
     else: # Regular user or Mesa de Entrada user
         user_dept_name = current_user.department
-        user_department_obj = Department.query.filter_by(name=user_dept_name).first()
+        user_department_obj = department_cache.by_name(user_dept_name)
         if user_department_obj:
             departments_for_select_dropdown = [user_department_obj]
             user_department_for_form = user_department_obj
@@ -486,9 +2991,8 @@ def add_record():
 
         # Helper function or inline logic for re-render parameters
         def get_params_for_rerender(current_form_data):
-            last_rec = Record.query.order_by(Record.sequence_number.desc()).first()
-            raw_next_seq = (last_rec.sequence_number + 1) if last_rec else 1
-            next_seq = get_next_available_sequence_number()
+            db.session.rollback() # Nothing is saved; also releases the sequence write lock if it was taken
+            raw_next_seq, next_seq = get_sequence_number_suggestion()
             current_date_str_for_num_gen = datetime.now(UTC).strftime('%d-%m-%Y') # For digital number generation
             default_transaction_date_val = current_form_data.get('transaction_date') or datetime.now(UTC).strftime('%Y-%m-%dT%H:%M') # Format for datetime-local
             dept_codes_json = json.dumps(DEPARTMENT_CODES)
@@ -511,7 +3015,6 @@ def add_record():
         status_from_form = request.form.get('status') # Leer el nuevo campo 'status'
         transaction_date_str = request.form.get('transaction_date')
         department_id = request.form.get('department_id', type=int)
-        attachment_file = request.files.get('attachment')
         manual_sequence_number_str = request.form.get('manual_sequence_number', '').strip()
         
         # Validate department selection and authorization
@@ -519,7 +3022,7 @@ def add_record():
             flash('Debe seleccionar un departamento.', 'danger')
             return render_template('add_record.html', **get_params_for_rerender(request.form))
 
-        selected_department_obj = Department.query.get(department_id)
+        selected_department_obj = department_cache.get(department_id)
         if not selected_department_obj:
             flash('Departamento no válido.', 'danger')
             return render_template('add_record.html', **get_params_for_rerender(request.form))
@@ -530,94 +3033,65 @@ def add_record():
                 flash('No tiene permisos para crear expedientes en el departamento seleccionado.', 'danger')
                 return render_template('add_record.html', **get_params_for_rerender(request.form))
 
-        sequence_number_to_use = None
+        # Process transaction_date (before taking a sequence number, which locks the database until commit)
+        transaction_datetime = None
+        if transaction_date_str:
+            try:
+                # Format from datetime-local input is 'YYYY-MM-DDTHH:MM'
+                transaction_datetime = datetime.strptime(transaction_date_str, '%Y-%m-%dT%H:%M').replace(tzinfo=UTC)
+            except ValueError:
+                flash('Fecha de trámite no válida. Asegúrese de que el formato sea correcto y la fecha/hora existan.', 'danger')
+                return render_template('add_record.html', **get_params_for_rerender(request.form))
 
+        manual_seq_int = None
         if manual_sequence_number_str:
             try:
                 manual_seq_int = int(manual_sequence_number_str)
                 if not (0 < manual_seq_int < 10000): # Basic validation for 4 digits, adjust as needed
                     raise ValueError("Sequence number out of typical range.")
-                
-                # Check if this manually entered sequence number is already taken
-                existing_record_by_seq = Record.query.filter_by(sequence_number=manual_seq_int).first()
-                if existing_record_by_seq:
-                    flash(f'El número de secuencia manual "{manual_seq_int:04d}" ya está en uso.', 'danger')
-                    return render_template('add_record.html', **get_params_for_rerender(request.form))
-                sequence_number_to_use = manual_seq_int
             except ValueError:
                 flash('El número de secuencia manual debe ser un número válido (ej: 0008).', 'danger')
                 return render_template('add_record.html', **get_params_for_rerender(request.form))
-        else:
-            # Get the next available sequence number using the helper function (skips 8 and 9)
-            sequence_number_to_use = get_next_available_sequence_number()
 
-        # Generate digital number (format: DEPT-SEQ-DD-MM-YYYY)
-        dept_code = DEPARTMENT_CODES.get(selected_department_obj.name, f"DPT{selected_department_obj.id}")
-        date_str_for_number = datetime.now(UTC).strftime('%d-%m-%Y') # Format: DD-MM-YYYY
-        digital_number = f"{dept_code}-{sequence_number_to_use:04d}-{date_str_for_number}"
-        
-        attachment_savename = None
-        if attachment_file and attachment_file.filename != '':
-            original_filename_secure = secure_filename(attachment_file.filename)
-            _ , ext_part = os.path.splitext(original_filename_secure)
+        # The attachment is copied and hashed before create_record takes the sequence number: that holds the
+        # database write lock until the commit, and other writers must not wait for this disk I/O
+        attachment_original_filename = pending_attachment_filename() # Form file or finished chunked upload
+        attachment_fields = {}
+        if attachment_original_filename:
+            try:
+                attachment_fields['attachment_size'], attachment_fields['attachment_sha256'] = store_attachment()
+            except UploadError as e:
+                flash(str(e), 'danger')
+                return render_template('add_record.html', **get_params_for_rerender(request.form))
+
+        try:
+            new_record = create_record(selected_department_obj, current_user, full_name,
+                                       manual_sequence_number=manual_seq_int,
+                                       dni=dni, address=address, phone=phone, email=email,
+                                       transaction_date=transaction_datetime, description=description,
+                                       status=status_from_form, # Asignar el valor del formulario al campo status del Record
+                                       **attachment_fields)
+        except RecordActionError as e:
+            flash(str(e), e.category)
+            return render_template('add_record.html', **get_params_for_rerender(request.form))
+
+        if attachment_original_filename:
+            _ , ext_part = os.path.splitext(attachment_original_filename)
             current_date_str = datetime.now(UTC).strftime('%d-%m-%Y')
             solicitante_name_part = secure_filename(full_name.replace(" ", "_").lower()) # Usar full_name para el nombre
+            dept_code = selected_department_obj.code
             
             # Construct the new filename: DEPT_CODE-SEQ_NUM-SOLICITANTE_NAME-DATE.EXT
             # Example: OP-0001-juan_perez-23-10-2023.pdf
-            new_filename = f"{dept_code}-{sequence_number_to_use:04d}-{solicitante_name_part}-{current_date_str}{ext_part}"
-            
-            # Ensure UPLOAD_FOLDER path is absolute or correctly relative for os.path.join
-            upload_path = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'])
-            attachment_file.save(os.path.join(upload_path, new_filename))
-            attachment_savename = new_filename
-        
-        # Process transaction_date
-        transaction_datetime = None
-        if transaction_date_str:
-            try:
-                # Format from datetime-local input is 'YYYY-MM-DDTHH:MM'
-                transaction_datetime = datetime.strptime(transaction_date_str, '%Y-%m-%dT%H:%M').replace(tzinfo=UTC)
-            except ValueError:
-                flash('Fecha de trámite no válida. Asegúrese de que el formato sea correcto y la fecha/hora existan.', 'danger')
-                return render_template('add_record.html', **get_params_for_rerender(request.form))
-
-        new_record = Record(
-            sequence_number=sequence_number_to_use,
-            digital_number=digital_number,
-            full_name=full_name,
-            dni=dni,
-            address=address,
-            phone=phone,
-            email=email,
-            transaction_date=transaction_datetime,
-            description=description,
-            department_id=selected_department_obj.id,
-            attachment_filename=attachment_savename,
-            created_by=current_user.id,
-            status=status_from_form # Asignar el valor del formulario al campo status del Record
-        )
-        
-        db.session.add(new_record)
-        db.session.flush() # Flush to get new_record.id
-
-        # Log history
-        history_entry = RecordHistory(
-            record_id=new_record.id,
-            user_id=current_user.id, # type: ignore
-            action_type="CREACIÓN",
-            details=f"Expediente iniciado en el departamento {selected_department_obj.name}."
-        )
-        db.session.add(history_entry)
+            new_record.attachment_filename = f"{dept_code}-{new_record.sequence_number:04d}-{solicitante_name_part}-{current_date_str}{ext_part}"
 
-        # Generate PDF for the new record
+        # Queue the PDF for the new record; the worker renders it after the commit.
         # The new_record object is already in session and has its ID after flush.
-        # generate_record_pdf will modify its generated_pdf_filename attribute.
-        generated_pdf_file = generate_record_pdf(new_record)
-        if not generated_pdf_file:
+        pdf_queued = enqueue_record_pdf(new_record)
+        if not pdf_queued:
             flash('Expediente creado, pero hubo un error al generar el PDF asociado.', 'warning')
         
-        # Commit everything: record, history, and pdf filename (if set)
+        # Commit everything: record, history and PDF job
         db.session.commit()
 
         flash('Expediente creado exitosamente', 'success')
@@ -625,10 +3099,7 @@ def add_record():
     
     # GET request:
     # For suggested number display
-    last_record_for_raw_get = Record.query.order_by(Record.sequence_number.desc()).first()
-    raw_next_sequence_number_get = (last_record_for_raw_get.sequence_number + 1) if last_record_for_raw_get else 1
-    
-    next_sequence_number = get_next_available_sequence_number()
+    raw_next_sequence_number_get, next_sequence_number = get_sequence_number_suggestion()
     current_date_str_for_number = datetime.now(UTC).strftime('%d-%m-%Y')
     department_codes_json = json.dumps(DEPARTMENT_CODES)
     default_transaction_date_str_get = datetime.now(UTC).strftime('%Y-%m-%dT%H:%M') # Format for datetime-local
@@ -645,21 +3116,25 @@ def add_record():
 @app.route('/records/<int:record_id>')
 @login_required
 def view_record(record_id):
-    record = Record.query.get_or_404(record_id)
-
-    is_admin = current_user.role == 'admin'
-    is_privileged_viewer = current_user.department in PRIVILEGED_VIEW_DEPARTMENTS
-    
-    can_view_this_record = is_admin or is_privileged_viewer or (record.department.name == current_user.department)
+    record = Record.query.options(*record_load_options('detail')).filter(Record.id == record_id).first_or_404()
 
-    if not can_view_this_record:
+    if not record_access().can_view(record):
         flash('No tiene permisos para ver este expediente.', 'danger')
         return redirect(url_for('dashboard')) 
         
     # For the "Resend" feature, pass all departments and the Intendencia department name
-    all_departments_for_dropdown = Department.query.order_by(Department.name).all()
+    all_departments_for_dropdown = department_cache.all()
+
+    # history_entries and notes are dynamic relationships; load them once with their authors
+    history_entries_list = record.history_entries.options(joinedload(RecordHistory.user)).all()
+    notes_list = record.notes.options(joinedload(Note.author)).all()
+        
+    latest_pdf_job = record.pdf_jobs.order_by(PdfJob.id.desc()).first()
         
     return render_template('view_record.html', record=record, 
+                           pdf_job=latest_pdf_job,
+                           history_entries=history_entries_list,
+                           notes=notes_list,
                            DATETIME_APP_FORMAT=APP_WIDE_DATETIME_FORMAT,
                            INTENDENCIA_DEPT_NAME=INTENDENCIA_DEPT_NAME,
                            all_departments=all_departments_for_dropdown)
@@ -667,16 +3142,10 @@ def view_record(record_id):
 @app.route('/records/<int:record_id>/print_view') # edunius
 @login_required
 def print_record_view(record_id):
-    record = Record.query.get_or_404(record_id)
+    record = Record.query.options(*record_load_options('pdf')).filter(Record.id == record_id).first_or_404()
 
     # Permisos: Cualquier usuario que pueda ver el expediente, puede imprimirlo.
-    # Esta lógica es similar a la de la ruta view_record.
-    is_admin = current_user.role == 'admin'
-    is_privileged_viewer = current_user.department in PRIVILEGED_VIEW_DEPARTMENTS
-    
-    can_access_this_record = is_admin or is_privileged_viewer or (record.department.name == current_user.department)
-
-    if not can_access_this_record:
+    if not record_access().can_view(record):
         flash('No tiene permisos para imprimir este expediente.', 'danger')
         # Redirigir a la vista del expediente o al dashboard según prefieras
         return redirect(url_for('view_record', record_id=record.id)) 
@@ -688,6 +3157,77 @@ def print_record_view(record_id):
 
 
 
+@app.route('/records/export')
+@login_required
+def records_export():
+    """The filtered listing as CSV or XLSX (?format=), streamed; ?history=1 adds each record's latest movement."""
+    export_format = request.args.get('format', default='csv', type=str)
+    if export_format not in ('csv', 'xlsx'):
+        flash('Formato de exportación no válido.', 'danger')
+        return redirect(url_for('records'))
+    department_id = request.args.get('department', default=None, type=int)
+    status_filter = request.args.get('status', default=None, type=str)
+    search_term = request.args.get('search_term', default=None, type=str)
+    include_history = request.args.get('history') == '1'
+
+    def generate_export():
+        # The query is built inside the generator so it uses the session of the streaming context
+        query = build_records_query(department_id, status_filter, search_term)[0]
+        rows = records_export_rows(query, include_history)
+        yield from (stream_records_xlsx(rows) if export_format == 'xlsx' else stream_records_csv(rows))
+
+    export_name = f"expedientes_{datetime.now(UTC).strftime('%d_%m_%Y_%H%M')}.{export_format}"
+    mimetype = ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet' if export_format == 'xlsx'
+                else 'text/csv')
+    return Response(stream_with_context(generate_export()), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={export_name}'})
+
+@app.route('/records/export/pdfs')
+@login_required
+def records_export_pdfs():
+    export_format = request.args.get('format', default='zip', type=str)
+    department_id = request.args.get('department', default=None, type=int)
+    status_filter = request.args.get('status', default=None, type=str)
+    try:
+        date_from = parse_export_date(request.args.get('date_from'))
+        date_to = parse_export_date(request.args.get('date_to'))
+    except ValueError:
+        flash('Las fechas de exportación deben tener el formato AAAA-MM-DD.', 'danger')
+        return redirect(url_for('records'))
+
+    # Same visibility rules as the records listing
+    access = record_access()
+    if not access.can_view_all:
+        if access.own_department_id is None:
+            flash('No se pudo encontrar su departamento asignado.', 'danger')
+            return redirect(url_for('records'))
+        department_id = access.own_department_id
+
+    query = bulk_export_records_query(department_id, status_filter, date_from, date_to)
+    export_count, too_many_for_pdf = count_records_capped(query, app.config['BULK_EXPORT_PDF_MAX_RECORDS'])
+    if export_count == 0:
+        flash('No hay expedientes que coincidan con los filtros de exportación.', 'warning')
+        return redirect(url_for('records', department=department_id, status=status_filter))
+
+    export_name = f"expedientes_{datetime.now(UTC).strftime('%d_%m_%Y_%H%M')}"
+    if export_format == 'pdf':
+        if too_many_for_pdf:
+            flash(f"Un PDF único admite hasta {app.config['BULK_EXPORT_PDF_MAX_RECORDS']} expedientes. Use la exportación ZIP.", 'warning')
+            return redirect(url_for('records', department=department_id, status=status_filter))
+        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as export_file:
+            write_records_combined_pdf(query, app.config['BULK_EXPORT_BATCH_SIZE'], request.url_root, export_file)
+        return Response(stream_file_and_delete(export_file.name), mimetype='application/pdf',
+                        headers={'Content-Disposition': f'attachment; filename={export_name}.pdf'})
+
+    base_url = request.url_root
+    def generate_zip():
+        # The query is built inside the generator so it uses the session of the streaming context
+        export_query = bulk_export_records_query(department_id, status_filter, date_from, date_to)
+        yield from stream_records_pdf_zip(export_query, app.config['BULK_EXPORT_BATCH_SIZE'],
+                                          app.config['BULK_EXPORT_PROCESSES'], base_url)
+    return Response(stream_with_context(generate_zip()), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={export_name}.zip'})
+
 @app.route('/records/edit/<int:record_id>', methods=['GET', 'POST'])
 @login_required
 def edit_record(record_id):
@@ -696,7 +3236,7 @@ def edit_record(record_id):
         return redirect(url_for('records'))
 
     record_to_edit = Record.query.get_or_404(record_id)
-    departments_for_select = Department.query.order_by(Department.name).all()
+    departments_for_select = department_cache.all()
 
     if request.method == 'POST':
         try:
@@ -726,11 +3266,11 @@ def edit_record(record_id):
                 # Capture the current department name BEFORE changing it, for the flash message
                 original_department_name_for_flash = record_to_edit.department.name
 
-                new_department_obj = Department.query.get(new_department_id)
+                new_department_obj = department_cache.get(new_department_id)
                 if new_department_obj:
                     record_to_edit.department_id = new_department_id
                     # Regenerate digital_number: Keep sequence, update dept code and date of change
-                    new_dept_code = DEPARTMENT_CODES.get(new_department_obj.name, f"DPT{new_department_obj.id}")
+                    new_dept_code = new_department_obj.code
                     date_str_for_number = datetime.now(UTC).strftime('%d-%m-%Y') # Date of this significant change
                     record_to_edit.digital_number = f"{new_dept_code}-{record_to_edit.sequence_number:04d}-{date_str_for_number}"
                     record_to_edit.status = 'pending' # Change status to 'pending' on department change
@@ -741,18 +3281,17 @@ def edit_record(record_id):
                     # Pass current form data back to template for repopulation
                     return render_template('edit_record.html', record=record_to_edit, departments=departments_for_select, current_data=request.form)
             # Attachment Handling
-            attachment_file = request.files.get('attachment')
-            if attachment_file and attachment_file.filename != '':
-                original_filename_secure = secure_filename(attachment_file.filename)
-                _, ext_part = os.path.splitext(original_filename_secure)
+            attachment_original_filename = pending_attachment_filename() # Form file or finished chunked upload
+            if attachment_original_filename:
+                _, ext_part = os.path.splitext(attachment_original_filename)
                 
-                # Fetch the department object based on the record_to_edit.department_id (which might have just been updated)
-                dept_for_filename_obj = Department.query.get(record_to_edit.department_id)
+                # Department of record_to_edit.department_id (which might have just been updated)
+                dept_for_filename_obj = department_cache.get(record_to_edit.department_id)
                 if not dept_for_filename_obj:
                     flash("Error crítico: No se pudo determinar el departamento para el nombre del archivo.", "danger")
                     return redirect(url_for('view_record', record_id=record_to_edit.id)) # Or handle error more gracefully
 
-                dept_code_for_filename = DEPARTMENT_CODES.get(dept_for_filename_obj.name, f"DPT{dept_for_filename_obj.id}")
+                dept_code_for_filename = dept_for_filename_obj.code
                 sequence_num_for_filename = record_to_edit.sequence_number
                 solicitante_name_part = secure_filename(record_to_edit.full_name.replace(" ", "_").lower())
                 current_date_str_for_filename = datetime.now(UTC).strftime('%d-%m-%Y') # Date of upload/change
@@ -760,9 +3299,12 @@ def edit_record(record_id):
                 new_attachment_savename = f"{dept_code_for_filename}-{sequence_num_for_filename:04d}-{solicitante_name_part}-{current_date_str_for_filename}{ext_part}"
                 
                 upload_path = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'])
-                
-                # Remove old file if it exists and is different
-                if record_to_edit.attachment_filename and record_to_edit.attachment_filename != new_attachment_savename:
+                had_legacy_attachment = record_to_edit.attachment_filename and not record_to_edit.attachment_sha256
+                record_to_edit.attachment_size, record_to_edit.attachment_sha256 = store_attachment()
+
+                # A replaced blob just loses a reference (gc-attachments deletes it once unused). Files from
+                # before the blob store still live in uploads/ and are removed here, as before.
+                if had_legacy_attachment and record_to_edit.attachment_filename != new_attachment_savename:
                     old_file_path = os.path.join(upload_path, record_to_edit.attachment_filename)
                     if os.path.exists(old_file_path):
                         try:
@@ -771,7 +3313,6 @@ def edit_record(record_id):
                             app.logger.warning(f"Could not delete old attachment {old_file_path}: {e}")
                             flash(f"Advertencia: No se pudo eliminar el adjunto anterior '{record_to_edit.attachment_filename}'.", "warning")
 
-                attachment_file.save(os.path.join(upload_path, new_attachment_savename))
                 record_to_edit.attachment_filename = new_attachment_savename
             
             # record.updated_at will be handled by onupdate in the model
@@ -786,8 +3327,8 @@ def edit_record(record_id):
             )
             db.session.add(history_entry)
 
-            # Regenerate PDF after potential changes
-            updated_pdf_file = generate_record_pdf(record_to_edit)
+            # Queue the PDF regeneration after potential changes
+            updated_pdf_file = enqueue_record_pdf(record_to_edit)
             if not updated_pdf_file:
                 # Only flash if the main update was successful but PDF failed
                 if not department_changed_and_status_updated:
@@ -795,7 +3336,7 @@ def edit_record(record_id):
                 else:
                      flash('Advertencia: Hubo un error al regenerar el PDF asociado tras la actualización.', 'warning')
             
-            db.session.commit() # Commit all changes: record data, history, pdf filename
+            db.session.commit() # Commit all changes: record data, history, PDF job
 
             if not department_changed_and_status_updated and updated_pdf_file:
                 flash('Expediente actualizado exitosamente!', 'success')
@@ -804,6 +3345,9 @@ def edit_record(record_id):
         except ValueError as ve: # Catch specific errors like invalid date format if not caught by browser
             db.session.rollback()
             flash(f'Error en los datos del formulario: {ve}', 'danger')
+        except UploadError as ue:
+            db.session.rollback()
+            flash(str(ue), 'danger')
         except Exception as e:
             db.session.rollback()
             app.logger.error(f"Error al actualizar el expediente {record_id}: {e}", exc_info=True)
@@ -820,39 +3364,38 @@ def edit_record(record_id):
 def attach_file_to_record(record_id):
     record = Record.query.get_or_404(record_id)
 
-    is_admin = current_user.role == 'admin'
-    is_privileged_viewer = current_user.department in PRIVILEGED_VIEW_DEPARTMENTS
-    can_modify_this_record = is_admin or is_privileged_viewer or (record.department.name == current_user.department)
-
-    if not can_modify_this_record:
+    if not record_access().can_view(record):
         flash('No tiene permisos para adjuntar archivos a este expediente.', 'danger')
         return redirect(url_for('view_record', record_id=record.id))
     
-    if 'attachment' not in request.files:
+    if 'attachment' not in request.files and not request.form.get('attachment_upload_token'):
         flash('No se encontró el archivo en la solicitud.', 'danger')
         return redirect(url_for('view_record', record_id=record.id))
         
-    file = request.files['attachment']
+    attachment_original_filename = pending_attachment_filename() # Form file or finished chunked upload
     
-    if file.filename == '':
+    if not attachment_original_filename:
         flash('No se seleccionó ningún archivo para subir.', 'warning')
         return redirect(url_for('view_record', record_id=record.id))
         
-    if file:
-        original_filename_secure = secure_filename(file.filename)
-        _ , ext_part = os.path.splitext(original_filename_secure) # Solo necesitamos la extensión
+    if attachment_original_filename:
+        _ , ext_part = os.path.splitext(attachment_original_filename) # Solo necesitamos la extensión
         current_date_str = datetime.now(UTC).strftime('%d-%m-%Y')
         
         # Get department code and sequence number from the existing record
         # Use defined department codes, fallback to DPT<ID> if not found
-        dept_code = DEPARTMENT_CODES.get(record.department.name, f"DPT{record.department.id}")
+        dept_code = department_cache.code(record.department_id)
         sequence_number = record.sequence_number # sequence_number is already part of the record
         solicitante_name_part = secure_filename(record.full_name.replace(" ", "_").lower()) # Usar record.full_name
         
         new_filename = f"{dept_code}-{sequence_number:04d}-{solicitante_name_part}-{current_date_str}{ext_part}"
         
-        upload_path = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'])
-        file.save(os.path.join(upload_path, new_filename))
+        try:
+            record.attachment_size, record.attachment_sha256 = store_attachment()
+        except UploadError as e:
+            db.session.rollback()
+            flash(str(e), 'danger')
+            return redirect(url_for('view_record', record_id=record.id))
         record.attachment_filename = new_filename # Store the new filename
         
         # Log history for attachment
@@ -869,18 +3412,160 @@ def attach_file_to_record(record_id):
 
     return redirect(url_for('view_record', record_id=record.id))
 
+@app.errorhandler(RequestEntityTooLarge)
+def request_entity_too_large(e):
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    if request.path.startswith('/upload-sessions'):
+        return upload_json_error(f"El fragmento supera el máximo de {limit_mb} MB por solicitud.", 413)
+    flash(f'La solicitud supera el tamaño máximo de {limit_mb} MB. Vuelva a intentarlo; los archivos grandes '
+          f'se envían por partes automáticamente.', 'danger')
+    return redirect(request.referrer or url_for('dashboard'))
+
+def get_own_upload_session(token):
+    upload_session = db.session.get(UploadSession, token)
+    if upload_session is None or upload_session.user_id != current_user.id:
+        return None
+    return upload_session
+
+@app.route('/upload-sessions', methods=['POST'])
+@login_required
+def create_upload_session():
+    """Starts a chunked upload. JSON body: {"filename": ..., "size": bytes}."""
+    payload = request.get_json(silent=True) or {}
+    filename = secure_filename(str(payload.get('filename') or ''))
+    try:
+        total_size = int(payload.get('size'))
+    except (TypeError, ValueError):
+        total_size = 0
+    if not filename or total_size <= 0:
+        return upload_json_error("Nombre o tamaño de archivo no válido.", 400)
+    if total_size > app.config['UPLOAD_MAX_FILE_BYTES']:
+        return upload_json_error(f"El archivo supera el tamaño máximo permitido "
+                                 f"({app.config['UPLOAD_MAX_FILE_BYTES'] // (1024 * 1024)} MB).", 413)
+
+    upload_session = UploadSession(id=secrets.token_hex(16), user_id=current_user.id, filename=filename,
+                                   total_size=total_size, received_bytes=0)
+    open(upload_session_part_path(upload_session), 'wb').close()
+    db.session.add(upload_session)
+    db.session.commit()
+    return upload_session_json(upload_session, status=201)
+
+@app.route('/upload-sessions/<token>', methods=['GET'])
+@login_required
+def upload_session_status(token):
+    """Current offset of a chunked upload, to resume it after an interruption."""
+    upload_session = get_own_upload_session(token)
+    if upload_session is None:
+        return upload_json_error("Carga no encontrada.", 404)
+    return upload_session_json(upload_session)
+
+@app.route('/upload-sessions/<token>', methods=['PATCH'])
+@login_required
+def upload_session_chunk(token):
+    """
+    Appends the request body at the Upload-Offset header, which must equal the bytes received so far
+    (409 with the current offset otherwise). The body is streamed to disk, never held in memory.
+    """
+    upload_session = get_own_upload_session(token)
+    if upload_session is None:
+        return upload_json_error("Carga no encontrada.", 404)
+    if upload_session.status != 'receiving':
+        return upload_json_error("La carga ya está completa.", 409, offset=upload_session.received_bytes)
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return upload_json_error("Falta el encabezado Upload-Offset.", 400)
+    if offset != upload_session.received_bytes:
+        return upload_json_error("Desplazamiento incorrecto.", 409, offset=upload_session.received_bytes)
+    remaining = upload_session.total_size - offset
+    if request.content_length is not None and request.content_length > remaining:
+        return upload_json_error("El fragmento excede el tamaño declarado del archivo.", 413)
+
+    part_path = upload_session_part_path(upload_session)
+    try:
+        with open(part_path, 'r+b') as part_file:
+            part_file.seek(offset)
+            written = copy_stream_to_file(request.stream, part_file, max_bytes=remaining)
+            part_file.truncate() # Drops bytes left over from an earlier, interrupted attempt at this chunk
+    except UploadError:
+        return upload_json_error("El fragmento excede el tamaño declarado del archivo.", 413)
+    except ClientDisconnected:
+        # The partial chunk is discarded: received_bytes is unchanged and the client resends it
+        return upload_json_error("Fragmento incompleto.", 400, offset=offset)
+
+    # Conditional update: if another request for the same offset got here first, this one lost the race
+    advanced = UploadSession.query.filter_by(id=upload_session.id, received_bytes=offset)\
+                                  .update({'received_bytes': offset + written, 'updated_at': datetime.now(UTC)},
+                                          synchronize_session=False)
+    if not advanced:
+        db.session.rollback()
+        db.session.refresh(upload_session)
+        return upload_json_error("Desplazamiento incorrecto.", 409, offset=upload_session.received_bytes)
+    db.session.refresh(upload_session)
+    if upload_session.received_bytes == upload_session.total_size:
+        upload_session.sha256 = hash_file(part_path)
+        upload_session.status = 'complete'
+    db.session.commit()
+    return upload_session_json(upload_session)
+
+@app.route('/upload-sessions/<token>', methods=['DELETE'])
+@login_required
+def delete_upload_session(token):
+    upload_session = get_own_upload_session(token)
+    if upload_session is None:
+        return upload_json_error("Carga no encontrada.", 404)
+    if upload_session.status != 'consumed' and os.path.exists(upload_session_part_path(upload_session)):
+        os.remove(upload_session_part_path(upload_session))
+    db.session.delete(upload_session)
+    db.session.commit()
+    return Response(status=204)
+
+@app.route('/records/<int:record_id>/attachment')
+@login_required
+def download_record_attachment(record_id):
+    """Serves the record's attachment from the blob store under its human-readable name (?download=true to save it)."""
+    record = Record.query.get_or_404(record_id)
+    if not record.attachment_filename or not record_access().can_view(record):
+        abort(404)
+    as_attachment = request.args.get('download') == 'true'
+    if record.attachment_sha256 and os.path.exists(attachment_blob_path(record.attachment_sha256)):
+        # The content behind a hash never changes, so links carrying it (?v=, see attachment_version)
+        # can be cached for good; the plain URL is revalidated, since a new upload replaces the attachment.
+        blob_folder = os.path.join(app.root_path, app.config['ATTACHMENT_BLOB_FOLDER'])
+        return serve_stored_file('ATTACHMENT_BLOB_FOLDER',
+                                 os.path.relpath(attachment_blob_path(record.attachment_sha256), blob_folder),
+                                 download_name=record.attachment_filename, as_attachment=as_attachment,
+                                 etag=record.attachment_sha256,
+                                 immutable=request.args.get('v') == attachment_version(record))
+    # Attachment from before the blob store that `flask migrate-attachments` has not moved yet
+    return serve_stored_file('UPLOAD_FOLDER', record.attachment_filename, as_attachment=as_attachment)
+
 @app.route('/uploads/<path:filename>')
 @login_required
 def download_file(filename):
-    # This route is for general uploads. We'll add a new one for generated PDFs.
+    # Old attachment links: files still in uploads/ are served from there, migrated ones through their record
     upload_path = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'])
-    return send_from_directory(upload_path, filename, as_attachment=False) # as_attachment=False to display in browser if possible
+    if not os.path.isfile(os.path.join(upload_path, filename)):
+        record = Record.query.filter_by(attachment_filename=filename).first_or_404()
+        return redirect(url_for('download_record_attachment', record_id=record.id, **request.args))
+    return serve_stored_file('UPLOAD_FOLDER', filename) # Inline, to display in the browser if possible
+
+@app.route('/metrics')
+def metrics():
+    # No login: scrapers do not have a session. They send the METRICS_TOKEN instead.
+    expected_token = app.config['METRICS_TOKEN']
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if not app.config['METRICS_ENABLED'] or not expected_token or scheme.lower() != 'bearer' \
+            or not secrets.compare_digest(token.encode(), expected_token.encode()):
+        return Response('Not found\n', status=404, mimetype='text/plain')
+    collect_scrape_time_metrics()
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/generated_pdfs/<path:filename>')
 @login_required
 def download_generated_pdf(filename):
-    upload_path = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'])
-    return send_from_directory(upload_path, filename, as_attachment=False)
+    # Re-rendering keeps the file name, so the browser revalidates (ETag from mtime and size) on every open
+    return serve_stored_file('GENERATED_PDF_FOLDER', filename)
 
 @app.route('/records/<int:record_id>/resend', methods=['POST'])
 @login_required
@@ -889,16 +3574,10 @@ def resend_record(record_id):
 
     # Permission checks:
     # User must be (admin role AND in Intendencia department) OR the main superadmin (username 'admin')
-    is_intendencia_admin = current_user.role == 'admin' and current_user.department == INTENDENCIA_DEPT_NAME # type: ignore
-    if not (is_intendencia_admin or current_user.username == 'admin'):
+    if not can_resend_records(current_user):
         flash('No tiene permisos para realizar esta acción.', 'danger')
         return redirect(url_for('view_record', record_id=record_id))
 
-    # Record must be in 'pending' or 'urgente' status
-    if record_to_resend.status not in ['pending', 'urgente']:
-        flash('Solo los expedientes en estado "pendiente" o "urgente" pueden ser re-enviados.', 'warning')
-        return redirect(url_for('view_record', record_id=record_id))
-
     new_department_id = request.form.get('new_department_id', type=int)
     if not new_department_id:
         flash('Debe seleccionar un nuevo departamento de destino.', 'danger')
@@ -909,63 +3588,22 @@ def resend_record(record_id):
         flash('El departamento de destino seleccionado no es válido.', 'danger')
         return redirect(url_for('view_record', record_id=record_id))
 
-    if new_department_obj.id == record_to_resend.department_id:
-        flash(f'El expediente ya se encuentra en el departamento "{new_department_obj.name}". No se realizaron cambios.', 'info')
-        return redirect(url_for('view_record', record_id=record_id))
-
     try:
-        original_department_name = record_to_resend.department.name
-        leaving_department_obj = record_to_resend.department # Department record is currently in (before update)
-
-        # Store the digital number string as it is BEFORE any changes in this transaction.
-        # This is the number we need to parse for the original date part.
-        current_digital_number_on_record = record_to_resend.digital_number
-
-        # Update department and status first
-        record_to_resend.department_id = new_department_obj.id
-        record_to_resend.status = 'in_progress' # Change status to "En Progreso"
-
-        # Regenerate digital_number based on the new requirement:
-        # Format: LEAVING_DEPT_CODE-ARRIVING_DEPT_CODE-SEQ_NUM-ORIGINAL_DATE_PART
-
-        leaving_dept_code = DEPARTMENT_CODES.get(leaving_department_obj.name, f"DPT{leaving_department_obj.id}")
-        arriving_dept_code = DEPARTMENT_CODES.get(new_department_obj.name, f"DPT{new_department_obj.id}")
-        sequence_number_int = int(record_to_resend.sequence_number)
-
-        current_dn_parts = current_digital_number_on_record.split('-')
-        if len(current_dn_parts) < 5: # Expects at least DEPT-SEQ-DD-MM-YYYY (5 parts)
-            app.logger.error(f"Digital number '{current_digital_number_on_record}' for record {record_to_resend.id} is too short to parse date and sequence.")
-            flash(f"Error: Formato de número digital '{current_digital_number_on_record}' no es válido para extraer fecha y secuencia. No se pudo actualizar el número digital.", "danger")
-            db.session.rollback() # Rollback department/status changes if number can't be formed correctly.
-            return redirect(url_for('view_record', record_id=record_id))
+        leaving_department_obj = resend_record_to_department(record_to_resend, new_department_obj, current_user)
 
-        original_date_part_for_new_number = f"{current_dn_parts[-3]}-{current_dn_parts[-2]}-{current_dn_parts[-1]}"
-
-        new_digital_number_value = f"{leaving_dept_code}-{arriving_dept_code}-{sequence_number_int:04d}-{original_date_part_for_new_number}"
-        record_to_resend.digital_number = new_digital_number_value
-
-        # Log history for resend
-        history_detail = (f"Movido del departamento '{original_department_name}' al departamento '{new_department_obj.name}'. "
-                          f"Nuevo número digital: {new_digital_number_value}. Estado actualizado a 'En Progreso'.")
-        history_entry = RecordHistory(
-            record_id=record_to_resend.id,
-            user_id=current_user.id, # type: ignore
-            action_type="REENVÍO",
-            details=history_detail
-        )
-        db.session.add(history_entry)
-
-        # Regenerate PDF after resend
-        resent_pdf_file = generate_record_pdf(record_to_resend)
+        # Queue the PDF regeneration after resend
+        resent_pdf_file = enqueue_record_pdf(record_to_resend)
         if not resent_pdf_file:
             flash(f'Expediente re-enviado, pero hubo un error al regenerar el PDF asociado.', 'warning')
 
-        # Commit all changes: record data, history, pdf filename
+        # Commit all changes: record data, history, PDF job
         # record.updated_at will be handled by onupdate in the model if not already set by other logic
         db.session.commit() 
 
-
-        flash(f'Expediente (antes en {original_department_name}) re-enviado a "{new_department_obj.name}". Nuevo N°: {record_to_resend.digital_number}. Estado: En Progreso.', 'success')
+        flash(f'Expediente (antes en {leaving_department_obj.name}) re-enviado a "{new_department_obj.name}". Nuevo N°: {record_to_resend.digital_number}. Estado: En Progreso.', 'success')
+    except RecordActionError as e:
+        db.session.rollback()
+        flash(str(e), e.category)
     except Exception as e:
         db.session.rollback()
         app.logger.error(f"Error al re-enviar el expediente {record_id}: {e}", exc_info=True)
@@ -979,11 +3617,7 @@ def add_note_to_record(record_id):
     record = Record.query.get_or_404(record_id)
 
     # Permission check: User must be able to view the record to add a note
-    is_admin = current_user.role == 'admin'
-    is_privileged_viewer = current_user.department in PRIVILEGED_VIEW_DEPARTMENTS
-    can_interact_with_record = is_admin or is_privileged_viewer or (record.department.name == current_user.department)
-
-    if not can_interact_with_record:
+    if not record_access().can_view(record):
         flash('No tiene permisos para agregar notas a este expediente.', 'danger')
         return redirect(url_for('view_record', record_id=record.id))
 
@@ -1010,6 +3644,906 @@ def add_note_to_record(record_id):
     flash('Nota agregada exitosamente.', 'success')
     return redirect(url_for('view_record', record_id=record.id))
 
+# JSON API, version 1: records, their history and notes, and departments, with the same permissions as the
+# HTML routes. Authentication is by API token only (see load_user_from_api_token), never the session cookie.
+# Lists use the keyset cursors of the records listing; ?fields=a,b limits the record fields returned.
+# Batch endpoints apply every item in one transaction: if any item fails nothing is saved (422 with the errors).
+api_v1 = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+def api_datetime(value):
+    if value is None:
+        return None
+    return (value if value.tzinfo else value.replace(tzinfo=UTC)).isoformat()
+
+def api_response(payload, status=200):
+    return Response(json.dumps(payload, ensure_ascii=False), status=status, mimetype='application/json')
+
+def api_error(message, status, **extra):
+    return api_response(dict(extra, error=message), status)
+
+def api_conditional_response(payload, last_modified=None):
+    """200 with an ETag of the body (and Last-Modified when given), or 304 for a matching If-None-Match."""
+    response = api_response(payload)
+    response.add_etag()
+    if last_modified is not None:
+        response.last_modified = last_modified.replace(tzinfo=UTC) if last_modified.tzinfo is None else last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def api_token_required(view):
+    @wraps(view)
+    def wrapped_view(*args, **kwargs):
+        if not current_user.is_authenticated or g.get('api_token') is None:
+            return api_error('Se requiere un token de API válido (Authorization: Bearer <token>).', 401)
+        return view(*args, **kwargs)
+    return wrapped_view
+
+def api_record_attachment(record):
+    if not record.attachment_filename:
+        return None
+    return {'filename': record.attachment_filename, 'size': record.attachment_size, 'sha256': record.attachment_sha256,
+            'url': url_for('download_record_attachment', record_id=record.id, v=attachment_version(record), _external=True)}
+
+# Record field name -> value for the API; ?fields= picks from these
+RECORD_API_FIELDS = {
+    'id': lambda record: record.id,
+    'sequence_number': lambda record: record.sequence_number,
+    'digital_number': lambda record: record.digital_number,
+    'full_name': lambda record: record.full_name,
+    'dni': lambda record: record.dni,
+    'address': lambda record: record.address,
+    'phone': lambda record: record.phone,
+    'email': lambda record: record.email,
+    'description': lambda record: record.description,
+    'status': lambda record: record.status,
+    'transaction_date': lambda record: api_datetime(record.transaction_date),
+    'created_at': lambda record: api_datetime(record.created_at),
+    'updated_at': lambda record: api_datetime(record.updated_at),
+    'department': lambda record: {'id': record.department_id, 'name': record.department.name},
+    'created_by': lambda record: {'id': record.created_by, 'name': record.creator.name},
+    'attachment': api_record_attachment,
+    'pdf_url': lambda record: url_for('download_generated_pdf', filename=record.generated_pdf_filename, _external=True)
+                              if record.generated_pdf_filename else None,
+}
+
+def api_requested_fields():
+    """Record fields asked for with ?fields= (all when absent). Raises ValueError for unknown names."""
+    fields_arg = request.args.get('fields')
+    if not fields_arg:
+        return list(RECORD_API_FIELDS)
+    fields = [name.strip() for name in fields_arg.split(',') if name.strip()]
+    unknown = [name for name in fields if name not in RECORD_API_FIELDS]
+    if unknown:
+        raise ValueError(f"Campos desconocidos: {', '.join(unknown)}. Disponibles: {', '.join(RECORD_API_FIELDS)}.")
+    return fields
+
+def record_to_api(record, fields=None):
+    return {name: RECORD_API_FIELDS[name](record) for name in (fields or RECORD_API_FIELDS)}
+
+def history_entry_to_api(entry):
+    return {'id': entry.id, 'action_type': entry.action_type, 'details': entry.details,
+            'timestamp': api_datetime(entry.timestamp), 'user': {'id': entry.user_id, 'name': entry.user.name}}
+
+def note_to_api(note):
+    return {'id': note.id, 'content': note.content, 'created_at': api_datetime(note.created_at),
+            'author': {'id': note.user_id, 'name': note.author.name}}
+
+def api_visible_record(record_id):
+    """The record if the current user can see it, else None (reported as 404 so ids are not disclosed)."""
+    record = Record.query.options(*record_load_options('detail')).filter(Record.id == record_id).first()
+    return record if record is not None and record_access().can_view(record) else None
+
+def api_batch_items(key):
+    """The list under key in the JSON body, or an error response (checked with isinstance(..., Response))."""
+    payload = request.get_json(silent=True)
+    items = payload.get(key) if isinstance(payload, dict) else None
+    if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+        return api_error(f'El cuerpo debe ser un objeto JSON con una lista no vacía de objetos en "{key}".', 400)
+    if len(items) > app.config['API_BATCH_MAX_ITEMS']:
+        return api_error(f"Como máximo {app.config['API_BATCH_MAX_ITEMS']} elementos por petición.", 413)
+    return items
+
+def api_batch_records(items):
+    """
+    Loads the records named by the "id" of each item in one query. Returns ({id: record}, errors); records the
+    current user cannot see are reported as not found.
+    """
+    errors = []
+    record_ids = []
+    for index, item in enumerate(items):
+        if not isinstance(item.get('id'), int):
+            errors.append({'index': index, 'error': 'Falta el "id" del expediente.'})
+        else:
+            record_ids.append(item['id'])
+    records_by_id = {record.id: record for record in
+                     Record.query.options(*record_load_options('detail')).filter(Record.id.in_(record_ids))}
+    access = record_access()
+    for index, item in enumerate(items):
+        record = records_by_id.get(item.get('id'))
+        if isinstance(item.get('id'), int) and (record is None or not access.can_view(record)):
+            errors.append({'index': index, 'error': f"Expediente {item['id']} no encontrado."})
+    return records_by_id, errors
+
+def api_batch_result(record_ids, status=200):
+    """Commits the batch and returns the records it touched, reloaded in one query, in request order."""
+    db.session.commit()
+    records_by_id = {record.id: record for record in
+                     Record.query.options(*record_load_options('detail')).filter(Record.id.in_(record_ids))}
+    return api_response({'data': [record_to_api(records_by_id[record_id]) for record_id in record_ids]}, status)
+
+@api_v1.errorhandler(404)
+def api_not_found(error):
+    return api_error('No encontrado.', 404)
+
+@api_v1.route('/departments')
+@api_token_required
+def api_departments():
+    return api_conditional_response({'data': [{'id': dept.id, 'name': dept.name, 'description': dept.description,
+                                               'code': dept.code}
+                                              for dept in department_cache.all()]})
+
+@api_v1.route('/records')
+@api_token_required
+def api_records():
+    """Same filters and visibility as /records (department, status, search_term); ?after= / ?before= cursors."""
+    try:
+        fields = api_requested_fields()
+    except ValueError as e:
+        return api_error(str(e), 400)
+    per_page = request.args.get('per_page', default=app.config['RECORDS_PER_PAGE'], type=int)
+    per_page = max(1, min(per_page, app.config['RECORDS_MAX_PER_PAGE']))
+    query, fts_matches, _, _ = build_records_query(request.args.get('department', type=int),
+                                                   request.args.get('status'), request.args.get('search_term'))
+    page_query = query.options(*record_load_options('listing'))
+    cursor_args = dict(after_cursor=request.args.get('after'), before_cursor=request.args.get('before'), per_page=per_page)
+    if fts_matches is not None:
+        rows, next_cursor, prev_cursor = paginate_records_keyset(page_query.add_columns(fts_matches.c.rank),
+                                                                 rank_column=fts_matches.c.rank, **cursor_args)
+        records_list = [row[0] for row in rows]
+    else:
+        records_list, next_cursor, prev_cursor = paginate_records_keyset(page_query, **cursor_args)
+    return api_conditional_response({
+        'data': [record_to_api(record, fields) for record in records_list],
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor,
+    })
+
+@api_v1.route('/records/<int:record_id>')
+@api_token_required
+def api_record(record_id):
+    """One record; ?include=history,notes embeds those. Conditional GET with If-None-Match / If-Modified-Since."""
+    try:
+        fields = api_requested_fields()
+    except ValueError as e:
+        return api_error(str(e), 400)
+    record = api_visible_record(record_id)
+    if record is None:
+        return api_error('Expediente no encontrado.', 404)
+    includes = set(filter(None, request.args.get('include', '').split(',')))
+    payload = record_to_api(record, fields)
+    if 'history' in includes:
+        payload['history'] = [history_entry_to_api(entry) for entry in
+                              record.history_entries.options(joinedload(RecordHistory.user))]
+    if 'notes' in includes:
+        payload['notes'] = [note_to_api(note) for note in record.notes.options(joinedload(Note.author))]
+    # updated_at only covers the record's own columns, so it is not a validator when history or notes are embedded
+    return api_conditional_response({'data': payload}, last_modified=None if includes else record.updated_at)
+
+@api_v1.route('/records/<int:record_id>/history')
+@api_token_required
+def api_record_history(record_id):
+    record = api_visible_record(record_id)
+    if record is None:
+        return api_error('Expediente no encontrado.', 404)
+    entries = record.history_entries.options(joinedload(RecordHistory.user))
+    return api_conditional_response({'data': [history_entry_to_api(entry) for entry in entries]})
+
+@api_v1.route('/records/<int:record_id>/notes')
+@api_token_required
+def api_record_notes(record_id):
+    record = api_visible_record(record_id)
+    if record is None:
+        return api_error('Expediente no encontrado.', 404)
+    notes = record.notes.options(joinedload(Note.author))
+    return api_conditional_response({'data': [note_to_api(note) for note in notes]})
+
+@api_v1.route('/records/batch', methods=['POST'])
+@api_token_required
+def api_records_batch_create():
+    """
+    {"records": [{"full_name", "department_id", "status", "dni", "address", "phone", "email", "description",
+    "transaction_date" (ISO 8601), "sequence_number" (optional, manual)}, ...]} -> 201 with the new records.
+    """
+    items = api_batch_items('records')
+    if isinstance(items, Response):
+        return items
+    can_select_any_department = current_user.role == 'admin'
+
+    errors, prepared = [], []
+    for index, item in enumerate(items):
+        department = department_cache.get(item.get('department_id')) if isinstance(item.get('department_id'), int) else None
+        manual_sequence_number = item.get('sequence_number')
+        transaction_date = error = None
+        if not isinstance(item.get('full_name'), str) or not item['full_name'].strip():
+            error = 'El nombre del solicitante ("full_name") es obligatorio.'
+        elif department is None:
+            error = 'Departamento ("department_id") no válido.'
+        elif not can_select_any_department and department.name != current_user.department:
+            error = 'No tiene permisos para crear expedientes en el departamento seleccionado.'
+        elif item.get('status', 'pending') not in RECORD_STATUS_LABELS:
+            error = f"Estado no válido: \"{item.get('status')}\"."
+        elif manual_sequence_number is not None and not (isinstance(manual_sequence_number, int)
+                                                         and 0 < manual_sequence_number < 10000):
+            error = 'El número de secuencia manual debe ser un número entre 1 y 9999.'
+        elif item.get('transaction_date'):
+            try:
+                transaction_date = datetime.fromisoformat(item['transaction_date'])
+                transaction_date = transaction_date if transaction_date.tzinfo else transaction_date.replace(tzinfo=UTC)
+            except (TypeError, ValueError):
+                error = 'Fecha de trámite ("transaction_date") no válida; use el formato ISO 8601.'
+        if error:
+            errors.append({'index': index, 'error': error})
+            continue
+        prepared.append((index, item, department, manual_sequence_number, transaction_date))
+    if errors:
+        return api_error('No se creó ningún expediente.', 422, errors=errors)
+
+    created_records, history_batch = [], []
+    begin_immediate_transaction() # Sequence numbers for the whole batch are taken under one write lock
+    for index, item, department, manual_sequence_number, transaction_date in prepared:
+        try:
+            new_record = create_record(department, current_user, item['full_name'].strip(),
+                                       manual_sequence_number=manual_sequence_number,
+                                       dni=item.get('dni'), address=item.get('address'), phone=item.get('phone'),
+                                       email=item.get('email'), description=item.get('description'),
+                                       transaction_date=transaction_date, status=item.get('status', 'pending'),
+                                       history_batch=history_batch)
+        except RecordActionError as e:
+            errors.append({'index': index, 'error': str(e)})
+            continue
+        created_records.append(new_record)
+    if errors:
+        db.session.rollback()
+        return api_error('No se creó ningún expediente.', 422, errors=errors)
+    insert_record_history_batch(history_batch)
+    enqueue_record_pdfs(created_records)
+    return api_batch_result([record.id for record in created_records], status=201)
+
+@api_v1.route('/records/batch/status', methods=['POST'])
+@api_token_required
+def api_records_batch_status():
+    """{"changes": [{"id": 1, "status": "archived"}, ...]} -> the records after the change. Admins only."""
+    if current_user.role != 'admin':
+        return api_error('Solo los administradores pueden cambiar el estado de los expedientes.', 403)
+    items = api_batch_items('changes')
+    if isinstance(items, Response):
+        return items
+    begin_immediate_transaction()
+    records_by_id, errors = api_batch_records(items)
+    changed_records, history_batch = [], []
+    for index, item in enumerate(items):
+        record = records_by_id.get(item.get('id'))
+        if record is None:
+            continue
+        try:
+            if change_record_status(record, item.get('status'), current_user, history_batch):
+                changed_records.append(record)
+        except RecordActionError as e:
+            errors.append({'index': index, 'error': str(e)})
+    if errors:
+        db.session.rollback()
+        return api_error('No se modificó ningún expediente.', 422, errors=errors)
+    insert_record_history_batch(history_batch)
+    enqueue_record_pdfs(changed_records)
+    return api_batch_result([item['id'] for item in items])
+
+@api_v1.route('/records/batch/resend', methods=['POST'])
+@api_token_required
+def api_records_batch_resend():
+    """{"changes": [{"id": 1, "department_id": 3}, ...]} -> the records after the resend."""
+    if not can_resend_records(current_user):
+        return api_error('No tiene permisos para re-enviar expedientes.', 403)
+    items = api_batch_items('changes')
+    if isinstance(items, Response):
+        return items
+    departments = {dept.id: dept for dept in Department.query.all()}
+    begin_immediate_transaction()
+    records_by_id, errors = api_batch_records(items)
+    resent_records, history_batch = [], []
+    for index, item in enumerate(items):
+        record = records_by_id.get(item.get('id'))
+        if record is None:
+            continue
+        new_department = departments.get(item.get('department_id'))
+        if new_department is None:
+            errors.append({'index': index, 'error': 'Departamento de destino ("department_id") no válido.'})
+            continue
+        try:
+            resend_record_to_department(record, new_department, current_user, history_batch)
+        except RecordActionError as e:
+            errors.append({'index': index, 'error': str(e)})
+            continue
+        resent_records.append(record)
+    if errors:
+        db.session.rollback()
+        return api_error('No se re-envió ningún expediente.', 422, errors=errors)
+    insert_record_history_batch(history_batch)
+    enqueue_record_pdfs(resent_records)
+    return api_batch_result([item['id'] for item in items])
+
+app.register_blueprint(api_v1)
+
+@app.cli.command('pdf-worker')
+@click.option('--processes', type=int, default=None, help='Procesos de renderizado (por defecto PDF_WORKER_PROCESSES).')
+@click.option('--once', is_flag=True, help='Procesa los trabajos pendientes y termina.')
+def pdf_worker_command(processes, once):
+    """Renders queued expediente PDFs in the background."""
+    processes = app.config['PDF_WORKER_PROCESSES'] if processes is None else processes
+    poll_seconds = app.config['PDF_WORKER_POLL_SECONDS']
+    stale_check_seconds = app.config['PDF_WORKER_STALE_CHECK_SECONDS']
+    ensure_folders_exist()
+    requeue_stale_pdf_jobs()
+    next_stale_check = time.monotonic() + stale_check_seconds
+    print(f"Worker de PDF iniciado ({processes or 'sin'} procesos).")
+
+    if processes == 0:
+        while True:
+            if time.monotonic() >= next_stale_check:
+                requeue_stale_pdf_jobs()
+                next_stale_check = time.monotonic() + stale_check_seconds
+            job_id = claim_next_pdf_job()
+            if job_id is not None:
+                print(f"Trabajo {job_id}: {run_pdf_job(job_id)}")
+            elif once:
+                break
+            else:
+                time.sleep(poll_seconds)
+        return
+
+    pool = ProcessPoolExecutor(max_workers=processes, initializer=init_pdf_worker_process)
+    running = {} # future -> job id
+    try:
+        while True:
+            if time.monotonic() >= next_stale_check:
+                requeue_stale_pdf_jobs()
+                next_stale_check = time.monotonic() + stale_check_seconds
+            pool_broken = False
+            while len(running) < processes and not pool_broken:
+                job_id = claim_next_pdf_job()
+                if job_id is None:
+                    break
+                try:
+                    running[pool.submit(run_pdf_job, job_id)] = job_id
+                except BrokenProcessPool:
+                    release_pdf_job(job_id)
+                    pool_broken = True
+            if not pool_broken:
+                if not running:
+                    if once:
+                        break
+                    time.sleep(poll_seconds)
+                    continue
+                finished, _ = wait(list(running), timeout=poll_seconds, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    job_id = running.pop(future)
+                    try:
+                        print(f"Trabajo {job_id}: {future.result()}")
+                    except Exception as e: # The pool process died or could not run the job
+                        app.logger.error(f"PDF job {job_id} crashed: {e}", exc_info=True)
+                        pool_broken = pool_broken or isinstance(e, BrokenProcessPool)
+                        job = db.session.get(PdfJob, job_id)
+                        if job:
+                            mark_pdf_job_failed(job, str(e))
+                            db.session.commit()
+            if pool_broken:
+                # A pool process died (e.g. OOM-killed) and the pool refuses new work. Once shut down, every job
+                # still in `running` has failed with BrokenProcessPool and is requeued by the wait() above.
+                app.logger.error('PDF worker pool broke; starting a new one.')
+                pool.shutdown(wait=True)
+                pool = ProcessPoolExecutor(max_workers=processes, initializer=init_pdf_worker_process)
+    finally:
+        pool.shutdown(wait=True)
+
+@app.cli.command('create-api-token')
+@click.argument('username')
+@click.option('--name', required=True, help='Integración que usará el token.')
+def create_api_token_command(username, name):
+    """Creates a JSON API token acting as USERNAME and prints it (it cannot be shown again)."""
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        print(f"No existe el usuario '{username}'.")
+        return
+    token = secrets.token_urlsafe(32)
+    api_token = ApiToken(user_id=user.id, name=name, token_sha256=hashlib.sha256(token.encode('utf-8')).hexdigest())
+    db.session.add(api_token)
+    db.session.commit()
+    print(f"Token {api_token.id} para '{username}' ({name}). Guárdelo ahora, no se volverá a mostrar:")
+    print(token)
+
+@app.cli.command('revoke-api-token')
+@click.argument('token_id', type=int)
+def revoke_api_token_command(token_id):
+    """Revokes an API token by id."""
+    api_token = db.session.get(ApiToken, token_id)
+    if not api_token or api_token.revoked_at:
+        print(f"No hay un token activo con id {token_id}.")
+        return
+    api_token.revoked_at = datetime.now(UTC)
+    db.session.commit()
+    print(f"Token {token_id} ({api_token.name}) revocado.")
+
+@app.cli.command('reserve-sequence-numbers')
+@click.option('--count', type=int, default=0, help='Reserva los próximos N números automáticos.')
+@click.option('--number', 'numbers', type=int, multiple=True, help='Reserva un número concreto (se puede repetir).')
+@click.option('--note', default=None, help='Motivo de la reserva.')
+def reserve_sequence_numbers_command(count, numbers, note):
+    """Sets sequence numbers aside for manual entry in add_record."""
+    reserved = []
+    for _ in range(count):
+        sequence_number = allocate_sequence_number()
+        db.session.add(SequenceReservation(sequence_number=sequence_number, note=note))
+        reserved.append(sequence_number)
+    if numbers:
+        begin_immediate_transaction()
+    for sequence_number in numbers:
+        if is_sequence_number_taken(sequence_number):
+            print(f"El número {sequence_number:04d} ya está en uso o reservado; se omite.")
+            continue
+        db.session.add(SequenceReservation(sequence_number=sequence_number, note=note))
+        db.session.flush()
+        reserved.append(sequence_number)
+    db.session.commit()
+    print(f"Números reservados: {', '.join(f'{n:04d}' for n in reserved) or 'ninguno'}")
+
+@app.cli.command('release-sequence-number')
+@click.argument('sequence_number', type=int)
+def release_sequence_number_command(sequence_number):
+    """Removes an unused reservation."""
+    reservation = db.session.get(SequenceReservation, sequence_number)
+    if not reservation:
+        print(f"El número {sequence_number:04d} no está reservado.")
+    elif reservation.record_id:
+        print(f"El número {sequence_number:04d} ya fue usado por el expediente {reservation.record_id}.")
+    else:
+        db.session.delete(reservation)
+        db.session.commit()
+        print(f"Reserva del número {sequence_number:04d} liberada.")
+
+@app.cli.command('cleanup-uploads')
+def cleanup_uploads_command():
+    """Removes abandoned chunked uploads and leftover temp files older than UPLOAD_SESSION_MAX_AGE_HOURS."""
+    ensure_folders_exist()
+    cutoff = datetime.now(UTC) - timedelta(hours=app.config['UPLOAD_SESSION_MAX_AGE_HOURS'])
+    removed_sessions = 0
+    for upload_session in UploadSession.query.filter(UploadSession.updated_at < cutoff).all():
+        if upload_session.status != 'consumed' and os.path.exists(upload_session_part_path(upload_session)):
+            os.remove(upload_session_part_path(upload_session))
+        db.session.delete(upload_session)
+        removed_sessions += 1
+    db.session.commit()
+
+    # Temp files of form uploads interrupted by a crash, and part files without a session
+    live_part_files = {f'{token}.part' for (token,) in db.session.query(UploadSession.id)}
+    removed_files = 0
+    for name in os.listdir(upload_temp_path()):
+        path = upload_temp_path(name)
+        if name not in live_part_files and os.path.getmtime(path) < cutoff.timestamp():
+            os.remove(path)
+            removed_files += 1
+    print(f"Cargas eliminadas: {removed_sessions}. Archivos temporales eliminados: {removed_files}.")
+
+@app.cli.command('prune-record-changes')
+def prune_record_changes_command():
+    """Deletes change log rows (live updates) older than RECORD_CHANGE_RETENTION_HOURS."""
+    cutoff = datetime.now(UTC) - timedelta(hours=app.config['RECORD_CHANGE_RETENTION_HOURS'])
+    deleted = RecordChange.query.filter(RecordChange.created_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    print(f"Cambios eliminados del registro de actualizaciones: {deleted}.")
+
+@app.cli.command('migrate-attachments')
+@click.option('--batch-size', type=int, default=200, show_default=True)
+def migrate_attachments_command(batch_size):
+    """Moves the attachments still in uploads/ into the blob store (idempotent)."""
+    ensure_folders_exist()
+    upload_path = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'])
+    record_ids = [record_id for (record_id,) in db.session.query(Record.id)
+                                                   .filter(Record.attachment_filename.isnot(None))
+                                                   .order_by(Record.id)]
+    moved = {} # uploads/ filename -> (sha256, size), for files shared by several records
+    migrated = missing = 0
+    for batch_start in range(0, len(record_ids), batch_size):
+        batch = Record.query.filter(Record.id.in_(record_ids[batch_start:batch_start + batch_size])).all()
+        for record in batch:
+            if record.attachment_sha256 and os.path.exists(attachment_blob_path(record.attachment_sha256)):
+                continue
+            source_path = os.path.join(upload_path, record.attachment_filename)
+            if record.attachment_filename not in moved:
+                if not os.path.isfile(source_path):
+                    print(f"Expediente {record.id}: no se encontró el archivo '{record.attachment_filename}'.")
+                    missing += 1
+                    continue
+                sha256 = hash_file(source_path)
+                size = os.path.getsize(source_path)
+                put_attachment_blob(source_path, sha256, size)
+                moved[record.attachment_filename] = (sha256, size)
+            record.attachment_sha256, record.attachment_size = moved[record.attachment_filename]
+            migrated += 1
+        db.session.commit()
+    # Records that already had a hash (uploaded before the blob store) were not counted by the flush hook
+    rebuild_attachment_blob_ref_counts()
+    print(f"Adjuntos migrados: {migrated} ({len(moved)} archivos distintos). Archivos faltantes: {missing}.")
+
+@app.cli.command('gc-attachments')
+@click.option('--dry-run', is_flag=True, help='Sólo informa qué se eliminaría.')
+@click.option('--recount', is_flag=True, help='Recalcula las referencias desde la tabla de expedientes antes.')
+def gc_attachments_command(dry_run, recount):
+    """
+    Deletes attachment blobs without references since before ATTACHMENT_GC_GRACE_HOURS, and blob files older than
+    that with no AttachmentBlob row (left behind by a transaction that rolled back after put_attachment_blob).
+    """
+    if recount:
+        rebuild_attachment_blob_ref_counts()
+    cutoff = datetime.now(UTC) - timedelta(hours=app.config['ATTACHMENT_GC_GRACE_HOURS'])
+    begin_immediate_transaction() # No record can start pointing at a candidate while it is checked and deleted
+    candidates = AttachmentBlob.query.filter(AttachmentBlob.ref_count <= 0, AttachmentBlob.unreferenced_at < cutoff).all()
+    known_hashes = {sha256 for sha256, in db.session.query(AttachmentBlob.sha256)} # Before deleting any candidate
+    deleted_paths, freed_bytes = [], 0
+    for blob in candidates:
+        blob_path = attachment_blob_path(blob.sha256)
+        if db.session.query(Record.id).filter(Record.attachment_sha256 == blob.sha256).first():
+            continue # Stale count (e.g. bulk import); --recount fixes it
+        if os.path.exists(blob_path) and os.path.getmtime(blob_path) >= cutoff.timestamp():
+            continue # Being attached again right now (put_attachment_blob refreshes the mtime)
+        deleted_paths.append(blob_path)
+        freed_bytes += blob.size
+        if not dry_run:
+            db.session.delete(blob)
+    orphan_paths, orphan_bytes = [], 0
+    for dirpath, _, filenames in os.walk(os.path.join(app.root_path, app.config['ATTACHMENT_BLOB_FOLDER'])):
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            if filename in known_hashes or os.path.getmtime(file_path) >= cutoff.timestamp():
+                continue # Has its row, or its row may still be about to commit
+            orphan_paths.append(file_path)
+            orphan_bytes += os.path.getsize(file_path)
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.commit()
+        for blob_path in deleted_paths + orphan_paths:
+            if os.path.exists(blob_path):
+                os.remove(blob_path)
+    action = 'Se eliminarían' if dry_run else 'Eliminados'
+    print(f"{action} {len(deleted_paths)} adjuntos sin referencias ({freed_bytes / (1024 * 1024):.1f} MB) "
+          f"y {len(orphan_paths)} ficheros sin registro ({orphan_bytes / (1024 * 1024):.1f} MB).")
+
+# Bulk import (`flask import-records`). Rows of a CSV (with header) or JSONL file are validated, numbered with the
+# add_record rules (allocate_sequence_numbers, DEPT-SEQ-DD-MM-YYYY) and inserted with one executemany per batch of
+# records and one of CREACIÓN history entries. Each batch commits together with its ImportRun progress, so an
+# interrupted import of the same file continues after the last committed row. Core inserts skip the before_flush
+# hooks: the department counters and attachment references are updated here; the FTS triggers still index the rows.
+IMPORT_FIELDS = ('full_name', 'dni', 'address', 'phone', 'email', 'description', 'status', 'transaction_date',
+                 'created_at', 'department', 'attachment')
+# Headers of the spreadsheet export, so an exported CSV can be imported again (numbers are assigned anew)
+IMPORT_FIELD_ALIASES = {'Solicitante': 'full_name', 'DNI': 'dni', 'Dirección': 'address', 'Teléfono': 'phone',
+                        'Email': 'email', 'Descripción': 'description', 'Estado': 'status',
+                        'Fecha de trámite': 'transaction_date', 'Creado': 'created_at', 'Departamento': 'department',
+                        'Adjunto': 'attachment'}
+IMPORT_TEXT_FIELDS = ('full_name', 'dni', 'address', 'phone', 'email', 'description')
+
+def read_import_rows(path, file_format, delimiter=None):
+    """Yields the rows of a CSV or JSONL file as dicts (None for a JSONL line that is not an object)."""
+    if file_format == 'jsonl':
+        with open(path, encoding='utf-8-sig') as source:
+            for line in source:
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+                yield row if isinstance(row, dict) else None
+    else:
+        with open(path, encoding='utf-8-sig', newline='') as source:
+            if delimiter is None: # The exports use ';', other tools ','
+                header_line = source.readline()
+                source.seek(0)
+                delimiter = ';' if header_line.count(';') > header_line.count(',') else ','
+            yield from csv.DictReader(source, delimiter=delimiter)
+
+def parse_import_datetime(value):
+    """DD/MM/YYYY [HH:MM] or ISO 8601 (as in the exports) to a UTC datetime, None if empty. Raises ValueError."""
+    value = str(value or '').strip()
+    if not value:
+        return None
+    for date_format in (APP_WIDE_DATETIME_FORMAT, '%d/%m/%Y'):
+        try:
+            return datetime.strptime(value, date_format).replace(tzinfo=UTC)
+        except ValueError:
+            pass
+    parsed = datetime.fromisoformat(value)
+    return parsed.astimezone(UTC) if parsed.tzinfo else parsed.replace(tzinfo=UTC)
+
+def validate_import_row(row, departments_by_key, attachments_dir, default_status):
+    """Record values of an import row, plus 'department' (id, name) and 'attachment_path'. ValueError with the reason."""
+    if row is None:
+        raise ValueError('La línea no es un objeto JSON válido.')
+    values = {}
+    for key, value in row.items():
+        field = IMPORT_FIELD_ALIASES.get(key, key)
+        if field in IMPORT_FIELDS and value not in (None, ''):
+            values[field] = value.strip() if isinstance(value, str) else value
+    for field in IMPORT_TEXT_FIELDS:
+        if field in values:
+            values[field] = str(values[field])
+            max_length = Record.__table__.c[field].type.length
+            if max_length and len(values[field]) > max_length:
+                raise ValueError(f"El campo {field} supera los {max_length} caracteres.")
+    if not values.get('full_name'):
+        raise ValueError('Falta el nombre del solicitante (full_name).')
+
+    department_key = str(values.pop('department', '')).strip()
+    department = departments_by_key.get(department_key.lower())
+    if not department:
+        raise ValueError(f"Departamento desconocido: '{department_key}'.")
+    status = str(values.get('status') or default_status)
+    status = {label.lower(): key for key, label in RECORD_STATUS_LABELS.items()}.get(status.lower(), status)
+    if status not in RECORD_STATUS_LABELS:
+        raise ValueError(f"Estado no válido: '{status}'.")
+    values['status'] = status
+    for field in ('transaction_date', 'created_at'):
+        try:
+            values[field] = parse_import_datetime(values.get(field))
+        except ValueError:
+            raise ValueError(f"Fecha no válida en {field}: '{values.get(field)}'.")
+
+    attachment = values.pop('attachment', None)
+    attachment_path = None
+    if attachment:
+        if not attachments_dir:
+            raise ValueError('La fila tiene un adjunto pero no se indicó --attachments-dir.')
+        attachment_path = safe_join(attachments_dir, str(attachment))
+        if attachment_path is None or not os.path.isfile(attachment_path):
+            raise ValueError(f"No se encontró el adjunto '{attachment}'.")
+    return dict(values, department=department, attachment_path=attachment_path)
+
+def import_records_batch(rows, user_id, departments_by_key, attachments_dir, default_status, source_name,
+                         queue_pdfs=False, dry_run=False):
+    """
+    Validates and inserts one batch of (row number, row) in the current transaction (not committed).
+    Returns (records created, rejected rows as {'fila', 'error', 'datos'}).
+    """
+    valid, rejected = [], []
+    for row_number, row in rows:
+        try:
+            values = validate_import_row(row, departments_by_key, attachments_dir, default_status)
+            if values['attachment_path'] and not dry_run:
+                with open(values['attachment_path'], 'rb') as attachment_file:
+                    values['attachment_size'], values['attachment_sha256'] = \
+                        store_attachment_stream(attachment_file, 'import-')
+        except (ValueError, UploadError) as e:
+            rejected.append({'fila': row_number, 'error': str(e), 'datos': row})
+            continue
+        valid.append(values)
+    if dry_run or not valid:
+        return len(valid), rejected
+
+    now = datetime.now(UTC)
+    record_rows, history_details, count_deltas, blob_deltas = [], {}, {}, {}
+    for values, sequence_number in zip(valid, allocate_sequence_numbers(len(valid))):
+        department_id, department_name = values['department']
+        dept_code = DEPARTMENT_CODES.get(department_name, f"DPT{department_id}")
+        created_at = values['created_at'] or now
+        date_str = created_at.strftime('%d-%m-%Y')
+        digital_number = f"{dept_code}-{sequence_number:04d}-{date_str}"
+        attachment_filename = None
+        if values['attachment_path']:
+            _, ext_part = os.path.splitext(values['attachment_path'])
+            solicitante_name_part = secure_filename(values['full_name'].replace(" ", "_").lower())
+            attachment_filename = f"{dept_code}-{sequence_number:04d}-{solicitante_name_part}-{date_str}{ext_part}"
+            blob_deltas[values['attachment_sha256']] = blob_deltas.get(values['attachment_sha256'], 0) + 1
+        # Every row has the same keys, so the batch goes out as a single executemany
+        record_rows.append({
+            'sequence_number': sequence_number, 'digital_number': digital_number, 'full_name': values['full_name'],
+            'dni': values.get('dni'), 'address': values.get('address'), 'phone': values.get('phone'),
+            'email': values.get('email'), 'description': values.get('description'),
+            'transaction_date': values['transaction_date'], 'status': values['status'],
+            'attachment_filename': attachment_filename, 'attachment_sha256': values.get('attachment_sha256'),
+            'attachment_size': values.get('attachment_size'), 'created_at': created_at, 'updated_at': created_at,
+            'department_id': department_id, 'created_by': user_id,
+        })
+        history_details[digital_number] = (created_at, department_name)
+        count_key = (department_id, values['status'])
+        count_deltas[count_key] = count_deltas.get(count_key, 0) + 1
+
+    db.session.execute(insert(Record), record_rows)
+    record_ids = dict(db.session.query(Record.digital_number, Record.id)
+                                .filter(Record.digital_number.in_(list(history_details))))
+    insert_record_history_batch([
+        {'record_id': record_ids[digital_number], 'user_id': user_id, 'timestamp': created_at,
+         'action_type': "CREACIÓN",
+         'details': f"Expediente iniciado en el departamento {department_name}. Importado desde {source_name}."}
+        for digital_number, (created_at, department_name) in history_details.items()])
+    apply_department_record_count_deltas(db.session.connection(), count_deltas)
+    apply_attachment_blob_ref_deltas(db.session.connection(), blob_deltas)
+    bump_record_versions(db.session.connection(), [department_id for department_id, _ in count_deltas])
+    insert_record_changes(db.session.connection(), [
+        {'record_id': record_ids[record_row['digital_number']], 'event': 'record-created',
+         'department_id': record_row['department_id'], 'previous_department_id': None, 'status': record_row['status']}
+        for record_row in record_rows])
+    if queue_pdfs:
+        enqueue_record_pdfs(Record.query.filter(Record.id.in_(list(record_ids.values()))).all())
+    return len(record_rows), rejected
+
+@app.cli.command('import-records')
+@click.argument('source', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'jsonl']), default=None,
+              help='Por defecto, según la extensión del archivo.')
+@click.option('--delimiter', default=None, help='Separador del CSV (por defecto se detecta entre "," y ";").')
+@click.option('--batch-size', type=int, default=500, show_default=True)
+@click.option('--user', 'username', default='admin', show_default=True, help='Usuario que figura como creador.')
+@click.option('--default-status', type=click.Choice(list(RECORD_STATUS_LABELS)), default='pending', show_default=True,
+              help='Estado de las filas que no lo indican.')
+@click.option('--attachments-dir', type=click.Path(exists=True, file_okay=False), default=None,
+              help='Carpeta de los archivos indicados en la columna attachment.')
+@click.option('--queue-pdfs', is_flag=True, help='Encola el PDF de cada expediente importado.')
+@click.option('--dry-run', is_flag=True, help='Sólo valida las filas; no modifica la base de datos.')
+@click.option('--force', is_flag=True, help='Importa de nuevo un archivo que ya se importó completo.')
+def import_records_command(source, file_format, delimiter, batch_size, username, default_status, attachments_dir,
+                           queue_pdfs, dry_run, force):
+    """Bulk-imports records from a CSV or JSONL file. An interrupted import of the same file is resumed."""
+    ensure_folders_exist()
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        print(f"No existe el usuario '{username}'.")
+        return
+    file_format = file_format or ('jsonl' if source.lower().endswith(('.jsonl', '.ndjson')) else 'csv')
+    source_name = os.path.basename(source)
+    departments_by_key = {}
+    for department in department_cache.all():
+        departments_by_key[department.name.lower()] = (department.id, department.name)
+        departments_by_key[department.code.lower()] = (department.id, department.name)
+
+    import_run, skip_rows = None, 0
+    if not dry_run:
+        source_sha256 = hash_file(source)
+        import_run = ImportRun.query.filter_by(source_sha256=source_sha256).order_by(ImportRun.id.desc()).first()
+        if import_run and import_run.status == 'finished' and not force:
+            print(f"Este archivo ya se importó (importación {import_run.id}: {import_run.records_created} expedientes). "
+                  "Use --force para importarlo de nuevo.")
+            return
+        if import_run and import_run.status == 'running':
+            skip_rows = import_run.rows_done
+            print(f"Reanudando la importación {import_run.id} desde la fila {skip_rows + 1}.")
+        else:
+            import_run = ImportRun(source_name=source_name, source_sha256=source_sha256)
+            db.session.add(import_run)
+            db.session.commit()
+    rejects_path = source + '.rechazos.jsonl'
+    if not skip_rows and os.path.exists(rejects_path):
+        os.remove(rejects_path)
+
+    user_id, started = user.id, time.perf_counter()
+    totals = {'rows': 0, 'created': 0, 'rejected': 0}
+
+    def process(batch):
+        created, rejected = import_records_batch(batch, user_id, departments_by_key, attachments_dir, default_status,
+                                                 source_name, queue_pdfs=queue_pdfs, dry_run=dry_run)
+        if import_run:
+            import_run.rows_done += len(batch)
+            import_run.records_created += created
+            import_run.rows_rejected += len(rejected)
+            import_run.updated_at = datetime.now(UTC)
+            db.session.commit()
+        if rejected: # Written after the commit, so a resumed import does not repeat them
+            with open(rejects_path, 'a', encoding='utf-8') as rejects_file:
+                for entry in rejected:
+                    rejects_file.write(json.dumps(entry, ensure_ascii=False, default=str) + '\n')
+        totals['rows'] += len(batch)
+        totals['created'] += created
+        totals['rejected'] += len(rejected)
+        elapsed = time.perf_counter() - started
+        print(f"  Fila {skip_rows + totals['rows']}: {totals['created']} expedientes, {totals['rejected']} rechazadas "
+              f"({totals['rows'] / elapsed:.0f} filas/s)")
+
+    batch = []
+    for row_number, row in enumerate(read_import_rows(source, file_format, delimiter), start=1):
+        if row_number <= skip_rows:
+            continue
+        batch.append((row_number, row))
+        if len(batch) >= batch_size:
+            process(batch)
+            batch = []
+    if batch:
+        process(batch)
+
+    if import_run:
+        import_run.status = 'finished'
+        import_run.finished_at = datetime.now(UTC)
+        db.session.commit()
+    elapsed = time.perf_counter() - started
+    action = 'Validación terminada' if dry_run else f"Importación {import_run.id} terminada"
+    print(f"{action}: {totals['created']} expedientes {'válidos' if dry_run else 'creados'}, "
+          f"{totals['rejected']} filas rechazadas. {totals['rows']} filas en {elapsed:.1f} s "
+          f"({totals['rows'] / elapsed if elapsed else 0:.0f} filas/s).")
+    if skip_rows:
+        print(f"Total de la importación: {import_run.records_created} expedientes creados, "
+              f"{import_run.rows_rejected} filas rechazadas.")
+    if totals['rejected']:
+        print(f"Filas rechazadas en {rejects_path}")
+
+@app.cli.command('export-pdfs')
+@click.option('--format', 'export_format', type=click.Choice(['zip', 'pdf']), default='zip', help='ZIP con un PDF por expediente o un único PDF.')
+@click.option('--department', 'department_name', default=None, help='Nombre del departamento.')
+@click.option('--status', default=None, help='Estado de los expedientes (pending, urgente, ...).')
+@click.option('--from', 'date_from', default=None, help='Creados desde (AAAA-MM-DD).')
+@click.option('--to', 'date_to', default=None, help='Creados hasta, inclusive (AAAA-MM-DD).')
+@click.option('--processes', type=int, default=None, help='Procesos de renderizado (por defecto BULK_EXPORT_PROCESSES).')
+@click.option('--output', required=True, type=click.Path(dir_okay=False), help='Archivo de salida.')
+def export_pdfs_command(export_format, department_name, status, date_from, date_to, processes, output):
+    """Exports the PDFs of many expedientes at once, for audits."""
+    department_id = None
+    if department_name:
+        department_obj = Department.query.filter_by(name=department_name).first()
+        if not department_obj:
+            raise click.BadParameter(f"No existe el departamento '{department_name}'.", param_hint='--department')
+        department_id = department_obj.id
+    try:
+        query = bulk_export_records_query(department_id, status, parse_export_date(date_from), parse_export_date(date_to))
+    except ValueError:
+        raise click.BadParameter('Las fechas deben tener el formato AAAA-MM-DD.')
+    processes = app.config['BULK_EXPORT_PROCESSES'] if processes is None else processes
+    batch_size = app.config['BULK_EXPORT_BATCH_SIZE']
+
+    start = time.perf_counter()
+    if export_format == 'pdf':
+        with open(output, 'wb') as output_file:
+            page_count = write_records_combined_pdf(query, batch_size, 'http://localhost/', output_file)
+        print(f"PDF con {page_count} páginas escrito en {output} ({time.perf_counter() - start:.1f} s).")
+    else:
+        with open(output, 'wb') as output_file:
+            for chunk in stream_records_pdf_zip(query, batch_size, processes, 'http://localhost/'):
+                output_file.write(chunk)
+        with zipfile.ZipFile(output) as written_zip:
+            print(f"ZIP con {len(written_zip.namelist())} PDFs escrito en {output} ({time.perf_counter() - start:.1f} s).")
+
+@app.cli.command('pdf-stats')
+def pdf_stats_command():
+    """Shows how many PDF jobs were rendered, skipped because nothing printed had changed, or failed."""
+    finished_jobs = dict(db.session.query(PdfJob.render_skipped, func.count(PdfJob.id))
+                                   .filter(PdfJob.status == 'done').group_by(PdfJob.render_skipped).all())
+    rendered = finished_jobs.get(False, 0) + finished_jobs.get(None, 0)
+    skipped = finished_jobs.get(True, 0)
+    failed = PdfJob.query.filter_by(status='failed').count()
+    pending = PdfJob.query.filter(PdfJob.status.in_(['queued', 'rendering'])).count()
+    total_done = rendered + skipped
+    skipped_ratio = (skipped / total_done * 100) if total_done else 0
+    print(f"Renderizados: {rendered}  Omitidos (sin cambios): {skipped} ({skipped_ratio:.1f}%)  "
+          f"Fallidos: {failed}  Pendientes: {pending}")
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Creates the FTS5 search index and its triggers, refilling it from the record table."""
+    if setup_record_fts():
+        print("Índice de búsqueda listo.")
+    else:
+        print("FTS5 no está disponible en esta versión de SQLite; se usará la búsqueda simple.")
+
+@app.cli.command('rebuild-record-counts')
+def rebuild_record_counts_command():
+    """Recomputes the per-department record counters from the record table."""
+    rebuild_department_record_counts()
+    print(f"Contadores recalculados: {DepartmentRecordCount.query.count()} filas.")
+
+@app.cli.command('flush-caches')
+def flush_caches_command():
+    """Makes every worker process reload its in-process caches (e.g. after editing departments by hand in SQL)."""
+    bump_cache_generation(db.session.connection(), DepartmentCache.GENERATION)
+    bump_cache_generation(db.session.connection(), UserCache.GENERATION)
+    db.session.commit()
+    print(f"Cachés invalidadas en todos los procesos (en menos de {app.config['CACHE_GENERATION_CHECK_SECONDS']} s).")
+
 if __name__ == '__main__':
     # It's good practice to ensure tables are created.
     # The @app.before_first_request decorator is deprecated.
@@ -0,0 +1,52 @@
+import argparse
+
+from sqlalchemy import text
+
+from app import app, db, Record, create_missing_indexes, upgrade_schema_columns, SQLITE_PROFILES
+
+# Consultas representativas de records(), dashboard(), el asignador de números y view_record,
+# para comprobar con EXPLAIN QUERY PLAN que usan los índices
+QUERY_PLAN_CHECKS = {
+    'Listado (todos)': "SELECT id FROM record ORDER BY created_at DESC, id DESC LIMIT 51",
+    'Listado (departamento)': "SELECT id FROM record WHERE department_id = 1 ORDER BY created_at DESC, id DESC LIMIT 51",
+    'Listado (estado)': "SELECT id FROM record WHERE status = 'pending' ORDER BY created_at DESC, id DESC LIMIT 51",
+    'Listado (departamento y estado)': "SELECT id FROM record WHERE department_id = 1 AND status = 'pending' "
+                                       "ORDER BY created_at DESC, id DESC LIMIT 51",
+    'Número de secuencia': "SELECT id FROM record WHERE sequence_number = 1 LIMIT 1",
+    'Historial de un expediente': "SELECT id FROM record_history WHERE record_id = 1 ORDER BY timestamp DESC",
+    'Notas de un expediente': "SELECT id FROM note WHERE record_id = 1 ORDER BY created_at DESC",
+}
+
+def apply_tuning(show_plans):
+    """
+    Aplica a una base de datos existente las tablas, columnas e índices declarados en los modelos y el perfil
+    de SQLite configurado (el modo WAL queda guardado en el archivo), y actualiza las
+    estadísticas del planificador con ANALYZE.
+    """
+    with app.app_context():
+        db.create_all() # Tablas nuevas (con sus índices) que la base todavía no tenga
+        upgrade_schema_columns()
+        created = create_missing_indexes()
+        print(f"Índices creados: {', '.join(created) if created else 'ninguno (ya existían todos)'}")
+
+        # La conexión ya tiene aplicado el perfil (evento 'connect' en app.py); se muestran los valores efectivos
+        profile_name = app.config['SQLITE_PROFILE']
+        print(f"Perfil de SQLite: {profile_name}")
+        for pragma_name in SQLITE_PROFILES[profile_name]:
+            value = db.session.execute(text(f"PRAGMA {pragma_name}")).scalar()
+            print(f"  {pragma_name} = {value}")
+
+        db.session.execute(text("ANALYZE"))
+        db.session.commit()
+        print(f"ANALYZE completado ({Record.query.count()} expedientes).")
+
+        if show_plans:
+            for label, sql in QUERY_PLAN_CHECKS.items():
+                plan = db.session.execute(text(f"EXPLAIN QUERY PLAN {sql}")).all()
+                print(f"{label}: {' | '.join(row[-1] for row in plan)}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Aplica índices y ajustes de SQLite a una base de datos existente.')
+    parser.add_argument('--plans', action='store_true', help='Muestra el plan de las consultas principales.')
+    args = parser.parse_args()
+    apply_tuning(args.plans)
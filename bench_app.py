@@ -0,0 +1,153 @@
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, UTC
+
+from sqlalchemy import event
+
+from app import app, db, Record, Department, encode_records_cursor
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def peak_rss_kib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # KiB en Linux
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class StatementCounter:
+    """Cuenta las sentencias SQL emitidas por el proceso (el cliente de pruebas corre en el mismo hilo)."""
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+def build_scenarios(sample_size, include_writes):
+    """
+    Escenarios: nombre -> función que devuelve la petición (método, URL, datos) a ejecutar en cada
+    iteración. Los IDs, cursores y términos de búsqueda se eligen al azar de una muestra de la base.
+    """
+    total_records = Record.query.count()
+    sample = Record.query.order_by(db.func.random()).limit(sample_size).all()
+    if not sample:
+        raise SystemExit("No hay expedientes en la base de datos. Ejecute seed_db.py primero.")
+    department_ids = [dept.id for dept in Department.query.all()]
+    search_words = [word for record in sample for word in record.full_name.split() if len(word) > 3]
+
+    def deep_page_request():
+        # Página profunda: el cursor de un expediente al azar, como si se hubiera avanzado hasta él
+        record = random.choice(sample)
+        return 'GET', '/records?after=' + encode_records_cursor(record.created_at, record.id), None
+
+    scenarios = {
+        'records': lambda: ('GET', '/records', None),
+        'records_department': lambda: ('GET', f'/records?department={random.choice(department_ids)}', None),
+        'records_status': lambda: ('GET', '/records?status=pending', None),
+        'records_deep_page': deep_page_request,
+        'search': lambda: ('GET', f'/records?search_term={random.choice(search_words)}', None),
+        'dashboard': lambda: ('GET', '/dashboard', None),
+        'record_detail': lambda: ('GET', f'/records/{random.choice(sample).id}', None),
+    }
+    if include_writes:
+        scenarios['add_record'] = lambda: ('POST', '/records/add', {
+            'full_name': 'Benchmark', 'department_id': random.choice(department_ids), 'status': 'pending'})
+    return scenarios, total_records
+
+def run_scenario(client, counter, request_factory, iterations, warmup):
+    latencies_ms, statements, statuses = [], [], {}
+    for i in range(warmup + iterations):
+        method, url, data = request_factory()
+        counter.count = 0
+        start = time.perf_counter()
+        response = client.open(url, method=method, data=data)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if i < warmup:
+            continue
+        latencies_ms.append(elapsed_ms)
+        statements.append(counter.count)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+    latencies_ms.sort()
+    return {
+        'requests': iterations,
+        'p50_ms': round(percentile(latencies_ms, 0.50), 2),
+        'p95_ms': round(percentile(latencies_ms, 0.95), 2),
+        'p99_ms': round(percentile(latencies_ms, 0.99), 2),
+        'max_ms': round(latencies_ms[-1], 2),
+        'queries_per_request': round(sum(statements) / len(statements), 2),
+        'max_queries': max(statements),
+        'status_codes': statuses,
+        'peak_rss_kib': peak_rss_kib(),
+    }
+
+def run_benchmark(iterations, warmup, username, password, only, include_writes, sample_size):
+    """
+    Ejecuta cada escenario con el cliente de pruebas de Flask contra la base configurada
+    (MUNICIPAL_DATABASE_URI) y devuelve los resultados como un dict serializable a JSON.
+    add_record crea expedientes de verdad: use --no-writes sobre una base que no quiera modificar.
+    """
+    with app.app_context():
+        scenarios, total_records = build_scenarios(sample_size, include_writes)
+        counter = StatementCounter(db.engine)
+
+    client = app.test_client()
+    login = client.post('/login', data={'username': username, 'password': password})
+    if login.status_code != 302:
+        raise SystemExit(f"No se pudo iniciar sesión como '{username}'.")
+
+    results = {}
+    for name, request_factory in scenarios.items():
+        if only and name not in only:
+            continue
+        print(f"  {name}...", file=sys.stderr)
+        results[name] = run_scenario(client, counter, request_factory, iterations, warmup)
+
+    return {
+        'timestamp': datetime.now(UTC).isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'database_uri': app.config['SQLALCHEMY_DATABASE_URI'],
+        'sqlite_profile': app.config.get('SQLITE_PROFILE'),
+        'records_in_db': total_records,
+        'user': username,
+        'iterations': iterations,
+        'peak_rss_kib': peak_rss_kib(),
+        'scenarios': results,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark de las rutas principales con el cliente de pruebas de Flask.')
+    parser.add_argument('--iterations', type=int, default=100, help='Peticiones medidas por escenario.')
+    parser.add_argument('--warmup', type=int, default=5, help='Peticiones previas no medidas por escenario.')
+    parser.add_argument('--user', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--scenario', action='append', default=[], help='Ejecuta sólo este escenario (se puede repetir).')
+    parser.add_argument('--no-writes', action='store_true', help='Omite add_record.')
+    parser.add_argument('--sample', type=int, default=500, help='Expedientes de muestra para IDs, cursores y búsquedas.')
+    parser.add_argument('--output', default=None, help='Archivo JSON de salida (por defecto, la salida estándar).')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    report = run_benchmark(args.iterations, args.warmup, args.user, args.password, args.scenario,
+                           not args.no_writes, args.sample)
+    report_json = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(report_json + '\n')
+        print(f"Resultados guardados en {args.output}", file=sys.stderr)
+    else:
+        print(report_json)
@@ -0,0 +1,66 @@
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, UTC
+
+from weasyprint import HTML, CSS
+
+from app import app, Record, record_load_options, render_record_print_html, PdfRenderer, APP_WIDE_DATETIME_FORMAT
+
+def render_without_cache(html_string, css_file_path, target):
+    # Lo que hacía generate_record_pdf antes: CSS y fuentes se resuelven en cada PDF
+    HTML(string=html_string, base_url='http://localhost/').write_pdf(target, stylesheets=[CSS(filename=css_file_path)])
+
+def describe(label, timings_ms):
+    timings_ms = sorted(timings_ms)
+    p95 = timings_ms[min(len(timings_ms) - 1, int(len(timings_ms) * 0.95))]
+    print(f"{label:<12} media {statistics.mean(timings_ms):8.1f} ms  mediana {statistics.median(timings_ms):8.1f} ms  "
+          f"p95 {p95:8.1f} ms  ({len(timings_ms)} PDFs)")
+    return statistics.mean(timings_ms)
+
+def run_benchmark(iterations, record_count):
+    """
+    Microbenchmark del renderizado de PDFs: mide el tiempo por PDF construyendo el CSS y la
+    configuración de fuentes en cada llamada, y con un PdfRenderer que los reutiliza.
+    """
+    with app.app_context():
+        records = Record.query.options(*record_load_options('pdf')).order_by(Record.id).limit(record_count).all()
+        if not records:
+            print("No hay expedientes en la base de datos. Ejecute seed_db.py primero.")
+            return
+        fecha_actual = datetime.now(UTC).strftime(APP_WIDE_DATETIME_FORMAT)
+        html_strings = [render_record_print_html(record, fecha_actual, 'http://localhost') for record in records]
+        css_file_path = os.path.join(app.root_path, 'static', 'css', 'estilo_impresion.css')
+        renderer = PdfRenderer(css_file_path)
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            target = os.path.join(output_dir, 'bench.pdf')
+            # Un render de calentamiento para cada modo (imports, caches de WeasyPrint)
+            render_without_cache(html_strings[0], css_file_path, target)
+            renderer.write_pdf(html_strings[0], target, base_url='http://localhost/')
+
+            timings_without_cache, timings_with_cache = [], []
+            for _ in range(iterations):
+                for html_string in html_strings:
+                    start = time.perf_counter()
+                    render_without_cache(html_string, css_file_path, target)
+                    timings_without_cache.append((time.perf_counter() - start) * 1000)
+
+                    start = time.perf_counter()
+                    renderer.write_pdf(html_string, target, base_url='http://localhost/')
+                    timings_with_cache.append((time.perf_counter() - start) * 1000)
+
+        print(f"Renderizado de PDF: {len(records)} expediente(s) x {iterations} iteración(es)")
+        mean_without_cache = describe("sin caché", timings_without_cache)
+        mean_with_cache = describe("con caché", timings_with_cache)
+        print(f"Mejora: {(1 - mean_with_cache / mean_without_cache) * 100:.1f}% "
+              f"(hojas de estilo parseadas con caché: {renderer.stylesheet_loads})")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Microbenchmark del renderizado de PDFs de expedientes.")
+    parser.add_argument('--iterations', type=int, default=5, help="Veces que se renderiza cada expediente.")
+    parser.add_argument('--records', type=int, default=5, help="Cantidad de expedientes a renderizar.")
+    args = parser.parse_args()
+    run_benchmark(args.iterations, args.records)
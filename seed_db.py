@@ -1,17 +1,175 @@
-from datetime import datetime, timezone, UTC # Use UTC for Python 3.12+
+from datetime import datetime, timedelta, timezone, UTC # Use UTC for Python 3.12+
+import argparse
 import random
+import time
 from faker import Faker
+from sqlalchemy import insert, text
 
 # Importa la app y db de tu aplicación principal
-from app import app, db, User, Department, Record, RecordHistory, generate_password_hash, DEPARTMENT_CODES
+from app import (app, db, User, Department, Record, RecordHistory, Note, SequenceCounter, generate_password_hash,
+                 DEPARTMENT_CODES, RECORD_SEQUENCE_COUNTER, next_sequence_candidate, setup_record_fts,
+                 rebuild_department_record_counts)
 
 fake = Faker('es_ES') # Para generar datos en español
 
-def seed_database():
+# Distribución aproximada de expedientes por departamento y por estado (pesos relativos).
+# Los departamentos que no figuran aquí reciben DEFAULT_DEPARTMENT_WEIGHT.
+DEPARTMENT_WEIGHTS = {
+    'Mesa de Entrada': 30,
+    'Obras Públicas': 18,
+    'Hacienda': 15,
+    'Intendencia': 10,
+    'Gobierno': 10,
+    'Cementerio': 7,
+    'Cultura': 6,
+    'Prensa': 4,
+}
+DEFAULT_DEPARTMENT_WEIGHT = 5
+STATUS_WEIGHTS = {'pending': 55, 'urgente': 10, 'in_progress': 15, 'archived': 15, 'active': 5}
+
+# Acciones de historial posteriores a la creación, con su peso relativo
+HISTORY_ACTION_WEIGHTS = {'MODIFICACIÓN': 40, 'REENVÍO': 35, 'ADJUNTO': 10, 'NOTA AGREGADA': 15}
+
+SEED_USER_PASSWORD = 'usuario'
+FAKE_POOL_SIZE = 2000 # Valores de Faker generados una vez y reutilizados (Faker es lento para millones de filas)
+
+def build_fake_pools():
+    """Listas de nombres, direcciones, textos, etc. de las que se eligen los valores de cada fila."""
+    return {
+        'names': [fake.name() for _ in range(FAKE_POOL_SIZE)],
+        'addresses': [fake.address() for _ in range(FAKE_POOL_SIZE)],
+        'phones': [fake.phone_number() for _ in range(FAKE_POOL_SIZE)],
+        'emails': [fake.email() for _ in range(FAKE_POOL_SIZE)],
+        'descriptions': [fake.paragraph(nb_sentences=random.randint(2, 5)) for _ in range(FAKE_POOL_SIZE)],
+        'sentences': [fake.sentence(nb_words=random.randint(6, 14)) for _ in range(FAKE_POOL_SIZE)],
+    }
+
+def random_count(average):
+    """Entero aleatorio con la media indicada (parte entera fija más un extra con probabilidad fraccional)."""
+    whole = int(average)
+    return whole + (1 if random.random() < average - whole else 0)
+
+def seed_users(num_users, departments):
+    """Crea num_users usuarios comunes repartidos entre los departamentos, con executemany."""
+    if num_users <= 0:
+        return []
+    password_hash = generate_password_hash(SEED_USER_PASSWORD) # Una sola vez: el hash es deliberadamente lento
+    weights = [DEPARTMENT_WEIGHTS.get(dept.name, DEFAULT_DEPARTMENT_WEIGHT) for dept in departments]
+    now = datetime.now(UTC)
+    rows = [{
+        'username': f'usuario{n}',
+        'password': password_hash,
+        'name': fake.name(),
+        'role': 'user',
+        'department': dept.name,
+        'created_at': now,
+    } for n, dept in enumerate(random.choices(departments, weights=weights, k=num_users), start=1)]
+    db.session.execute(insert(User), rows)
+    db.session.commit()
+    print(f"{num_users} usuarios creados (usuario1..usuario{num_users}, contraseña '{SEED_USER_PASSWORD}').")
+    return [user_id for (user_id,) in db.session.query(User.id).filter(User.role == 'user').all()]
+
+def seed_records(num_records, departments, user_ids, history_per_record, notes_per_record, batch_size, years=3):
+    """
+    Inserta num_records expedientes con su historial y sus notas en lotes de batch_size, con
+    executemany y un commit por lote. Las fechas de creación crecen con el número de secuencia
+    y se reparten a lo largo de los últimos `years` años.
+    """
+    pools = build_fake_pools()
+    department_weights = [DEPARTMENT_WEIGHTS.get(dept.name, DEFAULT_DEPARTMENT_WEIGHT) for dept in departments]
+    statuses, status_weights = list(STATUS_WEIGHTS), list(STATUS_WEIGHTS.values())
+    history_actions, history_action_weights = list(HISTORY_ACTION_WEIGHTS), list(HISTORY_ACTION_WEIGHTS.values())
+
+    now = datetime.now(UTC)
+    start_date = now - timedelta(days=365 * years)
+    step = (now - start_date) / max(num_records, 1)
+    next_record_id = (db.session.query(db.func.max(Record.id)).scalar() or 0) + 1
+    sequence_number = db.session.query(db.func.max(Record.sequence_number)).scalar() or 0
+    totals = {'records': 0, 'history': 0, 'notes': 0}
+    started = time.perf_counter()
+
+    for batch_start in range(0, num_records, batch_size):
+        batch_len = min(batch_size, num_records - batch_start)
+        batch_departments = random.choices(departments, weights=department_weights, k=batch_len)
+        batch_statuses = random.choices(statuses, weights=status_weights, k=batch_len)
+        record_rows, history_rows, note_rows = [], [], []
+
+        for offset in range(batch_len):
+            index = batch_start + offset
+            record_id = next_record_id + index
+            department = batch_departments[offset]
+            creator_id = random.choice(user_ids)
+            sequence_number = next_sequence_candidate(sequence_number)
+            created_at = start_date + step * index + timedelta(seconds=random.randint(0, 59))
+            dept_code = DEPARTMENT_CODES.get(department.name, f"DPT{department.id}")
+            record_rows.append({
+                'id': record_id,
+                'sequence_number': sequence_number,
+                'digital_number': f"{dept_code}-{sequence_number:04d}-{created_at.strftime('%d-%m-%Y')}",
+                'full_name': random.choice(pools['names']),
+                'dni': str(random.randint(10000000, 99999999)),
+                'address': random.choice(pools['addresses']),
+                'phone': random.choice(pools['phones']),
+                'email': random.choice(pools['emails']),
+                'description': random.choice(pools['descriptions']),
+                'transaction_date': created_at - timedelta(days=random.randint(0, 30)) if random.random() < 0.5 else None,
+                'status': batch_statuses[offset],
+                'department_id': department.id,
+                'created_by': creator_id,
+                'created_at': created_at,
+                'updated_at': created_at,
+                'attachment_filename': None,
+                'generated_pdf_filename': None,
+            })
+
+            # Historial: la creación y luego acciones posteriores, en orden cronológico
+            history_rows.append({
+                'record_id': record_id, 'user_id': creator_id, 'timestamp': created_at,
+                'action_type': 'CREACIÓN', 'details': f"Expediente iniciado en el departamento {department.name}.",
+            })
+            action_time = created_at
+            for action_type in random.choices(history_actions, weights=history_action_weights,
+                                              k=random_count(history_per_record)):
+                action_time += timedelta(hours=random.randint(1, 240))
+                history_rows.append({
+                    'record_id': record_id, 'user_id': random.choice(user_ids), 'timestamp': action_time,
+                    'action_type': action_type, 'details': random.choice(pools['sentences']),
+                })
+            note_time = created_at
+            for _ in range(random_count(notes_per_record)):
+                note_time += timedelta(hours=random.randint(1, 240))
+                note_rows.append({
+                    'record_id': record_id, 'user_id': random.choice(user_ids),
+                    'content': random.choice(pools['sentences']), 'created_at': note_time,
+                })
+
+        db.session.execute(insert(Record), record_rows)
+        db.session.execute(insert(RecordHistory), history_rows)
+        if note_rows:
+            db.session.execute(insert(Note), note_rows)
+        db.session.commit()
+        totals['records'] += len(record_rows)
+        totals['history'] += len(history_rows)
+        totals['notes'] += len(note_rows)
+        elapsed = time.perf_counter() - started
+        print(f"  {totals['records']}/{num_records} expedientes "
+              f"({totals['records'] / elapsed:,.0f}/s, {totals['history']} historial, {totals['notes']} notas)")
+
+    # El asignador continúa desde el último número generado
+    counter = db.session.get(SequenceCounter, RECORD_SEQUENCE_COUNTER)
+    if counter is None:
+        db.session.add(SequenceCounter(name=RECORD_SEQUENCE_COUNTER, last_value=sequence_number))
+    else:
+        counter.last_value = max(counter.last_value, sequence_number)
+    db.session.commit()
+    return totals
+
+def seed_database(num_records=15, num_users=0, history_per_record=1.0, notes_per_record=0.5, batch_size=5000):
     """
     Limpia la base de datos existente, recrea las tablas y
     llena con datos ficticios: un usuario admin, departamentos
-    por defecto y 15 expedientes aleatorios.
+    por defecto, num_users usuarios y num_records expedientes aleatorios
+    con su historial y sus notas.
     """
     with app.app_context(): # Esencial para operaciones de base de datos fuera de una ruta Flask
         print("Iniciando el proceso de seeding...")
@@ -19,6 +177,8 @@ def seed_database():
         # 1. Blanquear la base de datos (eliminar todas las tablas)
         print("Eliminando todas las tablas existentes...")
         db.drop_all()
+        db.session.execute(text("DROP TABLE IF EXISTS record_fts")) # Tabla virtual, fuera de los modelos
+        db.session.commit()
         print("Tablas eliminadas.")
 
         # 2. Recrear las tablas según los modelos definidos
@@ -111,91 +271,35 @@ def seed_database():
             print(f"  - ID: {dept_obj.id}, Nombre: {dept_obj.name}")
 
 
-        # 5. Crear 15 registros (expedientes) ficticios
-        print(f"Iniciando creación de 15 expedientes ficticios asignados al usuario ID: {admin_user_id}...")
-        records_created_count = 0
-        for i in range(15):
-            print(f"  Iteración {i+1}/15 para crear expediente:")
-            if not departments_for_records: # Check the correct list
-                print("    Error: la lista departments_for_records está vacía dentro del bucle. Saliendo del bucle.")
-                break
-            
-            selected_department = random.choice(departments_for_records) # Use the filtered list
-            print(f"    Departamento seleccionado: {selected_department.name} (ID: {selected_department.id})")
-            
-            # Get the last record number (globally) for sequence
-            last_global_record = Record.query.order_by(Record.sequence_number.desc()).first()
-            current_max_sequence = last_global_record.sequence_number if last_global_record else 0
-            sequence_number = current_max_sequence + 1
-            # Apply skipping logic for numbers ending in 8 or 9
-            while sequence_number % 10 == 8 or sequence_number % 10 == 9:
-                sequence_number += 1
-            print(f"    Número de secuencia calculado (después de omitir 8/9): {sequence_number}")
-
-            # Generate digital number (format: DEPT-SEQ-DD-MM-YYYY)
-            dept_code = DEPARTMENT_CODES.get(selected_department.name, f"DPT{selected_department.id}")
-            # Use current date for the number part, similar to add_record logic
-            date_for_digital_number_str = datetime.now(UTC).strftime('%d-%m-%Y')
-            digital_number = f"{dept_code}-{sequence_number:04d}-{date_for_digital_number_str}"
-            print(f"    Número digital generado: {digital_number}")
-
-            applicant_full_name = fake.name()
-            applicant_dni = fake.unique.random_number(digits=8, fix_len=True)
-            applicant_address = fake.address()
-            applicant_phone = fake.phone_number()
-            applicant_email = fake.email()
-
-            # For the record's created_at field, we can use a faked past date for realism in seeding
-            record_created_at_timestamp = fake.date_time_between(start_date='-1y', end_date='now', tzinfo=UTC) # Or timezone.utc
-
-            # Generate a fake transaction date (can be None sometimes)
-            transaction_date_for_seed = fake.date_time_between(start_date='-2y', end_date='-1d', tzinfo=UTC) if random.choice([True, False]) else None
-
-            record = Record(
-                sequence_number=sequence_number,
-                digital_number=digital_number,
-                full_name=applicant_full_name,
-                dni=str(applicant_dni),
-                address=applicant_address,
-                phone=applicant_phone,
-                email=applicant_email,
-                description=fake.paragraph(nb_sentences=random.randint(2, 5)),
-                transaction_date=transaction_date_for_seed,
-                status=random.choice(['pending', 'urgente']), # Updated to new primary statuses
-                department_id=selected_department.id,
-                created_by=admin_user_id,
-                created_at=record_created_at_timestamp,
-                updated_at=record_created_at_timestamp, # Or datetime.now(UTC) if updated_at should be current
-                attachment_filename=None,
-                generated_pdf_filename=None # New field
-            )
-            db.session.add(record)
-            try:
-                db.session.flush() # Para obtener record.id para la entrada de historial
-                
-                # Crear entrada de historial para la creación
-                history_entry = RecordHistory(
-                    record_id=record.id,
-                    user_id=admin_user_id, # Creado por el admin en el seeder
-                    action_type="CREACIÓN",
-                    details=f"Expediente iniciado en el departamento {selected_department.name}."
-                )
-                db.session.add(history_entry)
-                db.session.commit()
-                records_created_count += 1
-                print(f"    Expediente ficticio '{digital_number}' creado y comiteado para {selected_department.name}.")
-            except Exception as e:
-                print(f"    ERROR al comitear el expediente {digital_number}: {e}")
-                db.session.rollback() # Revertir en caso de error en este commit específico
-                print(f"    Rollback realizado para el expediente {digital_number}.")
-                # Considerar si continuar con el siguiente o detenerse
-                # break # Descomentar si quieres detener el bucle en el primer error
-
-        print(f"Total de {records_created_count} expedientes ficticios creados.")
-        if records_created_count < 15:
-            print("ADVERTENCIA: No se crearon los 15 expedientes esperados.")
-        
+        # 5. Crear usuarios comunes
+        user_ids = [admin_user_id] + seed_users(num_users, departments_for_records)
+
+        # 6. Crear expedientes ficticios, con su historial y sus notas, en lotes
+        print(f"Iniciando creación de {num_records} expedientes ficticios en lotes de {batch_size}...")
+        totals = seed_records(num_records, departments_for_records, user_ids,
+                              history_per_record, notes_per_record, batch_size)
+        print(f"Total de {totals['records']} expedientes, {totals['history']} entradas de historial "
+              f"y {totals['notes']} notas creados.")
+
+        # 7. Estructuras derivadas: los inserts masivos no pasan por la sesión ni por los triggers de FTS
+        rebuild_department_record_counts()
+        print("Contadores de expedientes por departamento recalculados.")
+        if setup_record_fts(): # El índice FTS5 y sus triggers no forman parte de los modelos
+            print("Índice de búsqueda de texto completo creado.")
+
         print("Proceso de seeding completado.")
 
 if __name__ == '__main__':
-    seed_database()
+    parser = argparse.ArgumentParser(description='Recrea la base de datos con datos ficticios.')
+    parser.add_argument('--records', type=int, default=15, help='Cantidad de expedientes (p. ej. 1000000).')
+    parser.add_argument('--users', type=int, default=0, help='Cantidad de usuarios comunes además del admin.')
+    parser.add_argument('--history-per-record', type=float, default=1.0,
+                        help='Acciones de historial promedio por expediente, además de la creación.')
+    parser.add_argument('--notes-per-record', type=float, default=0.5, help='Notas promedio por expediente.')
+    parser.add_argument('--batch-size', type=int, default=5000, help='Expedientes por lote (un commit por lote).')
+    parser.add_argument('--seed', type=int, default=None, help='Semilla aleatoria, para datos reproducibles.')
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+        Faker.seed(args.seed)
+    seed_database(args.records, args.users, args.history_per_record, args.notes_per_record, args.batch_size)
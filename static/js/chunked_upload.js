@@ -0,0 +1,112 @@
+// Subida por partes de adjuntos grandes.
+// Los formularios con data-chunked-upload="<bytes>" envían los archivos mayores que ese tamaño en fragmentos
+// (POST/PATCH a /upload-sessions) antes de enviar el formulario, que lleva entonces attachment_upload_token
+// en lugar del archivo. Si la conexión se corta, se consulta el desplazamiento y se continúa desde ahí.
+document.addEventListener('DOMContentLoaded', function () {
+    const MAX_RETRIES = 5;
+
+    function sleep(ms) {
+        return new Promise(function (resolve) { setTimeout(resolve, ms); });
+    }
+
+    async function readJson(response) {
+        try {
+            return await response.json();
+        } catch (e) {
+            return {};
+        }
+    }
+
+    async function currentOffset(token) {
+        const response = await fetch('/upload-sessions/' + token, { credentials: 'same-origin' });
+        if (!response.ok) {
+            throw new Error((await readJson(response)).error || 'No se pudo consultar el estado de la carga.');
+        }
+        return (await response.json()).offset;
+    }
+
+    async function uploadInChunks(file, onProgress) {
+        const created = await fetch('/upload-sessions', {
+            method: 'POST',
+            credentials: 'same-origin',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ filename: file.name, size: file.size })
+        });
+        const session = await readJson(created);
+        if (!created.ok) {
+            throw new Error(session.error || 'No se pudo iniciar la carga del archivo.');
+        }
+
+        let offset = 0;
+        let retries = 0;
+        while (offset < file.size) {
+            const chunk = file.slice(offset, offset + session.chunk_size);
+            try {
+                const response = await fetch('/upload-sessions/' + session.token, {
+                    method: 'PATCH',
+                    credentials: 'same-origin',
+                    headers: { 'Upload-Offset': String(offset), 'Content-Type': 'application/octet-stream' },
+                    body: chunk
+                });
+                const result = await readJson(response);
+                if (response.ok) {
+                    offset = result.offset;
+                    retries = 0;
+                } else if (response.status === 409 && typeof result.offset === 'number') {
+                    offset = result.offset; // El servidor tiene otra cantidad de bytes: se sigue desde ahí
+                } else if (response.status === 413 || response.status === 404) {
+                    throw new Error(result.error || 'La carga fue rechazada.');
+                } else {
+                    throw new TypeError(result.error || 'Error temporal del servidor.');
+                }
+            } catch (e) {
+                if (!(e instanceof TypeError) || retries >= MAX_RETRIES) {
+                    throw e;
+                }
+                retries += 1;
+                await sleep(1000 * retries);
+                offset = await currentOffset(session.token);
+            }
+            onProgress(offset / file.size);
+        }
+        return session.token;
+    }
+
+    document.querySelectorAll('form[data-chunked-upload]').forEach(function (form) {
+        const threshold = parseInt(form.dataset.chunkedUpload, 10);
+        const fileInput = form.querySelector('input[type="file"][name="attachment"]');
+        if (!fileInput || isNaN(threshold)) {
+            return;
+        }
+        const progress = document.createElement('div');
+        progress.className = 'form-text';
+        fileInput.insertAdjacentElement('afterend', progress);
+
+        form.addEventListener('submit', async function (event) {
+            const file = fileInput.files[0];
+            if (!file || file.size <= threshold || form.dataset.chunkedUploadDone) {
+                return;
+            }
+            event.preventDefault();
+            const submitButtons = form.querySelectorAll('[type="submit"]');
+            submitButtons.forEach(function (button) { button.disabled = true; });
+            try {
+                const token = await uploadInChunks(file, function (fraction) {
+                    progress.textContent = 'Subiendo archivo: ' + Math.floor(fraction * 100) + '%';
+                });
+                const tokenInput = document.createElement('input');
+                tokenInput.type = 'hidden';
+                tokenInput.name = 'attachment_upload_token';
+                tokenInput.value = token;
+                form.appendChild(tokenInput);
+                fileInput.disabled = true; // El archivo ya está en el servidor; no se vuelve a enviar
+                form.dataset.chunkedUploadDone = '1';
+                progress.textContent = 'Archivo subido. Guardando...';
+                form.submit();
+            } catch (e) {
+                progress.textContent = 'Error al subir el archivo: ' + e.message;
+                submitButtons.forEach(function (button) { button.disabled = false; });
+            }
+        });
+    });
+});
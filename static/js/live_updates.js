@@ -0,0 +1,185 @@
+// Live updates of the dashboard and the records listing.
+// The page wraps its tables in #live-record-updates, whose data-events-url is the /records/events stream starting
+// a little before the page was rendered. Events may arrive twice (right after the page loads, or on reconnect),
+// so every patch sets absolute values and rows are only inserted once.
+document.addEventListener('DOMContentLoaded', function () {
+    const container = document.getElementById('live-record-updates');
+    if (!container || !container.dataset.eventsUrl || !window.EventSource) {
+        return;
+    }
+    const STATUS_BADGES = {
+        active: 'bg-success',
+        pending: 'bg-warning text-dark',
+        in_progress: 'bg-info text-dark',
+        archived: 'bg-secondary',
+        urgente: 'bg-danger'
+    };
+    const isDashboard = container.dataset.view === 'dashboard';
+    const rowLimit = parseInt(container.dataset.liveLimit, 10) || 0;
+    const statusLabels = container.dataset.statusLabels ? JSON.parse(container.dataset.statusLabels) : {};
+    const departmentFilter = container.dataset.departmentFilter;
+    const statusFilter = container.dataset.statusFilter;
+
+    function tableBody() {
+        return container.querySelector('tbody[data-live-rows]');
+    }
+
+    function findRow(recordId) {
+        return container.querySelector('tr[data-record-id="' + recordId + '"]');
+    }
+
+    function element(tag, className, text) {
+        const node = document.createElement(tag);
+        if (className) {
+            node.className = className;
+        }
+        if (text !== undefined) {
+            node.textContent = text;
+        }
+        return node;
+    }
+
+    function statusBadge(change) {
+        const badgeClass = 'badge ' + (STATUS_BADGES[change.status] || 'bg-light text-dark');
+        return element('span', isDashboard ? badgeClass : badgeClass + ' status-badge', change.status_label);
+    }
+
+    function matchesFilters(change) {
+        return (!departmentFilter || String(change.department_id) === departmentFilter)
+            && (!statusFilter || change.status === statusFilter);
+    }
+
+    function flashRow(row) {
+        row.classList.add('table-info');
+        setTimeout(function () { row.classList.remove('table-info'); }, 3000);
+    }
+
+    function updateRow(row, change) {
+        if (!change.visible || !matchesFilters(change)) {
+            // Resent elsewhere or no longer matching the filters: kept, but dimmed, until the next reload
+            row.classList.add('opacity-50');
+            row.title = 'Este expediente ya no corresponde a este listado.';
+            return;
+        }
+        row.classList.remove('opacity-50');
+        row.removeAttribute('title');
+        const number = row.querySelector('[data-field="digital-number"]');
+        number.textContent = change.digital_number;
+        if (!isDashboard && change.resent) {
+            number.classList.add('text-info');
+            if (!number.parentNode.querySelector('.bi-arrow-repeat')) {
+                const icon = element('i', 'bi bi-arrow-repeat text-primary ms-1');
+                icon.title = 'Re-enviado';
+                number.parentNode.appendChild(icon);
+            }
+        }
+        row.querySelector('[data-field="department"]').textContent = change.department_name;
+        row.querySelector('[data-field="status"]').replaceChildren(statusBadge(change));
+        flashRow(row);
+    }
+
+    function buildRow(change) {
+        const row = element('tr');
+        row.dataset.recordId = change.record_id;
+        row.dataset.created = change.created_ts;
+        const cell = function (child, className) {
+            const td = element('td', className);
+            if (child !== undefined) {
+                td.append(child);
+            }
+            row.appendChild(td);
+            return td;
+        };
+        if (!isDashboard && document.getElementById('bulk-action-form')) {
+            const checkbox = element('input', 'form-check-input bulk-record-checkbox');
+            checkbox.type = 'checkbox';
+            checkbox.name = 'record_ids';
+            checkbox.value = change.record_id;
+            checkbox.setAttribute('form', 'bulk-action-form');
+            cell(checkbox, 'text-center');
+        }
+        cell(element('span', isDashboard ? 'badge bg-primary' : 'record-number')).firstChild.dataset.field = 'digital-number';
+        cell(change.full_name);
+        cell().dataset.field = 'department';
+        cell(undefined, isDashboard ? undefined : 'text-center').dataset.field = 'status';
+        cell(change.created_at);
+        if (!isDashboard) {
+            cell(change.created_by);
+        }
+        const viewLink = element('a', 'btn btn-sm btn-info');
+        viewLink.href = change.url;
+        viewLink.title = 'Ver Detalles';
+        viewLink.appendChild(element('i', 'bi bi-eye'));
+        if (isDashboard) {
+            cell(viewLink);
+        } else {
+            const group = element('div', 'btn-group');
+            group.setAttribute('role', 'group');
+            group.appendChild(viewLink);
+            if (container.dataset.canEdit) {
+                const editLink = element('a', 'btn btn-sm btn-warning');
+                editLink.href = change.edit_url;
+                editLink.title = 'Editar Expediente';
+                editLink.appendChild(element('i', 'bi bi-pencil'));
+                group.appendChild(editLink);
+            }
+            cell(group);
+        }
+        return row;
+    }
+
+    function insertRow(change) {
+        const tbody = tableBody();
+        if (!tbody || !change.visible || !matchesFilters(change)) {
+            return;
+        }
+        const firstRow = tbody.querySelector('tr[data-record-id]');
+        if (firstRow && parseFloat(firstRow.dataset.created) > change.created_ts) {
+            return; // Older than what the table starts with (e.g. imported with a past date)
+        }
+        tbody.querySelectorAll('tr:not([data-record-id])').forEach(function (row) { row.remove(); }); // "No hay expedientes"
+        const row = buildRow(change);
+        tbody.prepend(row);
+        updateRow(row, change);
+        if (rowLimit) {
+            const rows = tbody.querySelectorAll('tr[data-record-id]');
+            for (let i = rowLimit; i < rows.length; i++) {
+                rows[i].remove();
+            }
+        }
+    }
+
+    function applyChange(event) {
+        const change = JSON.parse(event.data);
+        const row = findRow(change.record_id);
+        if (row) {
+            updateRow(row, change);
+        } else if (event.type === 'record-created' && (isDashboard || container.dataset.insertNew)) {
+            insertRow(change);
+        }
+    }
+
+    function applyDepartmentCounts(event) {
+        const departmentCounts = JSON.parse(event.data);
+        Object.keys(departmentCounts).forEach(function (departmentId) {
+            const card = container.querySelector('[data-department-id="' + departmentId + '"]');
+            if (!card) {
+                return;
+            }
+            const counts = departmentCounts[departmentId];
+            card.querySelector('[data-field="total"]').textContent = counts.total;
+            card.querySelector('[data-field="by-status"]').textContent = Object.keys(counts.by_status).sort().map(function (status) {
+                const label = statusLabels[status] || (status.charAt(0).toUpperCase() + status.slice(1).toLowerCase());
+                return label + ': ' + counts.by_status[status];
+            }).join(' · ');
+        });
+    }
+
+    const source = new EventSource(container.dataset.eventsUrl);
+    ['record-created', 'record-resent', 'status-changed'].forEach(function (eventName) {
+        source.addEventListener(eventName, applyChange);
+    });
+    if (isDashboard) {
+        source.addEventListener('department-counts', applyDepartmentCounts);
+    }
+});
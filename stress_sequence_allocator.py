@@ -0,0 +1,96 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+def run_worker(worker_index, records_per_worker, manual_every, results):
+    """Crea expedientes a través de /records/add con su propio cliente, como lo haría un usuario más."""
+    from app import app, Department
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin'})
+    with app.app_context():
+        department_ids = [department.id for department in Department.query.order_by(Department.id).all()]
+
+    created = rejected = errors = 0
+    for i in range(records_per_worker):
+        form = {
+            'full_name': f'Prueba {worker_index}-{i}',
+            'department_id': department_ids[(worker_index + i) % len(department_ids)],
+            'status': 'pending',
+        }
+        if manual_every and i % manual_every == manual_every - 1:
+            # Números manuales que compiten entre workers: sólo uno de ellos debe poder usarlo
+            form['manual_sequence_number'] = str(5000 + i)
+        response = client.post('/records/add', data=form)
+        if response.status_code == 302:
+            created += 1
+        elif response.status_code == 200:
+            rejected += 1 # Formulario re-renderizado (p. ej. número manual ya en uso)
+        else:
+            errors += 1
+    results.put((worker_index, created, rejected, errors))
+
+def main():
+    parser = argparse.ArgumentParser(description='Prueba de concurrencia del asignador de números de secuencia.')
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--records', type=int, default=50, help='Expedientes por proceso.')
+    parser.add_argument('--manual-every', type=int, default=10,
+                        help='Cada cuántos expedientes se pide un número manual (0 = nunca).')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Base de datos descartable: app.py lee la URI al importarse, también en los procesos hijos
+        os.environ['MUNICIPAL_DATABASE_URI'] = 'sqlite:///' + os.path.join(temp_dir, 'stress.db')
+        from app import app, db, create_tables_and_admin, Record
+
+        with app.app_context():
+            create_tables_and_admin()
+
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        started = time.perf_counter()
+        workers = [context.Process(target=run_worker, args=(i, args.records, args.manual_every, results))
+                   for i in range(args.processes)]
+        for worker in workers:
+            worker.start()
+        worker_results = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+        created = sum(r[1] for r in worker_results)
+        rejected = sum(r[2] for r in worker_results)
+        errors = sum(r[3] for r in worker_results)
+
+        with app.app_context():
+            sequence_numbers = [row[0] for row in db.session.query(Record.sequence_number).all()]
+        duplicates = [n for n, times in Counter(sequence_numbers).items() if times > 1]
+        automatic = [n for n in sequence_numbers if n < 5000]
+        skipped_digits = [n for n in automatic if n % 10 in (8, 9)]
+
+        print(f"{args.processes} procesos x {args.records} expedientes en {elapsed:.1f} s: "
+              f"{created} creados, {rejected} rechazados, {errors} errores")
+        problems = []
+        if len(sequence_numbers) != created:
+            problems.append(f"{len(sequence_numbers)} expedientes en la base, {created} creados")
+        if duplicates:
+            problems.append(f"números duplicados: {sorted(duplicates)[:20]}")
+        if skipped_digits:
+            problems.append(f"números automáticos terminados en 8/9: {sorted(skipped_digits)[:20]}")
+        if errors:
+            problems.append(f"{errors} peticiones con error")
+        expected_manual_rejections = (args.processes - 1) * (args.records // args.manual_every) if args.manual_every else 0
+        if rejected != expected_manual_rejections:
+            problems.append(f"{rejected} rechazos, se esperaban {expected_manual_rejections}")
+        for problem in problems:
+            print(f"ERROR: {problem}")
+        if problems:
+            sys.exit(1)
+        print("OK: sin duplicados ni números terminados en 8/9.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+# The suite imports the single-file app from the repository root, so `pytest tests` works without installing it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Database and stored files of the test run live in a temporary folder, never in the working tree
+TEST_DATA_FOLDER = tempfile.mkdtemp(prefix='municipal-tests-')
+os.environ['MUNICIPAL_DATABASE_URI'] = 'sqlite:///' + os.path.join(TEST_DATA_FOLDER, 'test.db')
+
+from app import app  # noqa: E402
+
+for folder_key in ('UPLOAD_FOLDER', 'GENERATED_PDF_FOLDER', 'UPLOAD_TEMP_FOLDER', 'ATTACHMENT_BLOB_FOLDER'):
+    app.config[folder_key] = os.path.join(TEST_DATA_FOLDER, app.config[folder_key])
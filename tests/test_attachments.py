@@ -0,0 +1,69 @@
+import hashlib
+import os
+import tempfile
+import time
+from datetime import UTC, datetime, timedelta
+
+from app import (AttachmentBlob, Department, User, app, attachment_blob_path, create_record, create_tables_and_admin, db,
+                 put_attachment_blob)
+
+
+def store_blob(data, commit):
+    sha256 = hashlib.sha256(data).hexdigest()
+    source_path = os.path.join(tempfile.mkdtemp(), 'upload')
+    with open(source_path, 'wb') as f:
+        f.write(data)
+    put_attachment_blob(source_path, sha256, len(data))
+    if commit:
+        db.session.commit()
+    else:
+        db.session.rollback()
+    return attachment_blob_path(sha256)
+
+
+def make_old(path):
+    old = time.time() - 2 * 3600 * app.config['ATTACHMENT_GC_GRACE_HOURS']
+    os.utime(path, (old, old))
+
+
+def test_gc_collects_blob_files_left_by_a_rollback():
+    with app.app_context():
+        create_tables_and_admin()
+        rolled_back_path = store_blob(os.urandom(64), commit=False)
+        committed_path = store_blob(os.urandom(64), commit=True)
+        unreferenced_path = store_blob(os.urandom(64), commit=True)
+        committed_row = AttachmentBlob.query.filter_by(sha256=os.path.basename(committed_path)).one()
+        committed_row.ref_count = 1
+        unreferenced_row = AttachmentBlob.query.filter_by(sha256=os.path.basename(unreferenced_path)).one()
+        unreferenced_row.unreferenced_at = datetime.now(UTC) - timedelta(hours=2 * app.config['ATTACHMENT_GC_GRACE_HOURS'])
+        db.session.commit()
+    runner = app.test_cli_runner()
+
+    runner.invoke(args=['gc-attachments'])
+    assert os.path.exists(rolled_back_path) # Within the grace period its row could still be about to commit
+
+    for path in (rolled_back_path, committed_path, unreferenced_path):
+        make_old(path)
+    result = runner.invoke(args=['gc-attachments'])
+    assert 'Eliminados 1 adjuntos sin referencias' in result.output
+    assert 'y 1 ficheros sin registro' in result.output # The deleted blob's file is not counted again
+    assert not os.path.exists(rolled_back_path)
+    assert not os.path.exists(unreferenced_path)
+    assert os.path.exists(committed_path)
+
+
+def test_ref_counts_follow_an_attachment_replaced_after_commit():
+    with app.app_context():
+        create_tables_and_admin()
+        old_path = store_blob(os.urandom(64), commit=True)
+        new_path = store_blob(os.urandom(64), commit=True)
+        old_sha256, new_sha256 = os.path.basename(old_path), os.path.basename(new_path)
+        record = create_record(Department.query.order_by(Department.id).first(),
+                               User.query.filter_by(username='admin').one(), 'Vecino', attachment_sha256=old_sha256)
+        db.session.commit()
+        assert db.session.get(AttachmentBlob, old_sha256).ref_count == 1
+
+        record.attachment_sha256 = new_sha256 # The record was expired by the commit
+        db.session.commit()
+        assert db.session.get(AttachmentBlob, old_sha256).ref_count == 0
+        assert db.session.get(AttachmentBlob, new_sha256).ref_count == 1
@@ -0,0 +1,68 @@
+import pytest
+from sqlalchemy import func
+
+from app import (Department, Record, User, app, change_record_status, create_record, create_tables_and_admin, db,
+                 get_department_record_counts, rebuild_department_record_counts, resend_record_to_department)
+
+
+@pytest.fixture
+def app_context():
+    with app.app_context():
+        create_tables_and_admin()
+        yield
+        db.session.rollback()
+
+
+def counted_from_records():
+    """What get_department_record_counts() must return, counted from the record table."""
+    counts = {}
+    for department_id, status, count in db.session.query(Record.department_id, func.coalesce(Record.status, ''),
+                                                         func.count(Record.id))\
+                                                  .group_by(Record.department_id, Record.status):
+        department_counts = counts.setdefault(department_id, {'total': 0, 'by_status': {}})
+        department_counts['total'] += count
+        department_counts['by_status'][status] = count
+    return counts
+
+
+def test_counts_follow_inserts_status_changes_resends_and_deletes(app_context):
+    first, second = Department.query.order_by(Department.id).limit(2).all()
+    admin = User.query.filter_by(username='admin').one()
+    records = [create_record(first, admin, f'Vecino {i}', status='pending') for i in range(4)]
+    records.append(create_record(second, admin, 'Vecina', status='urgente'))
+    db.session.commit()
+    assert get_department_record_counts() == counted_from_records()
+
+    change_record_status(records[0], 'active', admin)
+    db.session.commit()
+    assert get_department_record_counts() == counted_from_records()
+
+    resend_record_to_department(records[1], second, admin)
+    resend_record_to_department(records[4], first, admin)
+    db.session.commit()
+    assert get_department_record_counts() == counted_from_records()
+
+    records[2].status = 'archived'
+    records[2].department_id = second.id # Both columns in one flush
+    db.session.commit()
+    assert get_department_record_counts() == counted_from_records()
+
+    for record in records[2:4]:
+        for entry in record.history_entries:
+            db.session.delete(entry)
+        db.session.delete(record)
+    db.session.commit()
+    assert get_department_record_counts() == counted_from_records()
+    assert get_department_record_counts([first.id]) == {first.id: counted_from_records()[first.id]}
+
+
+def test_rebuild_recomputes_drifted_counts(app_context):
+    department = Department.query.order_by(Department.id).first()
+    create_record(department, User.query.filter_by(username='admin').one(), 'Vecino', status='pending')
+    db.session.commit()
+    db.session.execute(db.text('UPDATE department_record_count SET count = count + 7')) # e.g. a manual SQL fix
+    db.session.commit()
+    assert get_department_record_counts() != counted_from_records()
+
+    rebuild_department_record_counts()
+    assert get_department_record_counts() == counted_from_records()
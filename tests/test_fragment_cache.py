@@ -0,0 +1,134 @@
+import json
+import os
+import tempfile
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+from app import (Department, Record, User, app, change_record_status, create_record, create_tables_and_admin, db,
+                 fragment_cache)
+
+
+@pytest.fixture
+def renders(monkeypatch):
+    """Fragment names rendered (cache misses) during the test, in order."""
+    with app.app_context():
+        create_tables_and_admin()
+    fragment_cache.clear()
+    rendered = []
+    put = fragment_cache.put
+
+    def recording_put(key, html):
+        rendered.append(key[0])
+        put(key, html)
+
+    monkeypatch.setattr(fragment_cache, 'put', recording_put)
+    return rendered
+
+
+@pytest.fixture
+def departments():
+    with app.app_context():
+        return [department.id for department in Department.query.order_by(Department.id).limit(2)]
+
+
+def login(username, password='clave'):
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': password})
+    return client
+
+
+def department_user(department_id):
+    """Logged-in client of a regular user of the department."""
+    with app.app_context():
+        department = db.session.get(Department, department_id)
+        username = f'fragment-{department_id}'
+        if not User.query.filter_by(username=username).first():
+            db.session.add(User(username=username, password=generate_password_hash('clave'), name='Usuaria Original',
+                                role='user', department=department.name))
+            db.session.commit()
+    return login(username)
+
+
+def add_record(department_id, full_name, username='admin'):
+    with app.app_context():
+        record = create_record(db.session.get(Department, department_id), User.query.filter_by(username=username).one(),
+                               full_name, status='pending')
+        db.session.commit()
+        return record.id
+
+
+def test_pages_are_reused_until_one_of_their_records_changes(renders, departments):
+    client = login('admin', 'admin')
+    record_id = add_record(departments[0], 'Vecina Cacheada')
+    for url in ('/records', '/dashboard', '/records', '/dashboard'):
+        assert 'Vecina Cacheada' in client.get(url).get_data(as_text=True)
+    assert renders == ['records_table', 'dashboard_panels']
+
+    add_record(departments[0], 'Vecino Nuevo')
+    assert 'Vecino Nuevo' in client.get('/records').get_data(as_text=True)
+    assert 'Vecino Nuevo' in client.get('/dashboard').get_data(as_text=True)
+    assert renders[2:] == ['records_table', 'dashboard_panels']
+
+    with app.app_context():
+        change_record_status(db.session.get(Record, record_id), 'urgente', User.query.filter_by(username='admin').one())
+        db.session.commit()
+    client.get('/records')
+    assert renders[4:] == ['records_table']
+
+
+def test_department_pages_ignore_other_departments_changes(renders, departments):
+    own, other = departments
+    client = department_user(own)
+    add_record(own, 'De Mi Departamento')
+    client.get('/records')
+    client.get('/dashboard')
+    assert renders == ['records_table', 'dashboard_panels']
+
+    add_record(other, 'De Otro Departamento')
+    body = client.get('/records').get_data(as_text=True)
+    client.get('/dashboard')
+    assert renders == ['records_table', 'dashboard_panels']
+    assert 'De Otro Departamento' not in body
+
+    add_record(own, 'Otro De Mi Departamento')
+    assert 'Otro De Mi Departamento' in client.get('/records').get_data(as_text=True)
+    assert renders[2:] == ['records_table']
+
+
+def test_renamed_departments_and_users_are_shown(renders, departments):
+    client = login('admin', 'admin')
+    department_user(departments[0]) # Creates the user whose name the listing shows
+    add_record(departments[0], 'Vecino Renombrado', username=f'fragment-{departments[0]}')
+    client.get('/records')
+    client.get('/dashboard')
+
+    with app.app_context():
+        User.query.filter_by(username=f'fragment-{departments[0]}').one().name = 'Usuaria Renombrada'
+        db.session.commit()
+    assert 'Usuaria Renombrada' in client.get('/records').get_data(as_text=True)
+    client.get('/dashboard') # Cached again with the new user names
+
+    with app.app_context():
+        department = db.session.get(Department, departments[0])
+        original_name, department.name = department.name, 'Departamento Renombrado'
+        db.session.commit()
+    try:
+        assert 'Departamento Renombrado' in client.get('/dashboard').get_data(as_text=True)
+    finally:
+        with app.app_context():
+            db.session.get(Department, departments[0]).name = original_name
+            db.session.commit()
+
+
+def test_imported_records_invalidate_the_pages(renders, departments):
+    client = login('admin', 'admin')
+    client.get('/records')
+    with app.app_context():
+        department_name = db.session.get(Department, departments[0]).name
+    source = os.path.join(tempfile.mkdtemp(), 'importados.jsonl')
+    with open(source, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'full_name': 'Vecina Importada', 'department': department_name}) + '\n')
+    result = app.test_cli_runner().invoke(args=['import-records', source])
+    assert result.exception is None, result.output
+    assert 'Vecina Importada' in client.get('/records').get_data(as_text=True)
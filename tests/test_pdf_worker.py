@@ -0,0 +1,38 @@
+import os
+import tempfile
+
+import app as app_module
+from app import PdfJob, app, create_tables_and_admin, db
+
+CRASH_MARKER = os.path.join(tempfile.mkdtemp(), 'crashed')
+run_pdf_job = app_module.run_pdf_job
+
+
+def run_pdf_job_crashing_once(job_id):
+    # Runs in the pool process: the first job kills its process, like WeasyPrint being OOM-killed
+    if not os.path.exists(CRASH_MARKER):
+        open(CRASH_MARKER, 'w').close()
+        os._exit(1)
+    return run_pdf_job(job_id)
+
+
+def test_worker_recovers_from_a_dead_pool_process(monkeypatch):
+    with app.app_context():
+        create_tables_and_admin()
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin'})
+    for i in range(4):
+        client.post('/records/add', data={'full_name': f'Vecino {i}', 'department_id': 2, 'status': 'pending'})
+    with app.app_context():
+        job_ids = [job.id for job in PdfJob.query.filter_by(status='queued')]
+    assert len(job_ids) == 4
+
+    monkeypatch.setattr(app_module, 'run_pdf_job', run_pdf_job_crashing_once)
+    monkeypatch.setitem(app.config, 'PDF_JOB_RETRY_DELAY_SECONDS', 0)
+    result = app.test_cli_runner().invoke(args=['pdf-worker', '--once', '--processes', '2'])
+
+    assert result.exception is None
+    with app.app_context():
+        jobs = db.session.query(PdfJob).filter(PdfJob.id.in_(job_ids)).all()
+        assert [job.status for job in jobs] == ['done'] * 4
+        assert max(job.attempts for job in jobs) == 2 # The job that was rendering when the process died
@@ -0,0 +1,18 @@
+import csv
+import io
+
+from app import app, stream_records_csv
+
+
+def read_csv(rows):
+    data = b''.join(stream_records_csv(rows)).decode('utf-8-sig')
+    return list(csv.reader(io.StringIO(data), delimiter=app.config['RECORDS_EXPORT_CSV_DELIMITER']))
+
+
+def test_csv_export_escapes_formula_cells():
+    rows = [['=HYPERLINK("http://example.com")', '+54 11 5555', '-1+1', '@SUM(A1)', '\tx', '\rx']]
+    assert read_csv(rows) == [["'" + value for value in rows[0]]]
+
+
+def test_csv_export_keeps_plain_values():
+    assert read_csv([['Juan Pérez', 'Calle 1 = 2', None, 42, -3]]) == [['Juan Pérez', 'Calle 1 = 2', '', '42', '-3']]
@@ -0,0 +1,94 @@
+import threading
+
+import pytest
+
+from sqlalchemy import func
+
+from app import (RECORD_SEQUENCE_COUNTER, Department, Record, RecordActionError, SequenceCounter, SequenceReservation,
+                 User, allocate_sequence_number, allocate_sequence_numbers, app, create_record, create_tables_and_admin,
+                 db, get_sequence_counter_value)
+
+
+@pytest.fixture
+def app_context():
+    with app.app_context():
+        create_tables_and_admin()
+        yield
+        db.session.rollback()
+
+
+def new_record(manual_sequence_number=None):
+    department = Department.query.order_by(Department.id).first()
+    admin = User.query.filter_by(username='admin').one()
+    return create_record(department, admin, 'Vecino', manual_sequence_number=manual_sequence_number)
+
+
+def test_automatic_numbers_skip_8_9_reserved_and_manual_ones(app_context):
+    # Start from a round number above everything in use, so the expected numbers are known
+    highest = max(get_sequence_counter_value(), db.session.query(func.max(Record.sequence_number)).scalar() or 0,
+                  db.session.query(func.max(SequenceReservation.sequence_number)).scalar() or 0)
+    base = (highest // 10 + 1) * 10
+    counter = db.session.get(SequenceCounter, RECORD_SEQUENCE_COUNTER)
+    if counter is None:
+        counter = SequenceCounter(name=RECORD_SEQUENCE_COUNTER)
+        db.session.add(counter)
+    counter.last_value = base
+    db.session.add(SequenceReservation(sequence_number=base + 2, note='Reservado para la prueba'))
+    new_record(manual_sequence_number=base + 3)
+    db.session.commit()
+
+    numbers = [new_record().sequence_number for _ in range(6)]
+    db.session.commit()
+    assert numbers == [base + 1, base + 4, base + 5, base + 6, base + 7, base + 10]
+
+
+def test_reserved_number_can_be_used_manually_once(app_context):
+    number = get_sequence_counter_value() + 100
+    db.session.add(SequenceReservation(sequence_number=number))
+    db.session.commit()
+    record = new_record(manual_sequence_number=number)
+    db.session.commit()
+    assert db.session.get(SequenceReservation, number).record_id == record.id
+    with pytest.raises(RecordActionError):
+        new_record(manual_sequence_number=number)
+
+
+def test_rolled_back_allocation_hands_out_the_number_again(app_context):
+    number = allocate_sequence_number()
+    db.session.rollback()
+    assert allocate_sequence_number() == number
+    db.session.rollback()
+
+
+def test_bulk_allocation_matches_one_by_one(app_context):
+    one_by_one = [allocate_sequence_number() for _ in range(25)]
+    db.session.rollback()
+    assert allocate_sequence_numbers(25) == one_by_one
+    db.session.rollback()
+
+
+def test_concurrent_adds_get_distinct_numbers(app_context):
+    department_id = Department.query.order_by(Department.id).first().id
+    before = {sequence_number for (sequence_number,) in db.session.query(Record.sequence_number)}
+    db.session.rollback()
+    failures = []
+
+    def add_records():
+        client = app.test_client()
+        client.post('/login', data={'username': 'admin', 'password': 'admin'})
+        for i in range(5):
+            response = client.post('/records/add', data={'full_name': f'Concurrente {i}', 'department_id': department_id,
+                                                          'status': 'pending'})
+            if response.status_code != 302:
+                failures.append(response.status_code)
+
+    threads = [threading.Thread(target=add_records) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert failures == []
+    numbers = [sequence_number for (sequence_number,) in db.session.query(Record.sequence_number)
+               if sequence_number not in before]
+    assert len(numbers) == len(set(numbers)) == 20
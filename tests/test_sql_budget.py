@@ -0,0 +1,71 @@
+import pytest
+from werkzeug.security import generate_password_hash
+
+from app import (Department, Note, SQLStatementBudgetExceeded, User, app, create_record, create_tables_and_admin, db,
+                 department_cache, fragment_cache, user_cache)
+
+# Statements a page may issue however many records, users and departments it shows. Loading relationships
+# row by row (N+1) goes far past it with the records seeded below.
+PAGE_SQL_BUDGET = 10
+
+
+@pytest.fixture(scope='module')
+def visible_record_ids():
+    """{(username, password): id of a record that user can see}, after seeding records from several users."""
+    with app.app_context():
+        create_tables_and_admin()
+        admin = User.query.filter_by(username='admin').one()
+        departments = Department.query.order_by(Department.id).limit(3).all()
+        department_users = []
+        for department in departments:
+            user = User(username=f'budget-{department.id}', password=generate_password_hash('clave'),
+                        name=f'Usuario {department.name}', role='user', department=department.name)
+            db.session.add(user)
+            department_users.append(user)
+        db.session.commit()
+        last_records = {}
+        for i in range(30):
+            department, user = departments[i % 3], department_users[i % 3]
+            last_records[department.id] = create_record(department, user, f'Vecino {i}',
+                                                        status=('pending', 'active', 'urgente')[i % 3])
+        for record in last_records.values():
+            for author in [admin] + department_users:
+                db.session.add(Note(record_id=record.id, user_id=author.id, content=f'Nota de {author.username}'))
+        db.session.commit()
+        visible = {('admin', 'admin'): last_records[departments[0].id].id}
+        for department, user in zip(departments, department_users):
+            visible[(user.username, 'clave')] = last_records[department.id].id
+        return visible
+
+
+@pytest.fixture
+def sql_budget(monkeypatch):
+    monkeypatch.setitem(app.config, 'SQL_STATEMENT_BUDGET', PAGE_SQL_BUDGET)
+    monkeypatch.setitem(app.config, 'PROPAGATE_EXCEPTIONS', True) # SQLStatementBudgetExceeded reaches the test
+
+
+def login(username, password):
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': password})
+    return client
+
+
+def get_uncached(client, url):
+    # The in-process caches would hide per-row queries, so every page is rendered from the database
+    fragment_cache.clear()
+    department_cache.invalidate()
+    user_cache.invalidate()
+    return client.get(url)
+
+
+def test_main_pages_stay_within_the_sql_budget(visible_record_ids, sql_budget):
+    for (username, password), record_id in visible_record_ids.items():
+        client = login(username, password)
+        for url in ('/records', '/dashboard', f'/records/{record_id}'):
+            assert get_uncached(client, url).status_code == 200, (username, url)
+
+
+def test_sql_budget_fails_requests_over_it(visible_record_ids, sql_budget, monkeypatch):
+    monkeypatch.setitem(app.config, 'SQL_STATEMENT_BUDGET', 1)
+    with pytest.raises(SQLStatementBudgetExceeded):
+        get_uncached(login('admin', 'admin'), '/records')